@@ -3,6 +3,7 @@ The binderhub application
 """
 
 import asyncio
+import copy
 import ipaddress
 import json
 import logging
@@ -40,20 +41,27 @@ from traitlets import (
     observe,
     validate,
 )
-from traitlets.config import Application
+from traitlets.config import Application, Config
+from traitlets.config.loader import JSONFileConfigLoader, PyFileConfigLoader
 
 from .base import VersionHandler
 from .build import BuildExecutor, KubernetesBuildExecutor, KubernetesCleaner
+from .build_queue import BuildQueue
+from .build_registry import BuildRegistry
 from .builder import BuildHandler
 from .events import EventLog
 from .handlers.repoproviders import RepoProvidersHandlers
 from .health import HealthHandler, KubernetesHealthHandler
+from .http_client import HTTPClientPools
+from .informer import PodInformer
 from .launcher import Launcher
 from .log import log_request
 from .main import LegacyRedirectHandler, RepoLaunchUIHandler, UIHandler
 from .metrics import MetricsHandler
+from .prewarm import ImagePrewarmer
 from .quota import KubernetesLaunchQuota, LaunchQuota
 from .ratelimit import RateLimiter
+from .refcache import RefCache
 from .registry import DockerRegistry
 from .repoproviders import (
     CKANProvider,
@@ -67,7 +75,8 @@ from .repoproviders import (
     RepoProvider,
     ZenodoProvider,
 )
-from .utils import ByteSpecification, url_path_join
+from .utils import ByteSpecification, NetworkIndex, url_path_join
+from .warmpool import WarmPool
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -321,6 +330,10 @@ class BinderHub(Application):
         The class used to build repo2docker images.
 
         Must inherit from binderhub.build.BuildExecutor
+
+        Use binderhub.build.AsyncKubernetesBuildExecutor to make requests
+        to Kubernetes from the event loop instead of threads of the build pool,
+        which limit the number of builds that can be watched at the same time.
         """,
         config=True,
     )
@@ -344,6 +357,32 @@ class BinderHub(Application):
         config=True,
     )
 
+    image_prewarmer_class = Type(
+        None,
+        klass=ImagePrewarmer,
+        allow_none=True,
+        help="""
+        The class used to pull popular images on nodes ahead of their launches,
+        e.g. binderhub.prewarm.KubernetesImagePrewarmer.
+
+        Images aren't prewarmed if None.
+        """,
+        config=True,
+    )
+
+    warm_pool_class = Type(
+        None,
+        klass=WarmPool,
+        allow_none=True,
+        help="""
+        The class used to keep idle servers running for the most launched images,
+        handed to users on launch, e.g. binderhub.warmpool.WarmPool.
+
+        Only used when authentication is disabled. No idle servers are kept if None.
+        """,
+        config=True,
+    )
+
     health_handler_class = Type(
         HealthHandler,
         help="The Tornado /health handler class",
@@ -651,8 +690,60 @@ class BinderHub(Application):
 
         return proposal.value
 
+    rate_limiter_class = Type(
+        RateLimiter,
+        klass=RateLimiter,
+        config=True,
+        help="""
+        The class checking the rate limits of build requests.
+
+        The default keeps limits in memory, separately for each BinderHub replica.
+        binderhub.ratelimit.RedisRateLimiter shares them between replicas.
+        """,
+    )
+
+    ref_cache_class = Type(
+        RefCache,
+        klass=RefCache,
+        config=True,
+        help="""
+        The class caching resolved refs, shared by all repo providers.
+
+        The default keeps them in memory.
+        binderhub.refcache.SQLiteRefCache keeps them across restarts,
+        binderhub.refcache.RedisRefCache shares them between BinderHub replicas.
+        Configure how long refs are cached with e.g. c.RepoProvider.ref_cache_ttl.
+        """,
+    )
+
     concurrent_build_limit = Integer(
-        32, config=True, help="""The number of concurrent builds to allow."""
+        32,
+        config=True,
+        help="""
+        The number of concurrent builds to allow.
+
+        Builds over the limit wait in a queue, and clients are told their position.
+        Builds are taken from the queue in order of arrival,
+        unless a `build_priority` is set with `RepoProvider.spec_config`,
+        in which case builds with a higher priority go first.
+        Builds count in the limit until they are done, even if all clients have left.
+
+        Sets `BuildQueue.limit`, unless it is configured.
+        """,
+    )
+    use_build_pod_informer = Bool(
+        True,
+        config=True,
+        help="""
+        Watch all build pods with a single shared watch.
+
+        When enabled, a single list+watch of build pods is run for the whole process,
+        and changes are sent to every build waiting on a pod.
+        Otherwise each build opens its own watch on its pod,
+        holding a thread of the build pool for the duration of the build.
+
+        Only used with KubernetesBuildExecutor.
+        """,
     )
     executor_threads = Integer(
         5,
@@ -767,12 +858,33 @@ class BinderHub(Application):
 
     @validate("ban_networks")
     def _cast_ban_networks(self, proposal):
-        """Cast CIDR strings to IPv[4|6]Network objects"""
+        """Cast CIDR strings to IPv[4|6]Network objects, indexed for lookups"""
         networks = {}
         for cidr, message in proposal.value.items():
             networks[ipaddress.ip_network(cidr)] = message
 
-        return networks
+        return NetworkIndex(networks)
+
+    dynamic_config_file = Unicode(
+        "",
+        config=True,
+        help="""
+        Config file (.py or .json) with ban lists and spec_config,
+        reloaded when it changes, without restarting BinderHub.
+
+        Only BinderHub.ban_networks and the banned_specs, allowed_specs,
+        high_quota_specs and spec_config of repo providers are loaded from it,
+        overriding the values of the main config.
+        The file can be e.g. mounted from a Kubernetes ConfigMap.
+        If it can't be loaded, the previous values are kept.
+        """,
+    )
+
+    dynamic_config_interval = Integer(
+        30,
+        config=True,
+        help="""Interval (in seconds) for how often dynamic_config_file is checked for changes.""",
+    )
 
     tornado_settings = Dict(
         config=True,
@@ -858,6 +970,13 @@ class BinderHub(Application):
             handlers[i] = tuple(lis)
         return handlers
 
+    def _make_build_queue(self):
+        """The BuildQueue, limited to concurrent_build_limit unless configured"""
+        build_queue = BuildQueue(parent=self)
+        if "limit" not in self.config.get("BuildQueue", {}):
+            build_queue.limit = self.concurrent_build_limit
+        return build_queue
+
     def init_pycurl(self):
         try:
             AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
@@ -921,17 +1040,29 @@ class BinderHub(Application):
             ]
         )
         jinja_env = Environment(loader=loader, **jinja_options)
+        self.http_clients = HTTPClientPools(parent=self)
         if self.use_registry:
-            registry = self.registry_class(parent=self)
+            registry = self.registry_class(
+                parent=self, http_client=self.http_clients.get("registry")
+            )
         else:
             registry = None
 
+        if self.image_prewarmer_class:
+            self.image_prewarmer = self.image_prewarmer_class(
+                parent=self, registry=registry, executor=self.executor
+            )
+        else:
+            self.image_prewarmer = None
+
         self.launcher = Launcher(
             parent=self,
             hub_url=self.hub_url,
             hub_url_local=self.hub_url_local,
             hub_api_token=self.hub_api_token,
             create_user=not self.auth_enabled,
+            http_client=self.http_clients.get("launcher"),
+            spawn_http_client=self.http_clients.get("launcher_spawns"),
         )
 
         self.event_log = EventLog(parent=self)
@@ -940,11 +1071,34 @@ class BinderHub(Application):
             with open(schema_file) as f:
                 self.event_log.register_schema(json.load(f))
 
-        launch_quota = self.launch_quota_class(parent=self, executor=self.executor)
+        self.launch_quota = launch_quota = self.launch_quota_class(
+            parent=self, executor=self.executor
+        )
 
         # Construct a Builder so that we can extract parameters such as the
         # configuration or the version string to pass to /version and /health handlers
         example_builder = self.build_class(parent=self)
+
+        self.build_pod_informer = None
+        if (
+            self.builder_required
+            and self.use_build_pod_informer
+            and issubclass(self.build_class, KubernetesBuildExecutor)
+        ):
+            self.build_pod_informer = PodInformer(
+                parent=self,
+                api=self.kube_client,
+                namespace=example_builder.namespace,
+                label_selector=f"component={example_builder._component_label}",
+            )
+
+        if self.warm_pool_class and not self.auth_enabled:
+            self.warm_pool = self.warm_pool_class(
+                parent=self, launcher=self.launcher, launch_quota=launch_quota
+            )
+        else:
+            self.warm_pool = None
+
         self.tornado_settings.update(
             {
                 "log_function": log_request,
@@ -954,6 +1108,10 @@ class BinderHub(Application):
                 "launcher": self.launcher,
                 "ban_networks": self.ban_networks,
                 "build_pool": self.build_pool,
+                "build_registry": BuildRegistry(
+                    parent=self, build_queue=self._make_build_queue()
+                ),
+                "build_pod_informer": self.build_pod_informer,
                 "build_token_check_origin": self.build_token_check_origin,
                 "build_token_secret": self.build_token_secret,
                 "build_token_expires_seconds": self.build_token_expires_seconds,
@@ -962,12 +1120,17 @@ class BinderHub(Application):
                 "per_repo_quota": self.per_repo_quota,
                 "per_repo_quota_higher": self.per_repo_quota_higher,
                 "repo_providers": self.repo_providers,
+                "ref_cache": self.ref_cache_class(parent=self),
+                "http_clients": self.http_clients,
                 "launch_quota": launch_quota,
-                "rate_limiter": RateLimiter(parent=self),
+                "rate_limiter": self.rate_limiter_class(parent=self),
                 "use_registry": self.use_registry,
                 "build_class": self.build_class,
                 "registry": registry,
+                "image_prewarmer": self.image_prewarmer,
+                "warm_pool": self.warm_pool,
                 "traitlets_config": self.config,
+                "spec_matchers": self._build_spec_matchers(self.config),
                 "traitlets_parent": self,
                 "about_message": self.about_message,
                 "banner_message": self.banner_message,
@@ -1106,9 +1269,148 @@ class BinderHub(Application):
             )
         self.tornado_app = tornado.web.Application(handlers, **self.tornado_settings)
 
+        # the values overridden by dynamic_config_file
+        self._static_config = copy.deepcopy(self.config)
+        self._static_ban_networks = self.ban_networks
+        self._dynamic_config_stat = None
+        if self.dynamic_config_file:
+            self.reload_dynamic_config()
+
+    # the config that can be loaded from dynamic_config_file
+    _dynamic_provider_traits = {
+        "banned_specs",
+        "allowed_specs",
+        "high_quota_specs",
+        "spec_config",
+    }
+
+    def _load_dynamic_config(self):
+        """Load and check the config of dynamic_config_file
+
+        Returns (traitlets_config, spec_matchers, ban_networks) to use,
+        with the spec patterns compiled, so that they are ready for requests.
+        """
+        path = os.path.abspath(self.dynamic_config_file)
+        directory, filename = os.path.split(path)
+        if filename.endswith(".json"):
+            loader = JSONFileConfigLoader(filename, path=directory, log=self.log)
+        else:
+            loader = PyFileConfigLoader(filename, path=directory, log=self.log)
+        loaded = loader.load_config()
+
+        provider_sections = {
+            cls.__name__
+            for provider in self.repo_providers.values()
+            for cls in provider.mro()
+            if issubclass(cls, RepoProvider)
+        }
+        dynamic_config = Config()
+        for section, values in loaded.items():
+            if section == "BinderHub":
+                allowed = {"ban_networks"}
+            elif section in provider_sections:
+                allowed = self._dynamic_provider_traits
+            else:
+                allowed = set()
+            ignored = set(values).difference(allowed)
+            if ignored:
+                self.log.warning(
+                    "Ignoring %s.%s in %s, it can't be changed without a restart",
+                    section,
+                    f"{{{','.join(sorted(ignored))}}}",
+                    self.dynamic_config_file,
+                )
+            for name in set(values).intersection(allowed):
+                dynamic_config[section][name] = values[name]
+
+        ban_networks = self._static_ban_networks
+        if "ban_networks" in dynamic_config.BinderHub:
+            ban_networks = NetworkIndex(
+                {
+                    ipaddress.ip_network(cidr): message
+                    for cidr, message in dynamic_config.BinderHub.ban_networks.items()
+                }
+            )
+
+        traitlets_config = copy.deepcopy(self._static_config)
+        traitlets_config.merge(dynamic_config)
+        # compile the patterns before using them
+        spec_matchers = self._build_spec_matchers(traitlets_config)
+        return traitlets_config, spec_matchers, ban_networks
+
+    def _build_spec_matchers(self, config):
+        """The ProviderSpecMatchers of each repo provider, by prefix, for `config`"""
+        return {
+            prefix: provider.build_spec_matchers(config)
+            for prefix, provider in self.repo_providers.items()
+        }
+
+    def reload_dynamic_config(self):
+        """Load dynamic_config_file if it has changed since it was last loaded
+
+        The ban lists and spec_config used by new requests are replaced at once,
+        without restarting BinderHub and dropping the connections of running builds.
+        Returns True if the config has been reloaded.
+        """
+        try:
+            st = os.stat(self.dynamic_config_file)
+        except FileNotFoundError:
+            st = None
+        # ConfigMap mounts are replaced by a symlink change, so compare the file itself
+        stat = st and (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat == self._dynamic_config_stat:
+            return False
+        if st is None:
+            self.log.warning(
+                "Dynamic config file %s not found, keeping the current config",
+                self.dynamic_config_file,
+            )
+            self._dynamic_config_stat = stat
+            return False
+
+        try:
+            traitlets_config, spec_matchers, ban_networks = self._load_dynamic_config()
+        except Exception:
+            self.log.exception(
+                "Failed to load dynamic config file %s, keeping the current config",
+                self.dynamic_config_file,
+            )
+            # don't retry until the file changes again
+            self._dynamic_config_stat = stat
+            return False
+
+        self._dynamic_config_stat = stat
+        self.ban_networks = ban_networks
+        self.tornado_app.settings.update(
+            {
+                "traitlets_config": traitlets_config,
+                "spec_matchers": spec_matchers,
+                "ban_networks": self.ban_networks,
+            }
+        )
+        self.log.info("Loaded dynamic config file %s", self.dynamic_config_file)
+        return True
+
+    async def watch_dynamic_config(self):
+        """
+        Watch dynamic_config_file, reload it every dynamic_config_interval if it has changed
+        """
+        while True:
+            await asyncio.sleep(self.dynamic_config_interval)
+            try:
+                self.reload_dynamic_config()
+            except Exception:
+                app_log.exception("Failed to reload dynamic config")
+
     def stop(self):
         self.http_server.stop()
         self.build_pool.shutdown()
+        if self.build_pod_informer is not None:
+            self.build_pod_informer.stop()
+        self.launch_quota.stop()
+        self.http_clients.close()
+        if getattr(self, "_watch_dynamic_config_future", None) is not None:
+            self._watch_dynamic_config_future.cancel()
 
     async def watch_build_pods(self):
         warnings.warn(
@@ -1130,6 +1432,39 @@ class BinderHub(Application):
                 app_log.exception("Failed to cleanup builders")
             await asyncio.sleep(self.build_cleanup_interval)
 
+    async def prewarm_images(self):
+        """
+        Update the images prewarmed on nodes every image_prewarmer.update_interval
+        """
+        while self.image_prewarmer is not None:
+            await asyncio.sleep(self.image_prewarmer.update_interval)
+            try:
+                await self.image_prewarmer.update()
+            except Exception:
+                app_log.exception("Failed to prewarm images")
+
+    async def update_warm_pool(self):
+        """
+        Start and stop idle servers every warm_pool.update_interval
+        """
+        while self.warm_pool is not None:
+            await asyncio.sleep(self.warm_pool.update_interval)
+            try:
+                await self.warm_pool.update()
+            except Exception:
+                app_log.exception("Failed to update warm pool")
+
+    async def fill_user_pool(self):
+        """
+        Refill the pool of temporary users every launcher.user_pool_interval
+        """
+        while self.launcher.create_user and self.launcher.user_pool_size:
+            try:
+                await self.launcher.fill_user_pool()
+            except Exception:
+                app_log.exception("Failed to fill the pool of temporary users")
+            await asyncio.sleep(self.launcher.user_pool_interval)
+
     def start(self, run_loop=True):
         self.log.info("BinderHub starting on port %i", self.port)
         self.http_server = HTTPServer(
@@ -1139,6 +1474,18 @@ class BinderHub(Application):
         self.http_server.listen(self.port)
         if self.builder_required:
             asyncio.ensure_future(self.watch_builders())
+        if self.image_prewarmer is not None:
+            asyncio.ensure_future(self.prewarm_images())
+        if self.warm_pool is not None:
+            asyncio.ensure_future(self.update_warm_pool())
+        if self.launcher.create_user and self.launcher.user_pool_size:
+            asyncio.ensure_future(self.fill_user_pool())
+        if self.dynamic_config_file:
+            self._watch_dynamic_config_future = asyncio.ensure_future(
+                self.watch_dynamic_config()
+            )
+        if self.build_pod_informer is not None:
+            self.build_pod_informer.start()
         if run_loop:
             tornado.ioloop.IOLoop.current().start()
 
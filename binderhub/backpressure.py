@@ -0,0 +1,306 @@
+"""
+Back-pressure on the JupyterHub API, when the Hub is struggling
+
+A circuit breaker stops requests to the Hub after consecutive failures,
+and an adaptive (AIMD) limit bounds the number of concurrent requests,
+so that a degraded Hub isn't kept down by retried requests.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+
+from prometheus_client import Counter, Enum, Gauge
+from traitlets import Float, Integer
+from traitlets.config import LoggingConfigurable
+
+HUB_API_CIRCUIT_STATE = Enum(
+    "binderhub_hub_api_circuit_state",
+    "State of the circuit breaker of Hub API requests",
+    states=["closed", "open", "half_open"],
+)
+HUB_API_CIRCUIT_OPENED = Counter(
+    "binderhub_hub_api_circuit_opened_count",
+    "Number of times the circuit breaker of Hub API requests has opened",
+)
+HUB_API_REJECTED = Counter(
+    "binderhub_hub_api_rejected_count",
+    "Hub API requests rejected without being sent, by reason",
+    ["reason"],
+)
+HUB_API_CONCURRENCY_LIMIT = Gauge(
+    "binderhub_hub_api_concurrency_limit",
+    "Current limit of concurrent Hub API requests",
+)
+HUB_API_ACTIVE = Gauge(
+    "binderhub_hub_api_active_requests",
+    "Hub API requests in progress, counted in the concurrency limit",
+)
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected to relieve the Hub"""
+
+    def __init__(self, message, *, retry_after, reason):
+        """
+        message: Description of the rejection
+        retry_after: Seconds after which a request may succeed
+        reason: String indicating why the request was rejected, for metrics
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class CircuitBreaker(LoggingConfigurable):
+    """Stop requests to the Hub after consecutive failures
+
+    - closed: requests are sent, until `failure_threshold` consecutive failures
+    - open: requests are rejected for `open_seconds`
+    - half_open: a single request is sent to probe the Hub,
+      closing the circuit if it succeeds, opening it again
+      (for twice as long, up to `max_open_seconds`) if it fails
+
+    Call `check()` before each request, and `record(success)` after it.
+    """
+
+    failure_threshold = Integer(
+        5,
+        config=True,
+        help="Number of consecutive failed requests to open the circuit",
+    )
+
+    open_seconds = Float(
+        10,
+        config=True,
+        help="Time (seconds) to reject requests for once the circuit opens",
+    )
+
+    max_open_seconds = Float(
+        120,
+        config=True,
+        help="""
+        Maximum time (seconds) to reject requests for,
+        when the circuit opens again after failed probes.
+        """,
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.state = "closed"
+        self._failures = 0
+        self._opened = 0
+        self._open_seconds = self.open_seconds
+        # start time of the probe in progress while half-open, if any
+        self._probe_started = None
+        HUB_API_CIRCUIT_STATE.state(self.state)
+
+    def _now(self):
+        return time.monotonic()
+
+    def _set_state(self, state):
+        self.state = state
+        HUB_API_CIRCUIT_STATE.state(state)
+
+    def _open(self, now):
+        self._opened = now
+        self._probe_started = None
+        self._set_state("open")
+        HUB_API_CIRCUIT_OPENED.inc()
+        self.log.warning(
+            "Hub API circuit open, rejecting requests for %.0fs", self._open_seconds
+        )
+
+    def retry_after(self):
+        """Seconds until requests may be sent again"""
+        if self.state == "closed":
+            return 0
+        remaining = self._opened + self._open_seconds - self._now()
+        return max(1, math.ceil(remaining))
+
+    def check(self):
+        """Check that a request may be sent, raises Overloaded if not"""
+        if self.state == "closed":
+            return
+        now = self._now()
+        if self.state == "open":
+            if now - self._opened < self._open_seconds:
+                raise Overloaded(
+                    "Hub API circuit open",
+                    retry_after=self.retry_after(),
+                    reason="circuit_open",
+                )
+            self.log.info("Hub API circuit half-open, probing the Hub")
+            self._set_state("half_open")
+        # half-open: let a single request through,
+        # or a new one if the probe never completed (e.g. it was cancelled)
+        if (
+            self._probe_started is not None
+            and now - self._probe_started < self._open_seconds
+        ):
+            raise Overloaded(
+                "Hub API circuit half-open",
+                retry_after=max(1, math.ceil(self._open_seconds)),
+                reason="circuit_half_open",
+            )
+        self._probe_started = now
+
+    def record(self, success):
+        """Record the outcome of a request"""
+        if success:
+            self._failures = 0
+            if self.state != "closed":
+                self.log.info("Hub API circuit closed")
+                self._open_seconds = self.open_seconds
+                self._probe_started = None
+                self._set_state("closed")
+            return
+        now = self._now()
+        if self.state == "half_open":
+            # the Hub is still struggling, wait longer before the next probe
+            self._open_seconds = min(self.max_open_seconds, self._open_seconds * 2)
+            self._open(now)
+        elif self.state == "closed":
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._failures = 0
+                self._open(now)
+
+
+class AdaptiveConcurrencyLimit(LoggingConfigurable):
+    """Limit the number of concurrent requests, adapting the limit to the Hub
+
+    The limit grows by 1 for every `limit` successful requests (additive increase),
+    and is multiplied by `backoff_factor` when requests fail or are slow
+    (multiplicative decrease), at most once every `backoff_interval` seconds.
+
+    Requests over the limit wait for `max_wait` seconds for a slot,
+    before being rejected.
+    """
+
+    initial_limit = Integer(
+        20,
+        config=True,
+        help="Initial limit of concurrent requests",
+    )
+
+    min_limit = Integer(
+        2,
+        config=True,
+        help="Minimum limit of concurrent requests",
+    )
+
+    max_limit = Integer(
+        200,
+        config=True,
+        help="Maximum limit of concurrent requests",
+    )
+
+    backoff_factor = Float(
+        0.5,
+        config=True,
+        help="Factor applied to the limit when requests fail or are slow",
+    )
+
+    backoff_interval = Float(
+        1,
+        config=True,
+        help="""
+        Minimum time (seconds) between two decreases of the limit,
+        so that the failures of concurrent requests only decrease it once.
+        """,
+    )
+
+    slow_request_seconds = Float(
+        10,
+        config=True,
+        help="""
+        Time (seconds) after which a successful request is considered slow,
+        decreasing the limit. 0 to only decrease it on failures.
+        """,
+    )
+
+    max_wait = Float(
+        10,
+        config=True,
+        help="Time (seconds) for a request to wait for a slot, before being rejected",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.limit = float(self.initial_limit)
+        self.active = 0
+        self._waiters = deque()
+        self._last_backoff = None
+        HUB_API_CONCURRENCY_LIMIT.set(int(self.limit))
+
+    def _now(self):
+        return time.monotonic()
+
+    async def acquire(self):
+        """Wait for a slot, raises Overloaded if none is free within max_wait
+
+        Returns the start time of the request, to pass to `release`.
+        """
+        deadline = self._now() + self.max_wait
+        while self.active >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, max(0, deadline - self._now()))
+            except asyncio.TimeoutError:
+                raise Overloaded(
+                    f"Over {int(self.limit)} concurrent Hub API requests",
+                    retry_after=max(1, math.ceil(self.max_wait)),
+                    reason="concurrency_limit",
+                ) from None
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.active += 1
+        HUB_API_ACTIVE.set(self.active)
+        return self._now()
+
+    def release(self, started, success):
+        """Release the slot of a request
+
+        started: start time of the request returned by `acquire`,
+        None to not consider slow requests as failures (e.g. long-running requests).
+        success: whether the request succeeded, None to leave the limit unchanged
+        (e.g. cancelled requests).
+        """
+        self.active -= 1
+        HUB_API_ACTIVE.set(self.active)
+        now = self._now()
+        if success is not None:
+            if (
+                success
+                and self.slow_request_seconds
+                and started is not None
+                and now - started > self.slow_request_seconds
+            ):
+                success = False
+            if success:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif (
+                self._last_backoff is None
+                or now - self._last_backoff >= self.backoff_interval
+            ):
+                self._last_backoff = now
+                self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+                self.log.warning(
+                    "Hub API requests failing or slow, limiting to %i concurrent requests",
+                    self.limit,
+                )
+            HUB_API_CONCURRENCY_LIMIT.set(int(self.limit))
+
+        # wake up the requests that fit in the limit
+        for _ in range(int(self.limit) - self.active):
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+            else:
+                break
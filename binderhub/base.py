@@ -97,37 +97,42 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
         self._have_build_token = True
         return decoded
 
-    def check_rate_limit(self):
+    async def check_rate_limit(self):
         rate_limiter = self.settings["rate_limiter"]
-        if rate_limiter.limit == 0:
-            # no limit enabled
-            return
-
+        request_ip = self.request.remote_ip
         if self.settings["auth_enabled"] and self.current_user:
-            # authenticated, no limit
-            # TODO: separate authenticated limit
-            return
+            # authenticated, rate limit is applied per-user
+            user = self.current_user
+            if isinstance(user, dict):
+                user = user["name"]
+            key = f"user:{user}"
+            limit = rate_limiter.authenticated_limit
+        elif self._have_build_token:
+            # build token defined, separate rate limit per-ip
+            key = f"build-token:{request_ip}"
+            limit = rate_limiter.build_token_limit
+        else:
+            # rate limit is applied per-ip
+            key = request_ip
+            limit = rate_limiter.limit
 
-        if self._have_build_token:
-            # build token defined, no limit
-            # TODO: use different limit for verified builds
+        if limit == 0:
+            # no limit enabled
             return
 
-        # rate limit is applied per-ip
-        request_ip = self.request.remote_ip
         try:
-            limit = rate_limiter.increment(request_ip)
-        except RateLimitExceeded:
+            remaining = await rate_limiter.async_increment(key, limit=limit)
+        except RateLimitExceeded as e:
             raise web.HTTPError(
                 429,
-                f"Rate limit exceeded. Try again in {rate_limiter.period_seconds} seconds.",
+                f"Rate limit exceeded. Try again in {e.retry_after} seconds.",
             )
         else:
-            app_log.debug(f"Rate limit for {request_ip}: {limit}")
+            app_log.debug(f"Rate limit for {key}: {remaining}")
 
-        self.set_header("x-ratelimit-remaining", str(limit["remaining"]))
-        self.set_header("x-ratelimit-reset", str(limit["reset"]))
-        self.set_header("x-ratelimit-limit", str(rate_limiter.limit))
+        self.set_header("x-ratelimit-remaining", str(remaining["remaining"]))
+        self.set_header("x-ratelimit-reset", str(remaining["reset"]))
+        self.set_header("x-ratelimit-limit", str(limit))
 
     def get_current_user(self):
         if not self.settings["auth_enabled"]:
@@ -173,7 +178,11 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
             raise web.HTTPError(404, f"No provider found for prefix {provider_prefix}")
 
         return providers[provider_prefix](
-            config=self.settings["traitlets_config"], spec=spec
+            config=self.settings["traitlets_config"],
+            spec_matchers=self.settings["spec_matchers"][provider_prefix],
+            spec=spec,
+            ref_cache=self.settings.get("ref_cache"),
+            http_client=self.settings["http_clients"].get("repo_providers"),
         )
 
     def get_badge_base_url(self):
@@ -2,6 +2,7 @@
 Contains build of a docker image from a git repository.
 """
 
+import asyncio
 import datetime
 import json
 import os
@@ -10,16 +11,18 @@ import warnings
 from collections import defaultdict
 from enum import Enum
 from typing import Union
-from urllib.parse import urlparse
+from urllib.parse import urlencode, urlparse
 
 import kubernetes.config
 from kubernetes import client, watch
+from tornado.httpclient import HTTPClientError, HTTPRequest
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
 from traitlets import Any, Bool, Dict, Integer, List, Unicode, default
 from traitlets.config import LoggingConfigurable
 from urllib3.exceptions import ReadTimeoutError
 
+from .http_client import PooledHTTPClient, is_timeout
 from .utils import KUBE_REQUEST_TIMEOUT, ByteSpecification, rendezvous_rank
 
 
@@ -197,6 +200,9 @@ class BuildExecutor(LoggingConfigurable):
 
         Progress of the build can be monitored by listening for items in
         the Queue passed to the constructor as `q`.
+
+        `submit`, `stream_logs` and `cleanup` are run in a thread,
+        unless they are coroutines.
         """
         raise NotImplementedError()
 
@@ -386,6 +392,18 @@ class KubernetesBuildExecutor(BuildExecutor):
         config=True,
     )
 
+    pod_informer = Any(
+        None,
+        allow_none=True,
+        help=(
+            "Shared binderhub.informer.PodInformer watching build pods. "
+            "If set, changes of the build pod are received from the informer "
+            "instead of opening a watch for every build."
+        ),
+    )
+
+    _cleanup_started = False
+
     _component_label = Unicode("binderhub-build")
 
     def get_affinity(self):
@@ -408,7 +426,13 @@ class KubernetesBuildExecutor(BuildExecutor):
             _preload_content=False,
         )
         image_builder_pods = json.loads(resp.read())
+        return self._get_affinity(image_builder_pods)
 
+    def _get_affinity(self, image_builder_pods):
+        """Determine the affinity term for the build pod
+
+        given the JSON list of image-builder pods.
+        """
         if self.sticky_builds and image_builder_pods:
             node_names = [
                 pod["spec"]["nodeName"] for pod in image_builder_pods["items"]
@@ -506,12 +530,9 @@ class KubernetesBuildExecutor(BuildExecutor):
 
         return image_pull_secrets
 
-    def submit(self):
+    def get_pod(self, affinity):
         """
-        Submit a build pod to create the image for the repository.
-
-        Progress of the build can be monitored by listening for items in
-        the Queue passed to the constructor as `q`.
+        Get the build pod to create, with the given affinity
         """
         volumes, volume_mounts = self.get_builder_volumes()
 
@@ -532,7 +553,7 @@ class KubernetesBuildExecutor(BuildExecutor):
                 )
             )
 
-        self.pod = client.V1Pod(
+        return client.V1Pod(
             metadata=client.V1ObjectMeta(
                 name=self.name,
                 labels={
@@ -573,11 +594,20 @@ class KubernetesBuildExecutor(BuildExecutor):
                 node_selector=self.node_selector,
                 volumes=volumes,
                 restart_policy="Never",
-                affinity=self.get_affinity(),
+                affinity=affinity,
                 image_pull_secrets=self.get_image_pull_secrets(),
             ),
         )
 
+    def submit(self):
+        """
+        Submit a build pod to create the image for the repository.
+
+        Progress of the build can be monitored by listening for items in
+        the Queue passed to the constructor as `q`.
+        """
+        self.pod = self.get_pod(self.get_affinity())
+
         try:
             _ = self.api.create_namespaced_pod(
                 self.namespace,
@@ -594,6 +624,13 @@ class KubernetesBuildExecutor(BuildExecutor):
         else:
             app_log.info("Started build %s", self.name)
 
+        if self.pod_informer is not None:
+            # the shared informer sends us changes of the pod,
+            # no need to hold on to a thread while the build is running
+            app_log.info("Subscribing to build pod %s", self.name)
+            self.pod_informer.subscribe(self.name, self._on_pod_event)
+            return
+
         app_log.info("Watching build pod %s", self.name)
         while not self.stop_event.is_set():
             w = watch.Watch()
@@ -605,59 +642,8 @@ class KubernetesBuildExecutor(BuildExecutor):
                     timeout_seconds=30,
                     _request_timeout=KUBE_REQUEST_TIMEOUT,
                 ):
-                    if f["type"] == "DELETED":
-                        phase = f["object"].status.phase
-                        app_log.debug(
-                            "Pod %s was deleted with phase %s",
-                            f["object"].metadata.name,
-                            phase,
-                        )
-                        if phase == "Succeeded":
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.BUILT,
-                            )
-                        else:
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.FAILED,
-                            )
+                    if self._handle_pod_event(f["type"], f["object"]):
                         return
-                    self.pod = f["object"]
-                    if not self.stop_event.is_set():
-                        # Account for all the phases kubernetes pods can be in
-                        # Pending, Running, Succeeded, Failed, Unknown
-                        # https://kubernetes.io/docs/concepts/workloads/pods/pod-lifecycle/#pod-phase
-                        phase = self.pod.status.phase
-                        if phase == "Pending":
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.PENDING,
-                            )
-                        elif phase == "Running":
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.RUNNING,
-                            )
-                        elif phase == "Succeeded":
-                            # Do nothing! We will clean this up, and send a 'Completed' progress event
-                            # when the pod has been deleted
-                            pass
-                        elif phase == "Failed":
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.FAILED,
-                            )
-                        elif phase == "Unknown":
-                            self.progress(
-                                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
-                                ProgressEvent.BuildStatus.UNKNOWN,
-                            )
-                        else:
-                            # This shouldn't happen, unless k8s introduces new Phase types
-                            warnings.warn(
-                                f"Found unknown phase {phase} when building {self.name}"
-                            )
 
                     if self.pod.status.phase == "Succeeded":
                         self.cleanup()
@@ -676,6 +662,99 @@ class KubernetesBuildExecutor(BuildExecutor):
                 app_log.info("Stopping watch of %s", self.name)
                 return
 
+    def _handle_pod_event(self, event_type, pod):
+        """Send progress events for a change of the build pod
+
+        Returns True if the pod was deleted, i.e. there is nothing left to watch.
+        """
+        if event_type == "DELETED":
+            phase = pod.status.phase
+            app_log.debug(
+                "Pod %s was deleted with phase %s",
+                pod.metadata.name,
+                phase,
+            )
+            if phase == "Succeeded":
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.BUILT,
+                )
+            else:
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.FAILED,
+                )
+            return True
+        self.pod = pod
+        if not self.stop_event.is_set():
+            # Account for all the phases kubernetes pods can be in
+            # Pending, Running, Succeeded, Failed, Unknown
+            # https://kubernetes.io/docs/concepts/workloads/pods/pod-lifecycle/#pod-phase
+            phase = self.pod.status.phase
+            if phase == "Pending":
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.PENDING,
+                )
+            elif phase == "Running":
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.RUNNING,
+                )
+            elif phase == "Succeeded":
+                # Do nothing! We will clean this up, and send a 'Completed' progress event
+                # when the pod has been deleted
+                pass
+            elif phase == "Failed":
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.FAILED,
+                )
+            elif phase == "Unknown":
+                self.progress(
+                    ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                    ProgressEvent.BuildStatus.UNKNOWN,
+                )
+            else:
+                # This shouldn't happen, unless k8s introduces new Phase types
+                warnings.warn(f"Found unknown phase {phase} when building {self.name}")
+        return False
+
+    def _on_pod_event(self, event_type, pod):
+        """Handle a change of the build pod sent by the pod informer
+
+        Called on the main loop.
+        """
+        if self.stop_event.is_set():
+            self.pod_informer.unsubscribe(self.name, self._on_pod_event)
+            return
+        if self._handle_pod_event(event_type, pod):
+            self.pod_informer.unsubscribe(self.name, self._on_pod_event)
+        elif pod.status.phase in {"Succeeded", "Failed"}:
+            self._start_cleanup()
+
+    def _start_cleanup(self):
+        """Delete the build pod in the background, once"""
+        if self._cleanup_started:
+            return
+        self._cleanup_started = True
+        # deleting the pod is a blocking call, don't make it on the main loop
+        cleanup_future = self.main_loop.run_in_executor(None, self.cleanup)
+        cleanup_future.add_done_callback(self._log_cleanup_error)
+
+    def _log_cleanup_error(self, future):
+        if future.exception():
+            app_log.error(
+                "Failed to delete build pod %s",
+                self.name,
+                exc_info=future.exception(),
+            )
+
+    def stop(self):
+        super().stop()
+        if self.pod_informer is not None:
+            self.pod_informer.unsubscribe(self.name, self._on_pod_event)
+
     def stream_logs(self):
         """
         Stream build logs to the queue in self.q
@@ -733,6 +812,306 @@ class KubernetesBuildExecutor(BuildExecutor):
                 raise
 
 
+class AsyncKubernetesBuildExecutor(KubernetesBuildExecutor):
+    """KubernetesBuildExecutor talking to the Kubernetes API from the event loop
+
+    `submit`, `stream_logs` and `cleanup` are coroutines making non-blocking
+    HTTP requests to the API server, instead of blocking calls
+    of the kubernetes client in threads of the build pool,
+    so a running build costs a coroutine rather than an OS thread.
+
+    The address and credentials of the API server are taken from
+    the configuration of the client in `api`.
+    """
+
+    http_client = Any(help="""
+        Client used to make requests to Kubernetes.
+
+        Defaults to a client shared by all builds, with `max_clients` connections,
+        separate from the clients used for other requests
+        since builds hold connections for as long as they run.
+        """)
+
+    max_clients = Integer(
+        256,
+        config=True,
+        help="""
+        Maximum number of concurrent requests to Kubernetes, over all builds.
+
+        Each running build holds one connection to follow its logs,
+        and another to watch its pod if the pod informer isn't used.
+        Further requests wait for a free connection.
+        """,
+    )
+
+    watch_max_retries = Integer(
+        5,
+        config=True,
+        help="""
+        Number of consecutive failed requests to watch the build pod
+        (e.g. while the API server is unreachable) before failing the build.
+
+        Requests timing out are always retried.
+        """,
+    )
+
+    watch_max_retry_delay = Integer(
+        30,
+        config=True,
+        help="""
+        Maximum time (seconds) to wait before retrying a failed request
+        to watch the build pod. The delay doubles after each failure.
+        """,
+    )
+
+    # the default http_client, shared by all builds
+    _shared_http_client = None
+
+    @default("http_client")
+    def _default_http_client(self):
+        cls = AsyncKubernetesBuildExecutor
+        shared = cls._shared_http_client
+        if shared is None or shared.max_clients != self.max_clients:
+            shared = cls._shared_http_client = PooledHTTPClient(
+                "kubernetes",
+                max_clients=self.max_clients,
+                log=self.log,
+                connect_timeout=KUBE_REQUEST_TIMEOUT[0],
+                request_timeout=KUBE_REQUEST_TIMEOUT[1],
+                tcp_keepalive=True,
+                http2=False,
+            )
+        return shared
+
+    def _kube_request(self, path, method="GET", params=None, body=None, **kwargs):
+        """Make an HTTPRequest for `path` on the Kubernetes API server"""
+        config = self.api.api_client.configuration
+        url = config.host.rstrip("/") + path
+        if params:
+            url += "?" + urlencode(params)
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(body)
+        # also refreshes expiring in-cluster service account tokens
+        authorization = config.get_api_key_with_prefix("authorization")
+        if authorization:
+            headers["Authorization"] = authorization
+        kwargs.setdefault("connect_timeout", KUBE_REQUEST_TIMEOUT[0])
+        kwargs.setdefault("request_timeout", KUBE_REQUEST_TIMEOUT[1])
+        return HTTPRequest(
+            url,
+            method=method,
+            headers=headers,
+            body=body,
+            ca_certs=config.ssl_ca_cert,
+            client_cert=config.cert_file,
+            client_key=config.key_file,
+            validate_cert=config.verify_ssl,
+            **kwargs,
+        )
+
+    @property
+    def _pods_path(self):
+        return f"/api/v1/namespaces/{self.namespace}/pods"
+
+    async def get_affinity(self):
+        resp = await self.http_client.fetch(
+            self._kube_request(
+                self._pods_path,
+                params={"labelSelector": "component=image-builder,app=binder"},
+            )
+        )
+        return self._get_affinity(json.loads(resp.body))
+
+    async def submit(self):
+        """
+        Submit a build pod to create the image for the repository.
+
+        Progress of the build can be monitored by listening for items in
+        the Queue passed to the constructor as `q`.
+        """
+        self.pod = self.get_pod(await self.get_affinity())
+
+        try:
+            await self.http_client.fetch(
+                self._kube_request(
+                    self._pods_path,
+                    method="POST",
+                    body=self.api.api_client.sanitize_for_serialization(self.pod),
+                )
+            )
+        except HTTPClientError as e:
+            if e.code == 409:
+                # Someone else created it!
+                app_log.info("Build %s already running", self.name)
+            else:
+                raise
+        else:
+            app_log.info("Started build %s", self.name)
+
+        if self.pod_informer is not None:
+            app_log.info("Subscribing to build pod %s", self.name)
+            self.pod_informer.subscribe(self.name, self._on_pod_event)
+            return
+
+        app_log.info("Watching build pod %s", self.name)
+        deleted = False
+        pod_watch = watch.Watch()
+
+        def handle_event(line):
+            nonlocal deleted
+            if deleted or self.stop_event.is_set():
+                return
+            # turns the object of the event into a V1Pod
+            event = pod_watch.unmarshal_event(line.decode("utf-8"), "V1Pod")
+            if event["type"] == "ERROR":
+                app_log.warning(
+                    "Error in watch stream for %s: %s", self.name, event["raw_object"]
+                )
+                return
+            pod = event["object"]
+            if self._handle_pod_event(event["type"], pod):
+                deleted = True
+            elif pod.status.phase in {"Succeeded", "Failed"}:
+                self._start_cleanup()
+
+        failures = 0
+        while not deleted and not self.stop_event.is_set():
+            try:
+                await self.http_client.fetch(
+                    self._kube_request(
+                        self._pods_path,
+                        params={
+                            "labelSelector": f"name={self.name}",
+                            "watch": "true",
+                            "timeoutSeconds": "30",
+                        },
+                        request_timeout=30 + KUBE_REQUEST_TIMEOUT[1],
+                        streaming_callback=_LineBuffer(handle_event),
+                    )
+                )
+            except (HTTPClientError, OSError) as e:
+                if is_timeout(e):
+                    # just retry after timeout, don't fail
+                    app_log.warning("Timeout in watch stream for %s", self.name)
+                    failures = 0
+                    continue
+                failures += 1
+                if getattr(e, "code", 599) != 599 or failures > self.watch_max_retries:
+                    app_log.exception("Error in watch stream for %s", self.name)
+                    raise
+                # e.g. the API server is unreachable, retry after a delay
+                delay = min(2 ** (failures - 1), self.watch_max_retry_delay)
+                app_log.warning(
+                    "Error in watch stream for %s, retrying in %is: %s",
+                    self.name,
+                    delay,
+                    e,
+                )
+                await asyncio.sleep(delay)
+            else:
+                failures = 0
+        if self.stop_event.is_set():
+            app_log.info("Stopping watch of %s", self.name)
+
+    def _start_cleanup(self):
+        if self._cleanup_started:
+            return
+        self._cleanup_started = True
+        cleanup_future = asyncio.ensure_future(self.cleanup())
+        cleanup_future.add_done_callback(self._log_cleanup_error)
+
+    async def stream_logs(self):
+        """
+        Stream build logs to the queue in self.q
+        """
+        app_log.info("Watching logs of %s", self.name)
+
+        def handle_line(line):
+            if self.stop_event.is_set():
+                # the request can't be interrupted, drop the rest of the log
+                return
+            line = line.decode("utf-8")
+            try:
+                json.loads(line)
+            except ValueError:
+                # log event wasn't JSON.
+                # use the line itself as the message with unknown phase.
+                app_log.error("log event not json: %r", line)
+                line = json.dumps(
+                    {
+                        "phase": "unknown",
+                        "message": line,
+                    }
+                )
+            self.progress(ProgressEvent.Kind.LOG_MESSAGE, line)
+
+        lines = _LineBuffer(handle_line)
+        await self.http_client.fetch(
+            self._kube_request(
+                f"{self._pods_path}/{self.name}/log",
+                params={"follow": "true", "tailLines": str(self.log_tail_lines)},
+                # logs are followed for as long as the build runs
+                request_timeout=0,
+                streaming_callback=lines,
+            )
+        )
+        lines.flush()
+        if self.stop_event.is_set():
+            app_log.info("Stopping logs of %s", self.name)
+        else:
+            app_log.info("Finished streaming logs of %s", self.name)
+
+    async def cleanup(self):
+        """
+        Delete the kubernetes build pod
+        """
+        try:
+            await self.http_client.fetch(
+                self._kube_request(
+                    f"{self._pods_path}/{self.name}",
+                    method="DELETE",
+                    params={"gracePeriodSeconds": "0"},
+                )
+            )
+        except HTTPClientError as e:
+            if e.code == 404:
+                # Is ok, someone else has already deleted it
+                pass
+            else:
+                raise
+
+
+class _LineBuffer:
+    """streaming_callback calling `handle_line` for each complete line of a response"""
+
+    def __init__(self, handle_line):
+        self.handle_line = handle_line
+        # chunks of the incomplete line, joined once the line is complete
+        self.pending = []
+
+    def __call__(self, chunk):
+        lines = chunk.split(b"\n")
+        if len(lines) == 1:
+            self.pending.append(chunk)
+            return
+        if self.pending:
+            self.pending.append(lines[0])
+            lines[0] = b"".join(self.pending)
+        self.pending = [lines.pop()]
+        for line in lines:
+            if line.strip():
+                self.handle_line(line)
+
+    def flush(self):
+        """Handle the last line, if the response didn't end with a newline"""
+        line = b"".join(self.pending)
+        self.pending = []
+        if line.strip():
+            self.handle_line(line)
+
+
 class KubernetesCleaner(LoggingConfigurable):
     """Regular cleanup utility for kubernetes builds
 
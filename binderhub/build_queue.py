@@ -0,0 +1,144 @@
+"""
+Admission queue limiting the number of builds running at the same time
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from prometheus_client import Gauge, Histogram
+from tornado.ioloop import IOLoop
+from traitlets import Integer
+from traitlets.config import LoggingConfigurable
+
+BUILD_QUEUE_LENGTH = Gauge(
+    "binderhub_build_queue_length", "Builds waiting for a free build slot"
+)
+BUILD_QUEUE_WAIT_TIME = Histogram(
+    "binderhub_build_queue_wait_seconds",
+    "Histogram of the time builds waited for a free build slot",
+    ["status"],
+    buckets=[1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float("inf")],
+)
+
+
+class _Waiter:
+    """A build waiting in the queue"""
+
+    def __init__(self, priority, seq, on_position):
+        # highest priority first, then first come first served
+        self.key = (-priority, seq)
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = None
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class BuildQueue(LoggingConfigurable):
+    """Limit the number of builds running at the same time
+
+    Builds over the limit wait in a priority queue,
+    and are started in order of priority, then arrival, as running builds finish.
+    Waiting builds are told their position in the queue.
+    """
+
+    limit = Integer(
+        0,
+        config=True,
+        help="""
+        The maximum number of builds to run at the same time.
+
+        0 means no limit.
+        Set from BinderHub.concurrent_build_limit by default.
+        """,
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.running = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._notify_scheduled = False
+
+    @property
+    def queued(self):
+        """The number of builds waiting in the queue"""
+        return sum(1 for waiter in self._heap if not waiter.cancelled)
+
+    def _has_room(self):
+        return not self.limit or self.running < self.limit
+
+    async def acquire(self, priority=0, on_position=None):
+        """Wait for a free build slot
+
+        Must be balanced with a call to `release()` once the build is done.
+
+        `on_position(n)` is called with the 1-based position of the build
+        in the queue, each time it changes while waiting.
+        """
+        if self._has_room() and not self._heap:
+            self.running += 1
+            BUILD_QUEUE_WAIT_TIME.labels(status="admitted").observe(0)
+            return
+
+        waiter = _Waiter(priority, next(self._counter), on_position)
+        heapq.heappush(self._heap, waiter)
+        BUILD_QUEUE_LENGTH.inc()
+        self._schedule_notify()
+        start = time.perf_counter()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just as we gave up, hand over the slot
+                self.release()
+            else:
+                waiter.cancelled = True
+                BUILD_QUEUE_LENGTH.dec()
+                self._schedule_notify()
+            BUILD_QUEUE_WAIT_TIME.labels(status="cancelled").observe(
+                time.perf_counter() - start
+            )
+            raise
+        BUILD_QUEUE_WAIT_TIME.labels(status="admitted").observe(
+            time.perf_counter() - start
+        )
+
+    def release(self):
+        """Free the build slot of a finished build, starting the next one"""
+        self.running -= 1
+        while self._heap and self._has_room():
+            waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            BUILD_QUEUE_LENGTH.dec()
+            self.running += 1
+            waiter.future.set_result(None)
+        self._schedule_notify()
+
+    def _schedule_notify(self):
+        """Send positions to waiting builds, at most once per loop iteration"""
+        if self._notify_scheduled:
+            return
+        self._notify_scheduled = True
+        IOLoop.current().add_callback(self._notify_positions)
+
+    def _notify_positions(self):
+        self._notify_scheduled = False
+        self._heap = [waiter for waiter in self._heap if not waiter.cancelled]
+        # a sorted list is a valid heap
+        self._heap.sort()
+        for position, waiter in enumerate(self._heap, 1):
+            if waiter.position == position:
+                continue
+            waiter.position = position
+            if waiter.on_position is None:
+                continue
+            try:
+                waiter.on_position(position)
+            except Exception:
+                self.log.exception("Error sending queue position")
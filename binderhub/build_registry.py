@@ -0,0 +1,311 @@
+"""
+Share a single build between all the requests for the same image
+"""
+
+import asyncio
+import inspect
+import json
+from collections import deque
+
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+from traitlets import Any, Integer
+from traitlets.config import LoggingConfigurable
+
+from .build import ProgressEvent
+
+# put on the build queue when a build thread (submit or stream_logs) has returned
+_TASK_DONE = object()
+
+
+def _is_terminal(progress):
+    """Whether `progress` marks the end of a build"""
+    if progress.kind == ProgressEvent.Kind.BUILD_STATUS_CHANGE:
+        return progress.payload in (
+            ProgressEvent.BuildStatus.BUILT,
+            ProgressEvent.BuildStatus.FAILED,
+        )
+    if progress.kind == ProgressEvent.Kind.LOG_MESSAGE:
+        try:
+            phase = json.loads(progress.payload).get("phase")
+        except (TypeError, ValueError, AttributeError):
+            return False
+        return phase in ("failure", "failed")
+    return False
+
+
+class SharedBuild:
+    """A single running build, with its progress sent to any number of subscribers
+
+    Runs `submit()` and `stream_logs()` of the build once,
+    and copies every ProgressEvent to the queue of each subscriber.
+    The most recent events are kept in a replay buffer,
+    so that subscribers joining a running build see its log from the start.
+
+    Once the build has finished, each subscriber receives `None`.
+    """
+
+    def __init__(self, registry, name, build, q, pool, replay_buffer_size, priority=0):
+        self.registry = registry
+        self.name = name
+        self.build = build
+        self.q = q
+        self.pool = pool
+        self.priority = priority
+        self.subscribers = []
+        self.replay = deque(maxlen=replay_buffer_size)
+        self.finished = False
+        self.closed = False
+        self._running = 0
+        self._log_started = False
+        self._admission = None
+        self._queue_position = None
+
+    def subscribe(self):
+        """Return a new queue receiving the progress of the build"""
+        q = Queue()
+        for progress in self.replay:
+            q.put_nowait(progress)
+        if self._queue_position is not None:
+            q.put_nowait(self._queue_position)
+        if self.closed:
+            q.put_nowait(None)
+        else:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        """Stop sending progress to `q`
+
+        When the last subscriber is gone, stop watching the build.
+        This doesn't stop the build itself,
+        a new request for the same build will pick it up again.
+
+        Builds admitted by the build queue are watched until they are done,
+        so that they keep their build slot for as long as they run.
+        New requests for the same build attach to them again.
+        """
+        if q in self.subscribers:
+            self.subscribers.remove(q)
+        if self.subscribers or self.closed:
+            return
+        if self._admitted:
+            # the build pod keeps running, and counts in the build queue's limit
+            self.registry.log.info(
+                "No more clients watching build %s, watching it until it is done",
+                self.name,
+            )
+            return
+        self.registry.log.info(
+            "No more clients watching build %s, stop watching", self.name
+        )
+        self.registry._forget(self)
+        self.build.stop()
+        if self._admission is not None and not self._admission.done():
+            # still waiting in the build queue
+            self._admission.cancel()
+        self.q.put_nowait(None)
+
+    @property
+    def _admitted(self):
+        """Whether the build holds a slot of the build queue"""
+        return (
+            self._admission is not None
+            and self._admission.done()
+            and not self._admission.cancelled()
+        )
+
+    def _start_task(self, f):
+        """Run `f` in the build pool, or on the event loop if it is a coroutine function
+
+        Unhandled errors fail the build.
+        Puts _TASK_DONE on the build queue when `f` has returned.
+        """
+        loop = IOLoop.current()
+
+        def _check_result(future):
+            try:
+                r = future.result()
+                self.registry.log.debug("Build task completed: %s", r)
+            except Exception:
+                self.registry.log.error("Build task failed", exc_info=True)
+                self.build.progress(
+                    ProgressEvent.Kind.LOG_MESSAGE,
+                    json.dumps(
+                        {
+                            "phase": ProgressEvent.BuildStatus.FAILED.value,
+                            "message": "Unhandled error watching for build events. Please try again.\n",
+                        }
+                    ),
+                )
+            # the done marker is queued after any progress the task has emitted
+            loop.add_callback(self.q.put, _TASK_DONE)
+
+        self._running += 1
+        if inspect.iscoroutinefunction(f):
+            # async build executors don't need a thread
+            future = asyncio.ensure_future(f())
+        else:
+            future = self.pool.submit(f)
+        future.add_done_callback(_check_result)
+
+    def _publish(self, progress):
+        self.replay.append(progress)
+        for q in self.subscribers:
+            q.put_nowait(progress)
+
+    def _on_queue_position(self, position):
+        """Tell subscribers the position of the build in the build queue"""
+        # not kept in the replay buffer, only the latest position matters
+        self._queue_position = ProgressEvent(
+            ProgressEvent.Kind.LOG_MESSAGE,
+            json.dumps(
+                {
+                    "phase": "waiting",
+                    "message": f"Waiting for a free build slot, position {position} in the queue...\n",
+                    "position": position,
+                }
+            ),
+        )
+        for q in self.subscribers:
+            q.put_nowait(self._queue_position)
+
+    async def run(self):
+        """Run the build, until it is finished or nobody is watching anymore"""
+        build_queue = self.registry.build_queue
+        admitted = False
+        try:
+            if build_queue is not None:
+                self._admission = asyncio.ensure_future(
+                    build_queue.acquire(self.priority, self._on_queue_position)
+                )
+                try:
+                    await self._admission
+                except asyncio.CancelledError:
+                    self.registry.log.info(
+                        "Build %s left the build queue, nobody is watching", self.name
+                    )
+                    return
+                admitted = True
+                self._queue_position = None
+            self._start_task(self.build.submit)
+            while True:
+                progress = await self.q.get()
+                if progress is None:
+                    # stopped
+                    break
+                if progress is _TASK_DONE:
+                    self._running -= 1
+                    if self.finished and not self._running:
+                        break
+                    continue
+
+                if (
+                    progress.kind == ProgressEvent.Kind.BUILD_STATUS_CHANGE
+                    and progress.payload == ProgressEvent.BuildStatus.RUNNING
+                    and not self._log_started
+                ):
+                    # start capturing build logs once the pod is running
+                    self._log_started = True
+                    self._start_task(self.build.stream_logs)
+
+                self._publish(progress)
+
+                if _is_terminal(progress) and not self.finished:
+                    self.finished = True
+                    # new requests for this build start from scratch
+                    self.registry._forget(self)
+                    if not self._running:
+                        break
+                    # keep forwarding logs until the build threads are done
+        finally:
+            if admitted:
+                build_queue.release()
+            self.closed = True
+            self.registry._forget(self)
+            for q in self.subscribers:
+                q.put_nowait(None)
+            self.subscribers = []
+
+
+class BuildRegistry(LoggingConfigurable):
+    """Registry of the builds running in this process, by build name
+
+    Concurrent requests for the same build share a single BuildExecutor,
+    instead of each running their own submit and log stream against the same pod.
+    """
+
+    replay_buffer_size = Integer(
+        10000,
+        config=True,
+        help="""
+        Number of progress events (mostly build log lines) of each build to keep
+        for clients joining a build that is already running.
+
+        Clients joining a build receive the full log
+        if it doesn't have more than this many lines.
+        """,
+    )
+
+    build_queue = Any(
+        None,
+        allow_none=True,
+        help="binderhub.build_queue.BuildQueue limiting the number of running builds",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # build name: SharedBuild or Future of a SharedBuild being created
+        self.builds = {}
+
+    def _forget(self, shared_build):
+        if self.builds.get(shared_build.name) is shared_build:
+            del self.builds[shared_build.name]
+
+    async def attach(self, name, create_build, pool, priority=0):
+        """Subscribe to the progress of the build `name`
+
+        If the build isn't running in this process yet, a BuildExecutor is created
+        by `await create_build(q)` and run in `pool`,
+        once admitted by the build queue with the given `priority`.
+
+        Returns `(shared_build, q, created)`, where `q` is the queue receiving
+        the progress of the build and `created` is True if the build was started
+        by this call.
+        """
+        existing = self.builds.get(name)
+        if isinstance(existing, asyncio.Future):
+            # another request is creating the build
+            existing = await asyncio.shield(existing)
+        if existing is not None and not existing.closed:
+            self.log.info(
+                "Attaching to running build %s (%i clients)",
+                name,
+                len(existing.subscribers) + 1,
+            )
+            return existing, existing.subscribe(), False
+
+        creating = asyncio.get_running_loop().create_future()
+        self.builds[name] = creating
+        try:
+            q = Queue()
+            build = await create_build(q)
+            shared_build = SharedBuild(
+                self, name, build, q, pool, self.replay_buffer_size, priority
+            )
+        except BaseException as e:
+            if self.builds.get(name) is creating:
+                del self.builds[name]
+            if isinstance(e, Exception):
+                creating.set_exception(e)
+                # avoid 'exception never retrieved' warnings when nobody else is waiting
+                creating.exception()
+            else:
+                creating.cancel()
+            raise
+
+        self.builds[name] = shared_build
+        creating.set_result(shared_build)
+        subscriber_q = shared_build.subscribe()
+        IOLoop.current().add_callback(shared_build.run)
+        return shared_build, subscriber_q, True
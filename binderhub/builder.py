@@ -8,20 +8,20 @@ import json
 import re
 import string
 import time
+from contextlib import nullcontext
 from http.client import responses
 
 import docker
 import escapism
 from prometheus_client import Counter, Gauge, Histogram
 from tornado.httpclient import HTTPClientError
-from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 from tornado.log import app_log
-from tornado.queues import Queue
 from tornado.web import Finish, HTTPError, authenticated
 
 from .base import BaseHandler
 from .build import ProgressEvent
+from .launcher import HubUnavailable, timed_launch_step
 from .quota import LaunchQuotaExceeded
 
 # Separate buckets for builds and launches.
@@ -145,7 +145,8 @@ class BuildHandler(BaseHandler):
 
     # emit keepalives every 25 seconds to avoid idle connections being closed
     KEEPALIVE_INTERVAL = 25
-    build = None
+    shared_build = None
+    progress_queue = None
 
     async def emit(self, data):
         """Emit an eventstream event"""
@@ -171,9 +172,9 @@ class BuildHandler(BaseHandler):
     def on_finish(self):
         """Stop keepalive when finish has been called"""
         self._keepalive = False
-        if self.build:
-            # if we have a build, tell it to stop watching
-            self.build.stop()
+        if self.shared_build:
+            # if we are watching a build, stop receiving its progress
+            self.shared_build.unsubscribe(self.progress_queue)
 
     async def keep_alive(self):
         """Constantly emit keepalive events
@@ -292,7 +293,7 @@ class BuildHandler(BaseHandler):
         # verify the build token and rate limit
         build_token = self.get_argument("build_token", None)
         self.check_build_token(build_token, f"{provider_prefix}/{spec}")
-        self.check_rate_limit()
+        await self.check_rate_limit()
 
         # Verify if the provider is valid for EventSource.
         # EventSource cannot handle HTTP errors, so we must validate and send
@@ -426,10 +427,9 @@ class BuildHandler(BaseHandler):
         if self.settings["use_registry"]:
             for _ in range(3):
                 try:
-                    image_manifest = await self.registry.get_image_manifest(
+                    image_found = await self.registry.image_exists(
                         image_without_tag, image_tag
                     )
-                    image_found = bool(image_manifest)
                     break
                 except HTTPClientError:
                     app_log.exception(
@@ -481,65 +481,54 @@ class BuildHandler(BaseHandler):
         except LaunchQuotaExceeded:
             return
 
-        # Prepare to build
-        q = Queue()
+        build_registry = self.settings["build_registry"]
+
+        async def create_build(q):
+            BuildClass = self.settings.get("build_class")
+
+            build_kwargs = {}
+            if self.settings.get("build_pod_informer") is not None:
+                # share a single watch of build pods
+                build_kwargs["pod_informer"] = self.settings["build_pod_informer"]
+
+            build = BuildClass(
+                # All other properties should be set in traitlets config
+                parent=self.settings["traitlets_parent"],
+                q=q,
+                name=build_name,
+                repo_url=repo_url,
+                ref=ref,
+                image_name=image_name,
+                git_credentials=provider.git_credentials,
+                **build_kwargs,
+            )
+            if self.settings["use_registry"]:
+                push_token = await self.registry.get_credentials(
+                    image_without_tag, image_tag
+                )
+                if push_token:
+                    build.registry_credentials = push_token
+            else:
+                build.push_secret = ""
+            return build
 
-        BuildClass = self.settings.get("build_class")
+        # builds over BinderHub.concurrent_build_limit wait in a queue,
+        # ordered by the build_priority set in spec_config
+        build_priority = provider.repo_config(self.settings).get("build_priority", 0)
 
-        build = BuildClass(
-            # All other properties should be set in traitlets config
-            parent=self.settings["traitlets_parent"],
-            q=q,
-            name=build_name,
-            repo_url=repo_url,
-            ref=ref,
-            image_name=image_name,
-            git_credentials=provider.git_credentials,
+        # concurrent requests for the same image share a single build
+        self.shared_build, q, created = await build_registry.attach(
+            build_name, create_build, self.settings["build_pool"], build_priority
         )
-        if self.settings["use_registry"]:
-            push_token = await self.registry.get_credentials(
-                image_without_tag, image_tag
-            )
-            if push_token:
-                build.registry_credentials = push_token
-        else:
-            build.push_secret = ""
+        self.progress_queue = q
 
-        self.build = build
-
-        with BUILDS_INPROGRESS.track_inprogress():
+        # only the request that started the build records its metrics
+        inprogress = BUILDS_INPROGRESS.track_inprogress() if created else nullcontext()
+        with inprogress:
             done = False
             failed = False
 
-            def _check_result(future):
-                nonlocal done
-                nonlocal failed
-                try:
-                    r = future.result()
-                    app_log.debug("Build task completed: %s", r)
-                except Exception:
-                    app_log.error("Build task failed", exc_info=True)
-                    done = True
-                    failed = True
-                    # make sure to wake the `await q.get()` below with a message
-                    build.progress(
-                        ProgressEvent.Kind.LOG_MESSAGE,
-                        json.dumps(
-                            {
-                                "phase": ProgressEvent.BuildStatus.FAILED.value,
-                                "message": "Unhandled error watching for build events. Please try again.\n",
-                            }
-                        ),
-                    )
-
             build_starttime = time.perf_counter()
-            pool = self.settings["build_pool"]
-            # Start building
-            submit_future = pool.submit(build.submit)
-            submit_future.add_done_callback(_check_result)
-            IOLoop.current().add_callback(lambda: submit_future)
-
-            log_future = None
 
             # initial waiting event
             await self.emit(
@@ -551,6 +540,10 @@ class BuildHandler(BaseHandler):
 
             while not done:
                 progress = await q.get()
+                if progress is None:
+                    # the build has finished without being built
+                    failed = True
+                    break
                 # FIXME: If pod goes into an unrecoverable stage, such as ImagePullBackoff or
                 # whatever, we should fail properly.
                 if progress.kind == ProgressEvent.Kind.BUILD_STATUS_CHANGE:
@@ -559,6 +552,9 @@ class BuildHandler(BaseHandler):
                         # nothing to do, just waiting
                         continue
                     elif progress.payload == ProgressEvent.BuildStatus.BUILT:
+                        if self.settings["use_registry"]:
+                            # it exists now
+                            self.registry.invalidate_image(image_without_tag, image_tag)
                         if build_only:
                             message = "Done! Image built\n"
                             phase = "ready"
@@ -569,23 +565,19 @@ class BuildHandler(BaseHandler):
                             "message": message,
                             "imageName": image_name,
                         }
-                        BUILD_TIME.labels(status="success").observe(
-                            time.perf_counter() - build_starttime
-                        )
-                        BUILD_COUNT.labels(
-                            status="success", **self.repo_metric_labels
-                        ).inc()
+                        if created:
+                            BUILD_TIME.labels(status="success").observe(
+                                time.perf_counter() - build_starttime
+                            )
+                            BUILD_COUNT.labels(
+                                status="success", **self.repo_metric_labels
+                            ).inc()
                         done = True
                     elif progress.payload == ProgressEvent.BuildStatus.RUNNING:
-                        # start capturing build logs once the pod is running
-                        if log_future is None:
-                            log_future = pool.submit(build.stream_logs)
-                            log_future.add_done_callback(_check_result)
-                        continue
-                    elif progress.payload == ProgressEvent.BuildStatus.BUILT:
-                        # Do nothing, is ok!
+                        # build logs are captured by the shared build
                         continue
                     elif progress.payload == ProgressEvent.BuildStatus.FAILED:
+                        failed = True
                         event = {"phase": phase}
                     elif progress.payload == ProgressEvent.BuildStatus.UNKNOWN:
                         event = {"phase": phase}
@@ -600,12 +592,13 @@ class BuildHandler(BaseHandler):
                     payload = json.loads(event)
                     if payload.get("phase") in ("failure", "failed"):
                         failed = True
-                        BUILD_TIME.labels(status="failure").observe(
-                            time.perf_counter() - build_starttime
-                        )
-                        BUILD_COUNT.labels(
-                            status="failure", **self.repo_metric_labels
-                        ).inc()
+                        if created:
+                            BUILD_TIME.labels(status="failure").observe(
+                                time.perf_counter() - build_starttime
+                            )
+                            BUILD_COUNT.labels(
+                                status="failure", **self.repo_metric_labels
+                            ).inc()
                 await self.emit(event)
 
         if build_only:
@@ -656,9 +649,12 @@ class BuildHandler(BaseHandler):
             },
         )
 
-    async def check_quota(self, provider):
+    async def check_quota(self, provider, reserve=False):
         """Check quota before proceeding with build/launch
 
+        If `reserve` is True, a server is reserved in the quota,
+        to be released with `launch_quota.release(quota_check.reservation)`.
+
         Returns:
 
         - ServerQuotaCheck on success (None if no quota)
@@ -673,7 +669,7 @@ class BuildHandler(BaseHandler):
         launch_quota = self.settings["launch_quota"]
         try:
             return await launch_quota.check_repo_quota(
-                self.image_name, repo_config, self.repo_url
+                self.image_name, repo_config, self.repo_url, reserve=reserve
             )
         except LaunchQuotaExceeded as e:
             LAUNCH_COUNT.labels(
@@ -683,9 +679,13 @@ class BuildHandler(BaseHandler):
             await self.fail(e.message)
             raise
 
-    async def launch(self, provider):
-        """Ask JupyterHub to launch the image."""
-        quota_check = await self.check_quota(provider)
+    async def _check_launch_quota(self, provider):
+        """Check the quota before launching, reserving a server
+
+        The quota is always checked again, even right after building,
+        so that the launches admitted during a build see each other.
+        """
+        quota_check = await self.check_quota(provider, reserve=True)
 
         if quota_check:
             if quota_check.matching >= 0.5 * quota_check.quota:
@@ -698,7 +698,10 @@ class BuildHandler(BaseHandler):
                 quota_check.matching,
                 quota_check.total,
             )
+        return quota_check
 
+    async def launch(self, provider):
+        """Ask JupyterHub to launch the image."""
         await self.emit(
             {
                 "phase": "launching",
@@ -706,6 +709,62 @@ class BuildHandler(BaseHandler):
             }
         )
 
+        # count this launch in the quota until the server is running,
+        # the quota is checked while the Hub creates the user
+        quota_check = asyncio.ensure_future(
+            timed_launch_step("quota", self._check_launch_quota(provider))
+        )
+        try:
+            server_info = None
+            warm_pool = self.settings.get("warm_pool")
+            if warm_pool is not None and not self.settings["auth_enabled"]:
+                warm_pool.record_launch(
+                    self.image_name,
+                    self.repo_url,
+                    repo_config=provider.repo_config(self.settings),
+                    # the launch arguments that don't depend on the request
+                    extra_args={
+                        "binder_ref_url": self.ref_url,
+                        "binder_launch_host": self.binder_launch_host,
+                        "binder_persistent_request": self.binder_persistent_request,
+                    },
+                )
+                if warm_pool.available(self.image_name):
+                    # idle servers are already counted in the quota,
+                    # so this is conservative by one server
+                    await quota_check
+                    server_info = warm_pool.take(self.image_name)
+                if server_info is not None:
+                    LAUNCH_TIME.labels(status="success", retries=0).observe(0)
+                    LAUNCH_COUNT.labels(
+                        status="success",
+                        **self.repo_metric_labels,
+                    ).inc()
+                    app_log.info("Launched %s with an idle server", self.repo_url)
+
+            if server_info is None:
+                server_info = await self._launch(quota_check)
+        finally:
+            try:
+                quota_check = await quota_check
+            except Exception:
+                # the launch has failed with the error
+                quota_check = None
+            if quota_check and quota_check.reservation is not None:
+                await self.settings["launch_quota"].release(quota_check.reservation)
+
+        event = {
+            "phase": "ready",
+            "message": f"server running at {server_info['url']}\n",
+        }
+        event.update(server_info)
+        await self.emit(event)
+
+    async def _launch(self, quota_check):
+        """Launch a server, once `quota_check` has passed
+
+        Returns the server info of Launcher.launch
+        """
         client_ip = self.request.remote_ip
 
         launcher = self.settings["launcher"]
@@ -743,6 +802,15 @@ class BuildHandler(BaseHandler):
                     "binder_persistent_request": self.binder_persistent_request,
                     "binder_client_ip": client_ip,
                 }
+
+                def assign_reservation(username, server_name):
+                    # release the reservation once the server's pod is counted
+                    check = quota_check.result()
+                    if check is not None and check.reservation is not None:
+                        self.settings["launch_quota"].assign(
+                            check.reservation, username, server_name
+                        )
+
                 server_info = await launcher.launch(
                     image=self.image_name,
                     username=username,
@@ -750,7 +818,23 @@ class BuildHandler(BaseHandler):
                     repo_url=self.repo_url,
                     extra_args=extra_args,
                     event_callback=handle_progress_event,
+                    before_spawn=quota_check,
+                    spawn_callback=assign_reservation,
                 )
+            except LaunchQuotaExceeded:
+                # already reported by check_quota
+                raise
+            except HubUnavailable:
+                # don't add to the load of a struggling Hub with retries,
+                # the user is told when to try again
+                LAUNCH_TIME.labels(status="hub_unavailable", retries=-1).observe(
+                    time.perf_counter() - launch_starttime
+                )
+                LAUNCH_COUNT.labels(
+                    status="hub_unavailable",
+                    **self.repo_metric_labels,
+                ).inc()
+                raise
             except Exception as e:
                 duration = time.perf_counter() - launch_starttime
                 if i + 1 == launcher.retries:
@@ -801,10 +885,10 @@ class BuildHandler(BaseHandler):
                     **self.repo_metric_labels,
                 ).inc()
                 app_log.info("Launched %s in %.0fs", self.repo_url, duration)
+                image_prewarmer = self.settings.get("image_prewarmer")
+                if image_prewarmer is not None:
+                    image_prewarmer.record_launch(
+                        self.image_name, *_get_image_basename_and_tag(self.image_name)
+                    )
                 break
-        event = {
-            "phase": "ready",
-            "message": f"server running at {server_info['url']}\n",
-        }
-        event.update(server_info)
-        await self.emit(event)
+        return server_info
@@ -3,7 +3,6 @@ import json
 import time
 from functools import wraps
 
-from tornado.httpclient import AsyncHTTPClient
 from tornado.log import app_log
 
 from .base import BaseHandler
@@ -140,7 +139,8 @@ class HealthHandler(BaseHandler):
     @_log_duration
     async def check_jupyterhub_api(self, hub_url):
         """Check JupyterHub API health"""
-        await AsyncHTTPClient().fetch(hub_url + "hub/api/health", request_timeout=3)
+        client = self.settings["http_clients"].get("health")
+        await client.fetch(hub_url + "hub/api/health", request_timeout=3)
         return True
 
     @at_most_every(interval=15)
@@ -0,0 +1,222 @@
+"""
+Pools of clients for outbound HTTP requests, one for each destination
+"""
+
+from prometheus_client import Counter, Gauge
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import HTTPTimeoutError
+from traitlets import Bool, Dict, Float, Integer, TraitError, validate
+from traitlets.config import LoggingConfigurable
+
+HTTP_CLIENT_ACTIVE = Gauge(
+    "binderhub_http_client_active_requests",
+    "Outbound HTTP requests in progress, including queued requests",
+    ["pool"],
+)
+HTTP_CLIENT_QUEUED = Gauge(
+    "binderhub_http_client_queued_requests",
+    "Outbound HTTP requests waiting for a free connection",
+    ["pool"],
+)
+HTTP_CLIENT_SATURATED = Counter(
+    "binderhub_http_client_saturated_total",
+    "Outbound HTTP requests made while all connections of the pool were in use",
+    ["pool"],
+)
+
+
+def is_timeout(e):
+    """Whether a request failed because it timed out, not e.g. to connect
+
+    Both are HTTPClientErrors with code 599.
+    """
+    if isinstance(e, HTTPTimeoutError):
+        return True
+    # CurlError, errno of CURLE_OPERATION_TIMEDOUT
+    return isinstance(e, HTTPClientError) and getattr(e, "errno", None) == 28
+
+
+def _prepare_curl(curl, http2=False, tcp_keepalive=True):
+    import pycurl
+
+    if tcp_keepalive:
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+    if http2:
+        # HTTP/2 over TLS if the server supports it, HTTP/1.1 otherwise
+        curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+
+
+class PooledHTTPClient:
+    """An AsyncHTTPClient with its own pool of connections
+
+    Tracks the usage of the pool,
+    requests over `max_clients` wait for a free connection.
+    The AsyncHTTPClient is created on first use, on the running event loop.
+    """
+
+    def __init__(self, name, max_clients, log, **settings):
+        self.name = name
+        self.max_clients = max_clients
+        self.log = log
+        self.settings = settings
+        self.active = 0
+        self._client = None
+
+    def _make_defaults(self):
+        defaults = {
+            "connect_timeout": self.settings["connect_timeout"],
+            "request_timeout": self.settings["request_timeout"],
+        }
+        http2 = self.settings["http2"]
+        tcp_keepalive = self.settings["tcp_keepalive"]
+        if AsyncHTTPClient.configured_class().__name__ == "CurlAsyncHTTPClient":
+            defaults["prepare_curl_callback"] = lambda curl: _prepare_curl(
+                curl, http2=http2, tcp_keepalive=tcp_keepalive
+            )
+        elif http2:
+            self.log.warning("HTTP/2 requires pycurl, using HTTP/1.1 for %s", self.name)
+        return defaults
+
+    @property
+    def client(self):
+        if self._client is not None and self._client.io_loop is not IOLoop.current():
+            # tornado clients can't be shared between event loops
+            self._client = None
+        if self._client is None:
+            self._client = AsyncHTTPClient(
+                force_instance=True,
+                max_clients=self.max_clients,
+                defaults=self._make_defaults(),
+            )
+        return self._client
+
+    def _update_metrics(self):
+        HTTP_CLIENT_ACTIVE.labels(pool=self.name).set(self.active)
+        HTTP_CLIENT_QUEUED.labels(pool=self.name).set(
+            max(0, self.active - self.max_clients)
+        )
+
+    async def fetch(self, request, **kwargs):
+        """Make a request, same as AsyncHTTPClient.fetch"""
+        if self.active >= self.max_clients:
+            HTTP_CLIENT_SATURATED.labels(pool=self.name).inc()
+        self.active += 1
+        self._update_metrics()
+        try:
+            return await self.client.fetch(request, **kwargs)
+        finally:
+            self.active -= 1
+            self._update_metrics()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class HTTPClientPools(LoggingConfigurable):
+    """Clients for outbound HTTP requests, with a pool of connections per destination
+
+    Requests to a slow destination (e.g. a repository provider)
+    don't hold up requests to the others (e.g. the JupyterHub API).
+    BinderHub uses the pools "registry", "launcher", "launcher_spawns", "health"
+    and "repo_providers".
+
+    "launcher_spawns" holds the spawn requests and progress streams of launches,
+    open for as long as servers start, with two connections per launch.
+    It allows 512 concurrent requests by default.
+    """
+
+    max_clients = Integer(
+        64,
+        config=True,
+        help="""
+        Maximum number of concurrent requests of each pool.
+
+        Further requests wait for a free connection.
+        """,
+    )
+
+    connect_timeout = Float(
+        20,
+        config=True,
+        help="Timeout (in seconds) for establishing a connection",
+    )
+
+    request_timeout = Float(
+        60,
+        config=True,
+        help="Default timeout (in seconds) for a whole request",
+    )
+
+    tcp_keepalive = Bool(
+        True,
+        config=True,
+        help="""
+        Send TCP keep-alive probes on idle connections kept for reuse.
+
+        Connections are only kept for reuse when pycurl is available.
+        """,
+    )
+
+    http2 = Bool(
+        False,
+        config=True,
+        help="""
+        Use HTTP/2 for HTTPS requests, if the server supports it.
+
+        Requires pycurl, built with HTTP/2 support.
+        """,
+    )
+
+    pools = Dict(
+        config=True,
+        help="""
+        Settings of specific pools, overriding the settings above, e.g.
+
+            {"repo_providers": {"max_clients": 128, "request_timeout": 30}}
+
+        Allowed settings are max_clients, connect_timeout, request_timeout,
+        tcp_keepalive and http2.
+        """,
+    )
+
+    # default settings of specific pools, overridden by `pools`
+    _pool_defaults = {"launcher_spawns": {"max_clients": 512}}
+
+    _pool_settings = {
+        "max_clients",
+        "connect_timeout",
+        "request_timeout",
+        "tcp_keepalive",
+        "http2",
+    }
+
+    @validate("pools")
+    def _validate_pools(self, proposal):
+        for name, settings in proposal.value.items():
+            unknown = set(settings).difference(self._pool_settings)
+            if unknown:
+                raise TraitError(
+                    f"Unknown settings for HTTP client pool {name}: {', '.join(sorted(unknown))}"
+                )
+        return proposal.value
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._clients = {}
+
+    def get(self, name):
+        """Get the client of pool `name`"""
+        if name not in self._clients:
+            settings = {key: getattr(self, key) for key in self._pool_settings}
+            settings.update(self._pool_defaults.get(name, {}))
+            settings.update(self.pools.get(name, {}))
+            self._clients[name] = PooledHTTPClient(name, log=self.log, **settings)
+        return self._clients[name]
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients = {}
@@ -0,0 +1,244 @@
+"""
+Shared watches of Kubernetes pods
+"""
+
+import asyncio
+import os
+import threading
+from collections import defaultdict
+
+import kubernetes.config
+from kubernetes import client, watch
+from tornado.ioloop import IOLoop
+from traitlets import Any, Integer, Unicode, default
+from traitlets.config import LoggingConfigurable
+from urllib3.exceptions import ReadTimeoutError
+
+from .utils import KUBE_REQUEST_TIMEOUT
+
+
+class PodInformer(LoggingConfigurable):
+    """Keep a local cache of the pods matching a label selector up to date
+
+    A single list+watch is run for the whole process, in a background thread,
+    resuming from the last seen resourceVersion whenever the watch is restarted.
+    Every change is dispatched on the main event loop:
+
+    - to callbacks subscribed to the name of the pod, via `subscribe()`
+    - to listeners interested in all pods, via `add_listener()`
+
+    Callbacks are called as `callback(event_type, pod)` where `event_type` is one of
+    ADDED, MODIFIED or DELETED and `pod` is a `kubernetes.client.V1Pod`.
+    Callbacks must not block.
+    """
+
+    api = Any(
+        help="Kubernetes API object to make requests (kubernetes.client.CoreV1Api())",
+    )
+
+    @default("api")
+    def _default_api(self):
+        try:
+            kubernetes.config.load_incluster_config()
+        except kubernetes.config.ConfigException:
+            kubernetes.config.load_kube_config()
+        return client.CoreV1Api()
+
+    namespace = Unicode(help="Kubernetes namespace to watch")
+
+    @default("namespace")
+    def _default_namespace(self):
+        return os.getenv("BUILD_NAMESPACE", "default")
+
+    label_selector = Unicode(help="Label selector of the pods to watch")
+
+    watch_timeout = Integer(
+        300,
+        config=True,
+        help="""
+        Timeout (in seconds) of a single watch request.
+
+        The watch is restarted from the last seen resourceVersion when it times out,
+        so this only bounds how long a silently dropped connection can go unnoticed.
+        """,
+    )
+
+    retry_delay = Integer(
+        5,
+        config=True,
+        help="Time (seconds) to wait before restarting the watch after an error.",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # name: V1Pod for all pods currently known, only modified on the main loop
+        self.pods = {}
+        self._subscribers = defaultdict(list)
+        self._listeners = []
+        self._resource_version = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.main_loop = None
+        self.ready = asyncio.Event()
+
+    def start(self):
+        """Start watching pods in a background thread"""
+        if self._thread is not None:
+            return
+        self.main_loop = IOLoop.current()
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"informer-{self.label_selector}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching pods
+
+        The background thread exits at the latest when the current watch request times out.
+        """
+        self._stop_event.set()
+        self._thread = None
+
+    def subscribe(self, name, callback):
+        """Subscribe `callback` to the changes of the pod called `name`
+
+        If the pod is already known, `callback` is called immediately with an ADDED event
+        so late subscribers don't miss the current state of the pod.
+
+        Safe to call from any thread.
+        """
+        self._call_in_loop(self._subscribe, name, callback)
+
+    def unsubscribe(self, name, callback):
+        """Stop sending changes of the pod called `name` to `callback`
+
+        Safe to call from any thread.
+        """
+        self._call_in_loop(self._unsubscribe, name, callback)
+
+    def add_listener(self, callback):
+        """Send changes of all pods to `callback`
+
+        Must be called from the main loop.
+        The current state of all pods is sent immediately as ADDED events.
+        """
+        self._listeners.append(callback)
+        for pod in list(self.pods.values()):
+            callback("ADDED", pod)
+
+    def _call_in_loop(self, f, *args):
+        if self.main_loop is None:
+            # not started yet, we must be on the main loop
+            f(*args)
+        else:
+            self.main_loop.add_callback(f, *args)
+
+    def _subscribe(self, name, callback):
+        self._subscribers[name].append(callback)
+        if name in self.pods:
+            callback("ADDED", self.pods[name])
+
+    def _unsubscribe(self, name, callback):
+        callbacks = self._subscribers.get(name, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self._subscribers.pop(name, None)
+
+    def _dispatch(self, event_type, pod):
+        """Send an event to subscribers of the pod and to all listeners"""
+        name = pod.metadata.name
+        if event_type == "DELETED":
+            self.pods.pop(name, None)
+        else:
+            self.pods[name] = pod
+        # copy callback lists, which may be modified by the callbacks
+        for callback in list(self._listeners) + list(self._subscribers.get(name, [])):
+            try:
+                callback(event_type, pod)
+            except Exception:
+                self.log.exception(
+                    "Error handling %s event for pod %s", event_type, name
+                )
+
+    def _replace(self, pods):
+        """Replace the full pod cache after listing pods
+
+        Emits events for the difference between the previous state and the listing,
+        so nothing is missed when the watch has to be restarted from scratch.
+        """
+        for name in set(self.pods).difference(pods):
+            self._dispatch("DELETED", self.pods[name])
+        for name, pod in pods.items():
+            event_type = "MODIFIED" if name in self.pods else "ADDED"
+            self._dispatch(event_type, pod)
+        self.ready.set()
+
+    def _list(self):
+        """List all pods, recording the resourceVersion to start watching from"""
+        pod_list = self.api.list_namespaced_pod(
+            self.namespace,
+            label_selector=self.label_selector,
+            _request_timeout=KUBE_REQUEST_TIMEOUT,
+        )
+        self._resource_version = pod_list.metadata.resource_version
+        pods = {pod.metadata.name: pod for pod in pod_list.items}
+        self.log.debug(
+            "Listed %i pods matching %s at resourceVersion %s",
+            len(pods),
+            self.label_selector,
+            self._resource_version,
+        )
+        self._call_in_loop(self._replace, pods)
+
+    def _watch(self):
+        """Watch pods from the last seen resourceVersion until the watch times out"""
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                self.api.list_namespaced_pod,
+                self.namespace,
+                label_selector=self.label_selector,
+                resource_version=self._resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=self.watch_timeout,
+                _request_timeout=(KUBE_REQUEST_TIMEOUT[0], self.watch_timeout + 5),
+            ):
+                if self._stop_event.is_set():
+                    return
+                pod = event["object"]
+                self._resource_version = pod.metadata.resource_version
+                if event["type"] == "BOOKMARK":
+                    # only used to advance the resourceVersion
+                    continue
+                self._call_in_loop(self._dispatch, event["type"], pod)
+        except ReadTimeoutError:
+            # just retry after timeout, don't fail
+            self.log.warning("Timeout in watch stream for %s", self.label_selector)
+        finally:
+            w.stop()
+
+    def _run(self):
+        self.log.info("Watching pods matching %s", self.label_selector)
+        while not self._stop_event.is_set():
+            try:
+                if self._resource_version is None:
+                    self._list()
+                self._watch()
+            except client.rest.ApiException as e:
+                if e.status == 410:
+                    # resourceVersion is too old, start over with a fresh list
+                    self.log.info(
+                        "Restarting watch of %s: resourceVersion %s expired",
+                        self.label_selector,
+                        self._resource_version,
+                    )
+                    self._resource_version = None
+                    continue
+                self.log.exception("Error in watch stream for %s", self.label_selector)
+                self._stop_event.wait(self.retry_delay)
+            except Exception:
+                self.log.exception("Error in watch stream for %s", self.label_selector)
+                self._stop_event.wait(self.retry_delay)
+        self.log.info("Stopped watching pods matching %s", self.label_selector)
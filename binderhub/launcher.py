@@ -9,18 +9,29 @@ import os
 import random
 import re
 import string
+import time
 import uuid
+from collections import deque
 from datetime import timedelta
 from urllib.parse import quote, urlparse
 
 from jupyterhub.traitlets import Callable
 from jupyterhub.utils import maybe_future
+from prometheus_client import Gauge, Histogram
 from tornado import gen, web
 from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
 from tornado.log import app_log
-from traitlets import Bool, Integer, Unicode, default
+from traitlets import Any, Bool, Float, Integer, Unicode, default
 from traitlets.config import LoggingConfigurable
 
+from .backpressure import (
+    HUB_API_REJECTED,
+    AdaptiveConcurrencyLimit,
+    CircuitBreaker,
+    Overloaded,
+)
+from .http_client import is_timeout
+from .sse import EventStreamQueue
 from .utils import url_path_join
 
 # pattern for checking if it's an ssh repo and not a URL
@@ -33,11 +44,94 @@ SUFFIX_CHARS = string.ascii_lowercase + string.digits
 # Set length of suffix. Number of combinations = SUFFIX_CHARS**SUFFIX_LENGTH = 36**8 ~= 2**41
 SUFFIX_LENGTH = 8
 
+LAUNCH_STEP_TIME = Histogram(
+    "binderhub_launch_step_time_seconds",
+    "Histogram of the time of each step of launches",
+    ["step", "status"],
+    buckets=[0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600, float("inf")],
+)
+
+USER_POOL_SIZE = Gauge(
+    "binderhub_temporary_user_pool_size",
+    "Temporary users created ahead of launches",
+)
+
+
+class HubUnavailable(web.HTTPError):
+    """Raised when a Hub API request is rejected to relieve a struggling Hub"""
+
+    def __init__(self, retry_after):
+        super().__init__(503, "JupyterHub is busy, try again in %is", retry_after)
+        self.retry_after = retry_after
+
+
+async def timed_launch_step(step, awaitable):
+    """Await a step of a launch, recording its time in LAUNCH_STEP_TIME"""
+    start = time.perf_counter()
+    status = "failure"
+    try:
+        result = await awaitable
+        status = "success"
+        return result
+    finally:
+        LAUNCH_STEP_TIME.labels(step=step, status=status).observe(
+            time.perf_counter() - start
+        )
+
+
+def _hub_unreachable(e):
+    """Whether a request failed because the Hub couldn't be reached"""
+    if e.code == 599:
+        return not is_timeout(e)
+    # errors of the proxy in front of the Hub
+    return e.code in {502, 503, 504}
+
 
 class Launcher(LoggingConfigurable):
     """Object for encapsulating launching an image for a user"""
 
     hub_api_token = Unicode(help="The API token for the Hub")
+
+    http_client = Any(help="""
+        Client for requests to the JupyterHub API, e.g. a binderhub.http_client.PooledHTTPClient.
+
+        Set by BinderHub, defaults to the shared AsyncHTTPClient.
+        """)
+
+    @default("http_client")
+    def _default_http_client(self):
+        return AsyncHTTPClient()
+
+    spawn_http_client = Any(help="""
+        Client for the long-running requests to the JupyterHub API
+        (spawn requests and the progress of spawns),
+        so that they don't hold up the other requests.
+
+        Set by BinderHub, defaults to http_client.
+        """)
+
+    @default("spawn_http_client")
+    def _default_spawn_http_client(self):
+        return self.http_client
+
+    circuit_breaker = Any(help="""
+        CircuitBreaker of the requests to the JupyterHub API,
+        shared by all launches.
+        """)
+
+    @default("circuit_breaker")
+    def _default_circuit_breaker(self):
+        return CircuitBreaker(parent=self)
+
+    concurrency_limit = Any(help="""
+        AdaptiveConcurrencyLimit of the requests to the JupyterHub API,
+        shared by all launches.
+        """)
+
+    @default("concurrency_limit")
+    def _default_concurrency_limit(self):
+        return AdaptiveConcurrencyLimit(parent=self)
+
     hub_url = Unicode(help="The URL of the Hub")
     hub_url_local = Unicode(help="The internal URL of the Hub if different")
 
@@ -94,9 +188,79 @@ class Launcher(LoggingConfigurable):
         Wait this many seconds until server is ready, raise TimeoutError otherwise.
         """,
     )
+    progress_delay = Float(
+        0.2,
+        config=True,
+        help="""
+        Time (seconds) to wait after requesting the spawn of a server
+        before following its progress.
+
+        The progress is followed as soon as the Hub has started the spawn,
+        without waiting for the Hub to reply to the spawn request.
+        """,
+    )
+
+    create_user_batch_delay = Float(
+        0.005,
+        config=True,
+        help="""
+        Time (seconds) to collect temporary users to create before creating them
+        with a single request to the Hub API.
+
+        Users are created one request at a time if 0.
+        """,
+    )
+    create_user_batch_size = Integer(
+        100,
+        config=True,
+        help="""Maximum number of temporary users to create with a single request""",
+    )
+
+    user_pool_size = Integer(
+        0,
+        config=True,
+        help="""
+        Number of temporary users to create ahead of launches.
+
+        Launches without authentication use one of these users,
+        instead of creating a user named after the repository,
+        and the pool is refilled in the background.
+        """,
+    )
+    user_pool_max_age = Integer(
+        1800,
+        config=True,
+        help="""
+        Time (seconds) after which unused users of the pool are deleted and replaced.
+
+        Should be less than the time after which the JupyterHub culler
+        deletes inactive users.
+        """,
+    )
+    user_pool_interval = Integer(
+        60,
+        config=True,
+        help="""Interval (in seconds) for how often the pool of temporary users is refilled""",
+    )
 
-    async def api_request(self, url, *args, **kwargs):
-        """Make an API request to JupyterHub"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # username: Future of temporary users waiting to be created
+        self._pending_users = {}
+        self._create_users_handle = None
+        # (username, created) of the users created ahead of launches, oldest first
+        self._user_pool = deque()
+        self._user_pool_creating = 0
+
+    async def api_request(self, url, *args, long_running=False, **kwargs):
+        """Make an API request to JupyterHub
+
+        Requests are rejected with HubUnavailable while the Hub is struggling,
+        see CircuitBreaker and AdaptiveConcurrencyLimit.
+        Only the Hub being unreachable counts as a failure of long-running requests
+        (e.g. spawning a server), and streaming requests
+        (e.g. following the progress of a spawn) aren't counted in the concurrency limit.
+        """
         headers = kwargs.setdefault("headers", {})
         headers.update({"Authorization": f"token {self.hub_api_token}"})
         hub_api_url = (
@@ -109,7 +273,7 @@ class Launcher(LoggingConfigurable):
         retry_delay = self.retry_delay
         for i in range(1, self.retries + 1):
             try:
-                return await AsyncHTTPClient().fetch(req)
+                return await self._guarded_fetch(req, long_running)
             except HTTPError as e:
                 # swallow 409 errors on retry only (not first attempt)
                 if i > 1 and e.code == 409 and e.response:
@@ -132,6 +296,49 @@ class Launcher(LoggingConfigurable):
                 else:
                     raise
 
+    async def _guarded_fetch(self, req, long_running):
+        """Fetch a request, unless the Hub is struggling"""
+        # streams (e.g. the progress of a spawn) are open for as long as the spawn
+        streaming = req.streaming_callback is not None
+        started = None
+        try:
+            self.circuit_breaker.check()
+            if not streaming:
+                started = await self.concurrency_limit.acquire()
+        except Overloaded as e:
+            HUB_API_REJECTED.labels(reason=e.reason).inc()
+            self.log.warning("Rejected Hub API request %s: %s", req.url, e)
+            raise HubUnavailable(e.retry_after) from None
+        # whether the Hub handled the request, None if unknown
+        success = None
+        try:
+            http_client = self.spawn_http_client if long_running else self.http_client
+            resp = await http_client.fetch(req)
+            success = True
+            return resp
+        except HTTPError as e:
+            if long_running:
+                # the outcome of a spawn depends on the spawner,
+                # e.g. a broken image fails, a slow image pull times out,
+                # only count the Hub being unreachable as a failure
+                success = False if _hub_unreachable(e) else None
+            else:
+                # 429 is the Hub's own limit on concurrent spawns
+                success = e.code < 500 and e.code != 429
+            raise
+        except Exception:
+            success = False
+            raise
+        finally:
+            if success is not None:
+                self.circuit_breaker.record(success)
+            if not streaming:
+                self.concurrency_limit.release(
+                    # the duration of a spawn isn't a sign of a slow Hub
+                    None if long_running else started,
+                    success,
+                )
+
     async def get_user_data(self, username):
         resp = await self.api_request(
             f"users/{username}",
@@ -168,38 +375,156 @@ class Launcher(LoggingConfigurable):
             prefix, "".join(random.choices(SUFFIX_CHARS, k=SUFFIX_LENGTH))
         )
 
-    async def launch(
-        self,
-        image,
-        username,
-        server_name="",
-        repo_url="",
-        extra_args=None,
-        event_callback=None,
-    ):
-        """Launch a server for a given image
+    async def _create_temporary_user(self, username):
+        """Create a temporary user, with the other users created at the same time
 
-        - creates a temporary user on the Hub if authentication is not enabled
-        - spawns a server for temporary/authenticated user
-        - generates a token
-        - returns a dict containing:
-          - `url`: the URL of the server
-          - `image`: image spec
-          - `repo_url`: the url of the repo
-          - `extra_args`: Dictionary of extra arguments passed to the server
-          - `token`: the token for the server
+        Users are collected for create_user_batch_delay seconds,
+        and created with a single request to the Hub.
         """
-        # TODO: validate the image argument?
+        if not self.create_user_batch_delay:
+            await self.api_request(
+                f"users/{quote(username, safe='@~')}", body=b"", method="POST"
+            )
+            return
+        loop = asyncio.get_running_loop()
+        future = self._pending_users[username] = loop.create_future()
+        if len(self._pending_users) >= self.create_user_batch_size:
+            self._create_pending_users()
+        elif self._create_users_handle is None:
+            self._create_users_handle = loop.call_later(
+                self.create_user_batch_delay, self._create_pending_users
+            )
+        await future
 
-        # Matches the escaping that JupyterHub does https://github.com/jupyterhub/jupyterhub/blob/c00c3fa28703669b932eb84549654238ff8995dc/jupyterhub/user.py#L427
-        escaped_username = quote(username, safe="@~")
+    def _create_pending_users(self):
+        if self._create_users_handle is not None:
+            self._create_users_handle.cancel()
+            self._create_users_handle = None
+        users, self._pending_users = self._pending_users, {}
+        asyncio.ensure_future(self._create_users(users))
+
+    async def _create_users(self, users):
+        """Create a batch of users, resolving the future of each user
+
+        Users that couldn't be created together are created one by one,
+        to get the error of each user.
+        """
+        try:
+            await self._create_users_batch(users)
+        except Exception as e:
+            self.log.error("Error creating %i users: %s", len(users), e)
+            for future in users.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # never leave a launch waiting for its user
+            for future in users.values():
+                if not future.done():
+                    future.cancel()
+
+    async def _create_users_batch(self, users):
+        created = set()
+        # whether the users may have been created by a request whose reply got lost
+        maybe_created = False
+        if len(users) > 1:
+            try:
+                resp = await self.api_request(
+                    "users",
+                    method="POST",
+                    body=json.dumps({"usernames": list(users)}).encode("utf8"),
+                )
+            except HTTPError as e:
+                self.log.warning(
+                    "Error creating %i users at once, creating them one by one: %s",
+                    len(users),
+                    e,
+                )
+            else:
+                if resp.code == 409:
+                    # a 409 on retry, see api_request
+                    maybe_created = True
+                else:
+                    created = {user["name"] for user in json.loads(resp.body)}
+
+        async def create_user(username, future):
+            try:
+                await self.api_request(
+                    f"users/{quote(username, safe='@~')}", body=b"", method="POST"
+                )
+            except HTTPError as e:
+                if e.code != 409 or not maybe_created:
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+            except Exception as e:
+                # e.g. HubUnavailable
+                if not future.done():
+                    future.set_exception(e)
+                return
+            if not future.done():
+                future.set_result(None)
+
+        singles = []
+        for username, future in users.items():
+            if username in created:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                singles.append(create_user(username, future))
+        await asyncio.gather(*singles)
+
+    def claim_pooled_user(self):
+        """Take a user from the pool of temporary users, None if the pool is empty"""
+        now = time.monotonic()
+        username = None
+        while self._user_pool:
+            pooled_username, created = self._user_pool.pop()
+            if now - created < self.user_pool_max_age:
+                username = pooled_username
+                break
+            asyncio.ensure_future(self._delete_user(quote(pooled_username, safe="@~")))
+        USER_POOL_SIZE.set(len(self._user_pool))
+        asyncio.ensure_future(self.fill_user_pool())
+        return username
+
+    async def fill_user_pool(self):
+        """Create temporary users up to user_pool_size, replacing the old unused users"""
+        now = time.monotonic()
+        expired = []
+        while self._user_pool and now - self._user_pool[0][1] >= self.user_pool_max_age:
+            expired.append(self._user_pool.popleft()[0])
+
+        missing = self.user_pool_size - len(self._user_pool) - self._user_pool_creating
+        usernames = [
+            "binder-" + "".join(random.choices(SUFFIX_CHARS, k=SUFFIX_LENGTH))
+            for _ in range(max(0, missing))
+        ]
+        self._user_pool_creating += len(usernames)
+        try:
+            results = await asyncio.gather(
+                *(self._create_temporary_user(username) for username in usernames),
+                *(
+                    self._delete_user(quote(username, safe="@~"))
+                    for username in expired
+                ),
+                return_exceptions=True,
+            )
+        finally:
+            self._user_pool_creating -= len(usernames)
+        for username, result in zip(usernames, results):
+            if isinstance(result, Exception):
+                self.log.error("Error creating pooled user %s: %s", username, result)
+            else:
+                self._user_pool.append((username, time.monotonic()))
+        USER_POOL_SIZE.set(len(self._user_pool))
+
+    async def _prepare_user(self, username, escaped_username, server_name, image):
+        """Create the temporary user, or check that the user can start a server"""
         if self.create_user:
             # create a new user
             app_log.info("Creating user %s for image %s", username, image)
             try:
-                await self.api_request(
-                    f"users/{escaped_username}", body=b"", method="POST"
-                )
+                await self._create_temporary_user(username)
             except HTTPError as e:
                 if e.response:
                     body = e.response.body
@@ -234,6 +559,80 @@ class Launcher(LoggingConfigurable):
                     ),
                 )
 
+    async def _delete_user(self, escaped_username):
+        """Delete a temporary user that won't be used"""
+        try:
+            await self.api_request(f"users/{escaped_username}", method="DELETE")
+        except Exception as e:
+            app_log.error("Error deleting unused user %s: %s", escaped_username, e)
+
+    async def launch(
+        self,
+        image,
+        username,
+        server_name="",
+        repo_url="",
+        extra_args=None,
+        event_callback=None,
+        before_spawn=None,
+        spawn_callback=None,
+    ):
+        """Launch a server for a given image
+
+        - creates a temporary user on the Hub if authentication is not enabled
+        - spawns a server for temporary/authenticated user
+        - generates a token
+        - returns a dict containing:
+          - `url`: the URL of the server
+          - `image`: image spec
+          - `repo_url`: the url of the repo
+          - `extra_args`: Dictionary of extra arguments passed to the server
+          - `token`: the token for the server
+
+        `before_spawn` is an optional awaitable (e.g. a quota check),
+        awaited while the user is created, before the server is spawned.
+        If it raises, the temporary user is deleted and the launch fails.
+
+        `spawn_callback` is an optional callable, called with the username
+        and server name right before the server is spawned.
+        """
+        # TODO: validate the image argument?
+
+        # Matches the escaping that JupyterHub does https://github.com/jupyterhub/jupyterhub/blob/c00c3fa28703669b932eb84549654238ff8995dc/jupyterhub/user.py#L427
+        launch_name = None
+        if self.create_user and self.user_pool_size:
+            pooled_username = self.claim_pooled_user()
+            if pooled_username is not None:
+                # use a user created ahead of time,
+                # the name from the repo is kept in the server's user_options
+                launch_name, username = username, pooled_username
+        escaped_username = quote(username, safe="@~")
+        if launch_name is None:
+            # the user is created while waiting for before_spawn
+            prepare_user = asyncio.ensure_future(
+                timed_launch_step(
+                    "user",
+                    self._prepare_user(username, escaped_username, server_name, image),
+                )
+            )
+        else:
+            prepare_user = None
+        if before_spawn is not None:
+            try:
+                await before_spawn
+            except BaseException:
+                try:
+                    if prepare_user is not None:
+                        await prepare_user
+                except Exception:
+                    pass
+                else:
+                    if self.create_user:
+                        asyncio.ensure_future(self._delete_user(escaped_username))
+                raise
+        if prepare_user is not None:
+            await prepare_user
+
         if self.pre_launch_hook:
             await maybe_future(
                 self.pre_launch_hook(self, image, username, server_name, repo_url)
@@ -248,12 +647,17 @@ class Launcher(LoggingConfigurable):
             .decode("ascii")
             .rstrip("=\n"),
         }
+        if launch_name is not None:
+            data["binder_launch_name"] = launch_name
         if extra_args:
             data.update(extra_args)
 
         # server name to be used in logs
         _server_name = f" {server_name}" if server_name else ""
 
+        if spawn_callback is not None:
+            spawn_callback(username, server_name)
+
         # start server
         app_log.info(
             f"Starting server{_server_name} for user {username} with image {image}"
@@ -267,41 +671,44 @@ class Launcher(LoggingConfigurable):
                 else:
                     ready_event_future.cancel()
 
+        spawn_future = None
         try:
-            await self.api_request(
-                f"users/{escaped_username}/servers/{server_name}",
-                method="POST",
-                body=json.dumps(data).encode("utf8"),
+            # the Hub only replies to the spawn request
+            # once the server is ready or after its slow_spawn_timeout,
+            # so follow the progress of the spawn without waiting for the reply
+            spawn_future = asyncio.ensure_future(
+                timed_launch_step(
+                    "spawn_request",
+                    self.api_request(
+                        f"users/{escaped_username}/servers/{server_name}",
+                        method="POST",
+                        body=json.dumps(data).encode("utf8"),
+                        long_running=True,
+                    ),
+                )
             )
             # listen for pending spawn (launch) events until server is ready
             # do this even if previous request finished!
-            buffer_list = []
-
-            async def handle_chunk(chunk):
-                lines = b"".join(buffer_list + [chunk]).split(b"\n\n")
-                # the last item in the list is usually an empty line ('')
-                # but it can be the partial line after the last `\n\n`,
-                # so put it back on the buffer to handle with the next chunk
-                buffer_list[:] = [lines[-1]]
-                for line in lines[:-1]:
-                    if line:
-                        line = line.decode("utf8", "replace")
-                    if line and line.startswith("data:"):
-                        event = json.loads(line.split(":", 1)[1])
-                        if event_callback:
-                            await event_callback(event)
-
-                        # stream ends when server is ready or fails
-                        if event.get("ready", False):
-                            if not ready_event_future.done():
-                                ready_event_future.set_result(event)
-                        elif event.get("failed", False):
-                            if not ready_event_future.done():
-                                ready_event_future.set_exception(
-                                    web.HTTPError(
-                                        500, event.get("message", "unknown error")
-                                    )
+            # events are handled in order, once the previous one has been handled
+            progress_events = EventStreamQueue()
+
+            async def handle_events():
+                async for progress_event in progress_events.events():
+                    event = json.loads(progress_event.data)
+                    if event_callback:
+                        await event_callback(event)
+
+                    # stream ends when server is ready or fails
+                    if event.get("ready", False):
+                        if not ready_event_future.done():
+                            ready_event_future.set_result(event)
+                    elif event.get("failed", False):
+                        if not ready_event_future.done():
+                            ready_event_future.set_exception(
+                                web.HTTPError(
+                                    500, event.get("message", "unknown error")
                                 )
+                            )
 
             url_parts = ["users", escaped_username]
             if server_name:
@@ -309,17 +716,43 @@ class Launcher(LoggingConfigurable):
             else:
                 url_parts.extend(["server/progress"])
             progress_api_url = url_path_join(*url_parts)
-            self.log.debug(f"Requesting progress for {username}: {progress_api_url}")
-            resp_future = self.api_request(
-                progress_api_url,
-                streaming_callback=lambda chunk: asyncio.ensure_future(
-                    handle_chunk(chunk)
-                ),
-                request_timeout=self.launch_timeout,
-            )
+
+            async def follow_progress():
+                handle_events_future = asyncio.ensure_future(handle_events())
+                try:
+                    while True:
+                        # give the Hub a moment to receive the spawn request
+                        await asyncio.wait([spawn_future], timeout=self.progress_delay)
+                        if spawn_future.done():
+                            # raise errors of the spawn request
+                            spawn_future.result()
+                        self.log.debug(
+                            f"Requesting progress for {username}: {progress_api_url}"
+                        )
+                        try:
+                            await self.api_request(
+                                progress_api_url,
+                                streaming_callback=progress_events.streaming_callback(),
+                                request_timeout=self.launch_timeout,
+                                long_running=True,
+                            )
+                            break
+                        except HTTPError as e:
+                            if e.code == 400 and not spawn_future.done():
+                                # the spawn hasn't started yet
+                                continue
+                            raise
+                finally:
+                    progress_events.close()
+                await handle_events_future
+
             try:
-                await gen.with_timeout(
-                    timedelta(seconds=self.launch_timeout), resp_future
+                await timed_launch_step(
+                    "ready",
+                    gen.with_timeout(
+                        timedelta(seconds=self.launch_timeout),
+                        asyncio.gather(spawn_future, follow_progress()),
+                    ),
                 )
             except (gen.TimeoutError, TimeoutError):
                 _cancel_ready_event()
@@ -342,6 +775,10 @@ class Launcher(LoggingConfigurable):
         except Exception:
             _cancel_ready_event()
             raise
+        finally:
+            if spawn_future is not None and not spawn_future.done():
+                # don't leave errors of the spawn request unretrieved
+                spawn_future.add_done_callback(lambda f: f.cancelled() or f.exception())
 
         # verify that the server is running!
         try:
@@ -0,0 +1,521 @@
+"""
+Prewarming of popular images on user nodes, ahead of their launches
+"""
+
+import asyncio
+import datetime
+import os
+import socket
+import time
+import uuid
+
+import kubernetes.config
+from kubernetes import client
+from prometheus_client import Gauge
+from traitlets import Any, Dict, Float, Integer, List, Unicode, Union, default
+from traitlets.config import LoggingConfigurable
+
+from .utils import KUBE_REQUEST_TIMEOUT, ByteSpecification
+
+PREWARMED_IMAGES = Gauge(
+    "binderhub_prewarmed_images", "Images currently prewarmed on user nodes"
+)
+PREWARMED_IMAGES_SIZE = Gauge(
+    "binderhub_prewarmed_images_size_bytes",
+    "Compressed size of the images currently prewarmed on user nodes, if known",
+)
+
+
+def _load_kube_config():
+    try:
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.ConfigException:
+        kubernetes.config.load_kube_config()
+
+
+class ImagePrewarmer(LoggingConfigurable):
+    """Track the popularity of images, to pull the most popular ones ahead of launches
+
+    Each launch adds 1 to the score of its image, and scores decay by half
+    every `half_life` seconds, so that images launched often and recently
+    are the ones prewarmed.
+
+    Call `record_launch()` on each launch, and `update()` periodically.
+    Subclasses implement `prewarm(images)`, to pull the images on nodes.
+    """
+
+    max_images = Integer(
+        10,
+        config=True,
+        help="Maximum number of images to prewarm",
+    )
+
+    max_size = ByteSpecification(
+        0,
+        config=True,
+        help="""
+        Maximum total size of the images to prewarm, to bound the disk used on each node.
+
+        The compressed size of images is taken from the registry,
+        images of unknown size aren't prewarmed when a size is set.
+        0 means no limit.
+        """,
+    )
+
+    max_new_images = Integer(
+        2,
+        config=True,
+        help="""
+        Maximum number of images to start prewarming at each update,
+        to bound the bandwidth used for pulls.
+        """,
+    )
+
+    half_life = Float(
+        3600,
+        config=True,
+        help="Time (in seconds) for the score of an image to decay by half",
+    )
+
+    min_score = Float(
+        3,
+        config=True,
+        help="""
+        Minimum score of an image to prewarm it, i.e. the number of recent launches
+        """,
+    )
+
+    update_interval = Integer(
+        300,
+        config=True,
+        help="Interval (in seconds) for how often the prewarmed images are updated",
+    )
+
+    max_tracked_images = Integer(
+        10000,
+        config=True,
+        help="""
+        Maximum number of images to track the popularity of.
+
+        The least popular images are forgotten first.
+        """,
+    )
+
+    registry = Any(
+        None,
+        allow_none=True,
+        help="DockerRegistry to check images in, images aren't checked if None",
+    )
+
+    executor = Any(
+        None,
+        allow_none=True,
+        help="Executor to run blocking calls in, the default executor if None",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # image: [score, updated, (name, tag)]
+        self._scores = {}
+        self._sizes = {}
+        self.prewarmed = []
+
+    def _now(self):
+        return time.monotonic()
+
+    def _score(self, image, now):
+        score, updated, _ = self._scores[image]
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def record_launch(self, image, name, tag):
+        """Record the launch of an image
+
+        image: the image to pull
+        name, tag: the image name in the registry, without the registry, and its tag
+        """
+        now = self._now()
+        score = self._score(image, now) if image in self._scores else 0
+        self._scores[image] = [score + 1, now, (name, tag)]
+        if len(self._scores) > self.max_tracked_images:
+            # forget the least popular quarter, rather than one image per launch
+            keep = set(
+                self.popular_images(min_score=0)[: self.max_tracked_images * 3 // 4]
+            )
+            self._scores = {image: self._scores[image] for image in keep}
+            self._sizes = {
+                image: size for image, size in self._sizes.items() if image in keep
+            }
+
+    def popular_images(self, min_score=None):
+        """Images with at least `min_score`, most popular first"""
+        if min_score is None:
+            min_score = self.min_score
+        now = self._now()
+        scores = {image: self._score(image, now) for image in self._scores}
+        return sorted(
+            (image for image, score in scores.items() if score >= min_score),
+            key=scores.get,
+            reverse=True,
+        )
+
+    async def _image_size(self, image):
+        """The compressed size of an image, from its manifest in the registry"""
+        if image not in self._sizes:
+            name, tag = self._scores[image][2]
+            manifest = await self.registry.get_image_manifest(name, tag)
+            if not manifest or "layers" not in manifest:
+                # e.g. a multi-platform image index
+                return None
+            self._sizes[image] = sum(
+                layer.get("size", 0) for layer in manifest["layers"]
+            ) + manifest.get("config", {}).get("size", 0)
+        return self._sizes[image]
+
+    async def select_images(self):
+        """Select the images to prewarm
+
+        The most popular images are selected within the size budget,
+        images not prewarmed yet are only added `max_new_images` at a time.
+        """
+        candidates = self.popular_images()[: self.max_images * 2]
+        if self.registry is not None and candidates:
+            found = await self.registry.check_images(
+                self._scores[image][2] for image in candidates
+            )
+            # don't pull images that are known to be missing, e.g. deleted images
+            candidates = [
+                image
+                for image in candidates
+                if found.get(self._scores[image][2]) is not False
+            ]
+
+        selected = []
+        new_images = 0
+        total_size = 0
+        for image in candidates:
+            if len(selected) >= self.max_images:
+                break
+            new = image not in self.prewarmed
+            if new and new_images >= self.max_new_images:
+                continue
+            if self.max_size:
+                size = None
+                if self.registry is not None:
+                    try:
+                        size = await self._image_size(image)
+                    except Exception as e:
+                        self.log.error("Failed to get the size of %s: %s", image, e)
+                if size is None or total_size + size > self.max_size:
+                    continue
+                total_size += size
+            selected.append(image)
+            new_images += new
+        return selected
+
+    async def prewarm(self, images):
+        """Pull `images` on nodes, and remove the images prewarmed before
+
+        To be implemented by subclasses.
+        """
+
+    async def acquire_lease(self):
+        """Whether this BinderHub replica updates the prewarmed images
+
+        Subclasses prewarming images for several replicas
+        elect a single replica, so that replicas don't undo each other's updates.
+        """
+        return True
+
+    async def update(self):
+        """Update the prewarmed images, if the most popular images have changed"""
+        if not await self.acquire_lease():
+            return
+        images = await self.select_images()
+        # the order of images doesn't matter, only which images are prewarmed
+        if set(images) == set(self.prewarmed):
+            return
+        self.log.info("Prewarming %i images: %s", len(images), ", ".join(images))
+        await self.prewarm(images)
+        self.prewarmed = images
+        PREWARMED_IMAGES.set(len(images))
+        PREWARMED_IMAGES_SIZE.set(sum(self._sizes.get(image, 0) for image in images))
+
+
+class KubernetesImagePrewarmer(ImagePrewarmer):
+    """Prewarm images on nodes with a DaemonSet
+
+    Each image is an init container of the DaemonSet's pods, which exits right away,
+    so that the images are pulled on each node before they are launched.
+    The DaemonSet is updated a few nodes at a time (`max_unavailable`),
+    to spread the pulls of new images over time.
+
+    With several BinderHub replicas, only the replica holding a Lease
+    (`lease_name`) updates the DaemonSet, from the launches it serves.
+    The Lease is taken over by another replica if it isn't renewed
+    for `lease_duration` seconds.
+    """
+
+    kube = Any(help="kubernetes AppsV1Api client")
+
+    @default("kube")
+    def _default_kube(self):
+        _load_kube_config()
+        return client.AppsV1Api()
+
+    namespace = Unicode(help="Kubernetes namespace of the DaemonSet")
+
+    @default("namespace")
+    def _default_namespace(self):
+        return os.getenv("BUILD_NAMESPACE", "default")
+
+    daemonset_name = Unicode(
+        "binderhub-image-prewarmer",
+        config=True,
+        help="Name of the DaemonSet pulling the images",
+    )
+
+    node_selector = Dict(
+        config=True,
+        help="""
+        Node selector of the DaemonSet, to prewarm images on user nodes only
+        """,
+    )
+
+    tolerations = List(
+        config=True,
+        help="""
+        Tolerations of the DaemonSet, e.g. to prewarm images on dedicated user nodes
+        """,
+    )
+
+    image_pull_secret = Unicode(
+        "",
+        config=True,
+        help="Name of the secret to pull the images from a private registry",
+    )
+
+    pause_image = Unicode(
+        "registry.k8s.io/pause:3.9",
+        config=True,
+        help="Image of the container keeping the pods of the DaemonSet running",
+    )
+
+    command = List(
+        ["/bin/sh", "-c", "true"],
+        config=True,
+        help="Command of the init containers pulling the images",
+    )
+
+    max_unavailable = Union(
+        [Integer(), Unicode()],
+        default_value="10%",
+        config=True,
+        help="""
+        Maximum number (or percentage) of nodes pulling new images at the same time
+        """,
+    )
+
+    coordination = Any(help="kubernetes CoordinationV1Api client, for the Lease")
+
+    @default("coordination")
+    def _default_coordination(self):
+        _load_kube_config()
+        return client.CoordinationV1Api()
+
+    lease_name = Unicode(
+        "binderhub-image-prewarmer",
+        config=True,
+        help="Name of the Lease electing the replica updating the DaemonSet",
+    )
+
+    lease_duration = Integer(
+        900,
+        config=True,
+        help="""
+        Time (in seconds) after which the Lease of a replica that stopped renewing it
+        is taken over by another replica.
+
+        Should be more than `update_interval`, when the Lease is renewed.
+        """,
+    )
+
+    identity = Unicode(help="Identity of this replica in the Lease")
+
+    @default("identity")
+    def _default_identity(self):
+        return f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+    def _acquire_lease(self):
+        """Take or renew the Lease, in a thread
+
+        Returns whether this replica holds the Lease.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            lease = self.coordination.read_namespaced_lease(
+                self.lease_name, self.namespace, _request_timeout=KUBE_REQUEST_TIMEOUT
+            )
+        except client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            lease = None
+
+        if lease is not None:
+            spec = lease.spec
+            if (
+                spec.holder_identity not in (None, self.identity)
+                and spec.renew_time is not None
+                and spec.renew_time
+                + datetime.timedelta(seconds=spec.lease_duration_seconds or 0)
+                > now
+            ):
+                # held by another replica
+                return False
+            acquired = spec.holder_identity != self.identity
+            spec.holder_identity = self.identity
+            spec.lease_duration_seconds = self.lease_duration
+            spec.renew_time = now
+            if acquired:
+                spec.acquire_time = now
+        else:
+            acquired = True
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=self.lease_name),
+                spec=client.V1LeaseSpec(
+                    holder_identity=self.identity,
+                    lease_duration_seconds=self.lease_duration,
+                    acquire_time=now,
+                    renew_time=now,
+                ),
+            )
+
+        try:
+            # conflicts with concurrent updates of other replicas,
+            # thanks to the resourceVersion of the Lease that was read
+            if lease.metadata.resource_version:
+                self.coordination.replace_namespaced_lease(
+                    self.lease_name,
+                    self.namespace,
+                    lease,
+                    _request_timeout=KUBE_REQUEST_TIMEOUT,
+                )
+            else:
+                self.coordination.create_namespaced_lease(
+                    self.namespace, lease, _request_timeout=KUBE_REQUEST_TIMEOUT
+                )
+        except client.rest.ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+
+        if acquired:
+            self.log.info("Updating prewarmed images from this replica")
+            # continue from the images prewarmed by the previous replica
+            self.prewarmed = self._read_prewarmed()
+        return True
+
+    def _read_prewarmed(self):
+        """The images of the current DaemonSet, in a thread"""
+        try:
+            daemonset = self.kube.read_namespaced_daemon_set(
+                self.daemonset_name,
+                self.namespace,
+                _request_timeout=KUBE_REQUEST_TIMEOUT,
+            )
+        except client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            return []
+        return [
+            container.image
+            for container in daemonset.spec.template.spec.init_containers or []
+        ]
+
+    async def acquire_lease(self):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._acquire_lease
+        )
+
+    def get_daemonset(self, images):
+        """The DaemonSet pulling `images`"""
+        labels = {"component": "image-prewarmer"}
+        image_pull_secrets = []
+        if self.image_pull_secret:
+            image_pull_secrets.append(
+                client.V1LocalObjectReference(name=self.image_pull_secret)
+            )
+        resources = client.V1ResourceRequirements(requests={"cpu": "0", "memory": "0"})
+        return client.V1DaemonSet(
+            metadata=client.V1ObjectMeta(name=self.daemonset_name, labels=labels),
+            spec=client.V1DaemonSetSpec(
+                selector=client.V1LabelSelector(match_labels=labels),
+                update_strategy=client.V1DaemonSetUpdateStrategy(
+                    type="RollingUpdate",
+                    rolling_update=client.V1RollingUpdateDaemonSet(
+                        max_unavailable=self.max_unavailable
+                    ),
+                ),
+                template=client.V1PodTemplateSpec(
+                    metadata=client.V1ObjectMeta(labels=labels),
+                    spec=client.V1PodSpec(
+                        init_containers=[
+                            client.V1Container(
+                                name=f"image-{i}",
+                                image=image,
+                                command=self.command,
+                                resources=resources,
+                            )
+                            # in a stable order, so that the pods are only
+                            # replaced when the prewarmed images change
+                            for i, image in enumerate(sorted(images))
+                        ],
+                        containers=[
+                            client.V1Container(
+                                name="pause",
+                                image=self.pause_image,
+                                resources=resources,
+                            )
+                        ],
+                        node_selector=self.node_selector,
+                        tolerations=self.tolerations,
+                        image_pull_secrets=image_pull_secrets,
+                        termination_grace_period_seconds=0,
+                        automount_service_account_token=False,
+                    ),
+                ),
+            ),
+        )
+
+    def _apply(self, images):
+        """Create, update or delete the DaemonSet, in a thread"""
+        if not images:
+            try:
+                self.kube.delete_namespaced_daemon_set(
+                    self.daemonset_name,
+                    self.namespace,
+                    _request_timeout=KUBE_REQUEST_TIMEOUT,
+                )
+            except client.rest.ApiException as e:
+                if e.status != 404:
+                    raise
+            return
+
+        daemonset = self.get_daemonset(images)
+        try:
+            self.kube.replace_namespaced_daemon_set(
+                self.daemonset_name,
+                self.namespace,
+                daemonset,
+                _request_timeout=KUBE_REQUEST_TIMEOUT,
+            )
+        except client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            self.kube.create_namespaced_daemon_set(
+                self.namespace, daemonset, _request_timeout=KUBE_REQUEST_TIMEOUT
+            )
+
+    async def prewarm(self, images):
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._apply, images
+        )
@@ -5,14 +5,17 @@ Singleuser server quotas
 import asyncio
 import json
 import os
-from collections import namedtuple
+import time
+import uuid
+from collections import Counter, OrderedDict, namedtuple
 
 import kubernetes.config
 from kubernetes import client
-from traitlets import Any, Integer, Unicode, default
+from traitlets import Any, Bool, Integer, Type, Unicode, default
 from traitlets.config import LoggingConfigurable
 
-from .utils import KUBE_REQUEST_TIMEOUT
+from .informer import PodInformer
+from .utils import KUBE_REQUEST_TIMEOUT, redis_from_url
 
 
 class LaunchQuotaExceeded(Exception):
@@ -32,7 +35,124 @@ class LaunchQuotaExceeded(Exception):
         self.status = status
 
 
-ServerQuotaCheck = namedtuple("ServerQuotaCheck", ["total", "matching", "quota"])
+ServerQuotaCheck = namedtuple(
+    "ServerQuotaCheck", ["total", "matching", "quota", "reservation"], defaults=[None]
+)
+
+QuotaReservation = namedtuple("QuotaReservation", ["id", "image"])
+
+
+class QuotaReservations(LoggingConfigurable):
+    """In-memory reservations of singleuser servers being launched
+
+    Reservations are taken when a launch passes the quota check,
+    and released when the server is counted (see LaunchQuota.assign),
+    when the launch has finished or after a timeout.
+    They are counted alongside running servers,
+    so a burst of launches can't all pass the quota check
+    before any of their servers exist.
+
+    Subclasses can store reservations elsewhere, to share them between replicas.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # id: (image, expiry), in order of expiry since the timeout is constant
+        self._reservations = OrderedDict()
+        self._image_counts = Counter()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._reservations:
+            reservation_id, (image, expiry) = next(iter(self._reservations.items()))
+            if expiry > now:
+                break
+            self._remove(reservation_id)
+
+    def _remove(self, reservation_id):
+        image, _ = self._reservations.pop(reservation_id)
+        self._image_counts[image] -= 1
+        if self._image_counts[image] <= 0:
+            del self._image_counts[image]
+
+    async def reserve(self, image, timeout):
+        """Reserve a server running `image` for `timeout` seconds
+
+        Returns `(reservation, total, matching)`:
+        the reservation, and the numbers of reservations in total
+        and for `image`, including the new one.
+        """
+        self._expire()
+        reservation = QuotaReservation(uuid.uuid4().hex, image)
+        self._reservations[reservation.id] = (image, time.monotonic() + timeout)
+        self._image_counts[image] += 1
+        return reservation, len(self._reservations), self._image_counts[image]
+
+    async def release(self, reservation):
+        """Release a reservation, once the server is running or has failed to start"""
+        if reservation.id in self._reservations:
+            self._remove(reservation.id)
+
+    async def count(self, image):
+        """Count the reservations in total and for `image`"""
+        self._expire()
+        return len(self._reservations), self._image_counts[image]
+
+
+class RedisQuotaReservations(QuotaReservations):
+    """Reservations of singleuser servers stored in Redis, shared between replicas
+
+    Requires the redis package.
+    """
+
+    redis_url = Unicode(
+        "redis://localhost:6379/0",
+        config=True,
+        help="URL of the Redis server storing reservations",
+    )
+
+    key_prefix = Unicode(
+        "binderhub:quota",
+        config=True,
+        help="Prefix of the Redis keys storing reservations",
+    )
+
+    redis = Any(help="redis.asyncio.Redis client")
+
+    @default("redis")
+    def _default_redis(self):
+        return redis_from_url(self.redis_url)
+
+    def _keys(self, image):
+        return f"{self.key_prefix}:total", f"{self.key_prefix}:image:{image}"
+
+    async def reserve(self, image, timeout):
+        reservation = QuotaReservation(uuid.uuid4().hex, image)
+        now = time.time()
+        # reservations are members of sorted sets scored by their expiry
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for key in self._keys(image):
+                pipe.zremrangebyscore(key, "-inf", now)
+                pipe.zadd(key, {reservation.id: now + timeout})
+                pipe.zcard(key)
+                # the whole set expires with its last reservation
+                pipe.expire(key, int(timeout) + 1)
+            results = await pipe.execute()
+        return reservation, results[2], results[6]
+
+    async def release(self, reservation):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for key in self._keys(reservation.image):
+                pipe.zrem(key, reservation.id)
+            await pipe.execute()
+
+    async def count(self, image):
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self._keys(image):
+                pipe.zcount(key, now, "+inf")
+            total, matching = await pipe.execute()
+        return total, matching
 
 
 class LaunchQuota(LoggingConfigurable):
@@ -53,7 +173,34 @@ class LaunchQuota(LoggingConfigurable):
         config=True,
     )
 
-    async def check_repo_quota(self, image_name, repo_config, repo_url):
+    reservations_class = Type(
+        QuotaReservations,
+        klass=QuotaReservations,
+        config=True,
+        help="""
+        The class storing reservations of servers being launched.
+
+        Use binderhub.quota.RedisQuotaReservations
+        to share reservations between BinderHub replicas.
+        """,
+    )
+
+    reservations = Any(help="QuotaReservations instance")
+
+    @default("reservations")
+    def _default_reservations(self):
+        return self.reservations_class(parent=self)
+
+    reservation_timeout = Integer(
+        600,
+        config=True,
+        help="""
+        Time (in seconds) after which the reservation of a launch is dropped,
+        if it hasn't been released because the launch finished.
+        """,
+    )
+
+    async def check_repo_quota(self, image_name, repo_config, repo_url, reserve=False):
         """
         Check whether launching a repository would exceed a quota.
 
@@ -62,6 +209,9 @@ class LaunchQuota(LoggingConfigurable):
         image_name: str
         repo_config: dict
         repo_url: str
+        reserve: bool
+            Reserve a server if the quota isn't exceeded,
+            the reservation must be released with `release()` after the launch.
 
         Returns
         -------
@@ -71,9 +221,28 @@ class LaunchQuota(LoggingConfigurable):
           - total servers
           - matching servers running image_name
           - quota
+          - reservation (None unless reserve is True)
         """
         return None
 
+    async def release(self, reservation):
+        """Release a reservation taken by `check_repo_quota`"""
+        await self.reservations.release(reservation)
+
+    def assign(self, reservation, username, server_name=""):
+        """Associate a reservation with the server it was taken for
+
+        Called with the name of the server once it is known, before it is spawned,
+        so that subclasses counting running servers can release the reservation
+        as soon as the server is counted, instead of counting it twice
+        until the launch has finished.
+        """
+        pass
+
+    def stop(self):
+        """Stop background tasks, called when BinderHub stops"""
+        pass
+
 
 class KubernetesLaunchQuota(LaunchQuota):
     api = Any(
@@ -94,7 +263,146 @@ class KubernetesLaunchQuota(LaunchQuota):
     def _default_namespace(self):
         return os.getenv("BUILD_NAMESPACE", "default")
 
-    async def check_repo_quota(self, image_name, repo_config, repo_url):
+    use_pod_informer = Bool(
+        True,
+        config=True,
+        help="""
+        Keep count of the running singleuser servers with a watch of their pods
+        in the background, instead of listing all pods for every quota check.
+        """,
+    )
+
+    pod_informer = Any(
+        None,
+        allow_none=True,
+        help="""
+        binderhub.informer.PodInformer watching singleuser server pods.
+
+        Created by the first quota check if `use_pod_informer` is True.
+        """,
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # pod name: set of images (without tag) of the pod
+        self._pod_images = {}
+        # image (without tag): number of pods running it
+        self._image_counts = Counter()
+        # (username, server name): pod name, for the pods of servers
+        self._server_pods = {}
+        # (username, server name): reservation of the server, until its pod exists
+        self._assigned = {}
+        self._assigned_keys = {}
+        self._informer_started = False
+
+    def _start_informer(self):
+        if self.pod_informer is None:
+            self.pod_informer = PodInformer(
+                parent=self,
+                api=self.api,
+                namespace=self.namespace,
+                label_selector="app=jupyterhub,component=singleuser-server",
+            )
+        self.pod_informer.add_listener(self._on_pod_event)
+        self.pod_informer.start()
+
+    def stop(self):
+        if self.pod_informer is not None:
+            self.pod_informer.stop()
+
+    @staticmethod
+    def _server_key(pod):
+        """(username, server name) of a pod, from the annotations of KubeSpawner"""
+        annotations = pod.metadata.annotations or {}
+        return (
+            annotations.get("hub.jupyter.org/username"),
+            annotations.get("hub.jupyter.org/servername", ""),
+        )
+
+    def _on_pod_event(self, event_type, pod):
+        """Update the counts of running pods"""
+        name = pod.metadata.name
+        for image in self._pod_images.pop(name, ()):
+            self._image_counts[image] -= 1
+            if self._image_counts[image] <= 0:
+                del self._image_counts[image]
+        key = self._server_key(pod)
+        if event_type == "DELETED":
+            if self._server_pods.get(key) == name:
+                del self._server_pods[key]
+            return
+        images = {
+            container.image.rsplit(":", 1)[0] for container in pod.spec.containers
+        }
+        self._pod_images[name] = images
+        for image in images:
+            self._image_counts[image] += 1
+        if key[0] is not None:
+            self._server_pods[key] = name
+            reservation = self._assigned.pop(key, None)
+            if reservation is not None:
+                self._assigned_keys.pop(reservation.id, None)
+                # the pod is counted now
+                self._release_soon(reservation)
+
+    def _release_soon(self, reservation):
+        future = asyncio.ensure_future(self.release(reservation))
+        future.add_done_callback(self._log_release_error)
+
+    def _log_release_error(self, future):
+        if future.exception():
+            self.log.error("Error releasing reservation: %s", future.exception())
+
+    def assign(self, reservation, username, server_name=""):
+        if self.pod_informer is None or not self._informer_started:
+            # pods aren't watched, the reservation is released after the launch
+            return
+        key = (username, server_name)
+        if key in self._server_pods:
+            self._release_soon(reservation)
+        else:
+            self._assigned[key] = reservation
+            self._assigned_keys[reservation.id] = key
+
+    async def release(self, reservation):
+        # forget reservations released by their launch before their pod exists
+        key = self._assigned_keys.pop(reservation.id, None)
+        if key is not None:
+            self._assigned.pop(key, None)
+        await super().release(reservation)
+
+    async def _count_pods(self, image_no_tag):
+        """Count the total number of pods, and the pods running `image_no_tag`"""
+        if self.use_pod_informer and not self._informer_started:
+            # only watch pods once quotas are actually used
+            self._informer_started = True
+            self._start_informer()
+        if self.pod_informer is not None and self.pod_informer.ready.is_set():
+            return len(self._pod_images), self._image_counts[image_no_tag]
+
+        # no up to date counts yet, list all pods
+        f = self.executor.submit(
+            self.api.list_namespaced_pod,
+            self.namespace,
+            label_selector="app=jupyterhub,component=singleuser-server",
+            _request_timeout=KUBE_REQUEST_TIMEOUT,
+            _preload_content=False,
+        )
+        resp = await asyncio.wrap_future(f)
+        pods = json.loads(resp.read())["items"]
+
+        matching_pods = 0
+        for pod in pods:
+            for container in pod["spec"]["containers"]:
+                # is the container running the same image as us?
+                # if so, count one for the current repo.
+                image = container["image"].rsplit(":", 1)[0]
+                if image == image_no_tag:
+                    matching_pods += 1
+                    break
+        return len(pods), matching_pods
+
+    async def check_repo_quota(self, image_name, repo_config, repo_url, reserve=False):
         # the image name (without tag) is unique per repo
         # use this to count the number of pods running with a given repo
         # if we added annotations/labels with the repo name via KubeSpawner
@@ -108,52 +416,59 @@ class KubernetesLaunchQuota(LaunchQuota):
 
         # Fetch info on currently running users *only* if quotas are set
         if pod_quota is not None or repo_quota:
-            matching_pods = 0
-
-            # TODO: run a watch to keep this up to date in the background
-            f = self.executor.submit(
-                self.api.list_namespaced_pod,
-                self.namespace,
-                label_selector="app=jupyterhub,component=singleuser-server",
-                _request_timeout=KUBE_REQUEST_TIMEOUT,
-                _preload_content=False,
-            )
-            resp = await asyncio.wrap_future(f)
-            pods = json.loads(resp.read())["items"]
-            total_pods = len(pods)
-
-            if pod_quota is not None and total_pods >= pod_quota:
-                # check overall quota first
-                self.log.error(f"BinderHub is full: {total_pods}/{pod_quota}")
-                raise LaunchQuotaExceeded(
-                    "Too many users on this BinderHub! Try again soon.",
-                    quota=pod_quota,
-                    used=total_pods,
-                    status="pod_quota",
+            reservation = None
+            if reserve:
+                # reserve before counting, so concurrent launches
+                # (also on other replicas) always see each other
+                reservation, reserved_total, reserved_matching = (
+                    await self.reservations.reserve(
+                        image_no_tag, self.reservation_timeout
+                    )
                 )
-
-            for pod in pods:
-                for container in pod["spec"]["containers"]:
-                    # is the container running the same image as us?
-                    # if so, count one for the current repo.
-                    image = container["image"].rsplit(":", 1)[0]
-                    if image == image_no_tag:
-                        matching_pods += 1
-                        break
-
-            if repo_quota and matching_pods >= repo_quota:
-                self.log.error(
-                    f"{repo_url} has exceeded quota: {matching_pods}/{repo_quota} ({total_pods} total)"
-                )
-                raise LaunchQuotaExceeded(
-                    f"Too many users running {repo_url}! Try again soon.",
-                    quota=repo_quota,
-                    used=matching_pods,
-                    status="repo_quota",
+                # don't count our own reservation
+                reserved_total -= 1
+                reserved_matching -= 1
+            else:
+                reserved_total, reserved_matching = await self.reservations.count(
+                    image_no_tag
                 )
 
+            try:
+                total_pods, matching_pods = await self._count_pods(image_no_tag)
+                # servers being launched count as running
+                total_pods += reserved_total
+                matching_pods += reserved_matching
+
+                if pod_quota is not None and total_pods >= pod_quota:
+                    # check overall quota first
+                    self.log.error(f"BinderHub is full: {total_pods}/{pod_quota}")
+                    raise LaunchQuotaExceeded(
+                        "Too many users on this BinderHub! Try again soon.",
+                        quota=pod_quota,
+                        used=total_pods,
+                        status="pod_quota",
+                    )
+
+                if repo_quota and matching_pods >= repo_quota:
+                    self.log.error(
+                        f"{repo_url} has exceeded quota: {matching_pods}/{repo_quota} ({total_pods} total)"
+                    )
+                    raise LaunchQuotaExceeded(
+                        f"Too many users running {repo_url}! Try again soon.",
+                        quota=repo_quota,
+                        used=matching_pods,
+                        status="repo_quota",
+                    )
+            except BaseException:
+                if reservation is not None:
+                    await self.release(reservation)
+                raise
+
             return ServerQuotaCheck(
-                total=total_pods, matching=matching_pods, quota=repo_quota
+                total=total_pods,
+                matching=matching_pods,
+                quota=repo_quota,
+                reservation=reservation,
             )
 
         return None
@@ -1,13 +1,26 @@
 """Rate limiting utilities"""
 
+import asyncio
+import math
 import time
+from collections import OrderedDict
+from functools import partial
 
-from traitlets import Dict, Float, Integer, default
+from traitlets import Any, Integer, Unicode, default
 from traitlets.config import LoggingConfigurable
 
+from .utils import redis_from_url
+
 
 class RateLimitExceeded(Exception):
-    """Exception raised when rate limit is exceeded"""
+    """Exception raised when rate limit is exceeded
+
+    `retry_after` is the number of seconds until the next request is allowed.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class RateLimiter(LoggingConfigurable):
@@ -21,15 +34,16 @@ class RateLimiter(LoggingConfigurable):
     If the rate limit is exhausted, a RateLimitExceeded exception is raised,
     otherwise a summary of the current rate limit remaining is returned.
 
-    Rate limits are reset to zero at the end of `period_seconds`,
-    not a sliding window,
-    so the entire rate limit can be consumed instantly
+    Each key has a token bucket holding up to `limit` requests,
+    refilled continuously at `limit` requests per `period_seconds`.
+    So `limit` requests can be made at once,
+    then requests are allowed at the refill rate.
     """
 
     period_seconds = Integer(
         3600,
         config=True,
-        help="""The rate limit window""",
+        help="""The time to refill an empty rate limit""",
     )
 
     limit = Integer(
@@ -38,59 +52,256 @@ class RateLimiter(LoggingConfigurable):
         help="""The number of requests to allow within period_seconds""",
     )
 
-    clean_seconds = Integer(
-        600,
+    authenticated_limit = Integer(
+        0,
         config=True,
-        help="""Interval on which to clean out old limits.
+        help="""
+        The number of requests to allow within period_seconds for each authenticated user
 
-        Avoids memory growth of unused limits
+        0 means no limit.
         """,
     )
 
-    _limits = Dict()
+    build_token_limit = Integer(
+        0,
+        config=True,
+        help="""
+        The number of requests to allow within period_seconds for requests with a valid build token,
+        per ip address.
+
+        0 means no limit.
+        """,
+    )
 
-    _last_cleaned = Float()
+    clean_seconds = Integer(
+        600,
+        config=True,
+        help="""
+        DEPRECATED: has no effect, unused limits are removed as they expire.
+        """,
+    )
 
-    @default("_last_cleaned")
-    def _default_last_cleaned(self):
-        return self.time()
+    # the maximum number of expired limits to remove on each increment,
+    # so that many limits expiring at once don't hold up a request
+    _max_evictions = 16
 
-    def _clean_limits(self):
-        now = self.time()
-        self._last_cleaned = now
-        self._limits = {
-            key: limit for key, limit in self._limits.items() if limit["reset"] > now
-        }
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # key: (tokens, updated), ordered by update time
+        self._limits = OrderedDict()
 
     @staticmethod
     def time():
         """Mostly here to enable override in tests"""
         return time.time()
 
-    def increment(self, key):
+    def _evict(self, now):
+        """Remove the least recently used limits, if they are full again"""
+        for _ in range(self._max_evictions):
+            if not self._limits:
+                return
+            key, (tokens, updated) = next(iter(self._limits.items()))
+            if updated + self.period_seconds > now:
+                # the oldest limit is still in use
+                return
+            del self._limits[key]
+
+    def increment(self, key, limit=None):
         """Check rate limit for a key
 
         key: key for recording rate limit. Each key tracks a different rate limit.
+        limit: the number of requests to allow within period_seconds,
+               `limit` if not specified.
         Returns: {"remaining": int_remaining, "reset": int_timestamp}
+                 where reset is the time the rate limit is fully refilled.
         Raises: RateLimitExceeded if the request would exceed the rate limit.
         """
-        now = int(self.time())
-        if now - self._last_cleaned > self.clean_seconds:
-            self._clean_limits()
-
-        if key not in self._limits or self._limits[key]["reset"] < now:
-            # no limit recorded, or reset expired
-            self._limits[key] = {
-                "remaining": self.limit,
-                "reset": now + self.period_seconds,
-            }
-        limit = self._limits[key]
-        # keep decrementing, so we have a track of excess requests
-        # which indicate abuse
-        limit["remaining"] -= 1
-        if limit["remaining"] < 0:
-            seconds_until_reset = int(limit["reset"] - now)
+        if limit is None:
+            limit = self.limit
+        now = self.time()
+        self._evict(now)
+
+        rate = limit / self.period_seconds
+        if key in self._limits:
+            tokens, updated = self._limits[key]
+            tokens = min(limit, tokens + (now - updated) * rate)
+            self._limits.move_to_end(key)
+        else:
+            tokens = limit
+
+        if tokens < 1:
+            self._limits[key] = (tokens, now)
+            retry_after = math.ceil((1 - tokens) / rate)
             raise RateLimitExceeded(
-                f"Rate limit exceeded (by {-limit['remaining']}) for {key!r}, reset in {seconds_until_reset}s."
+                f"Rate limit exceeded for {key!r}, next request allowed in {retry_after}s.",
+                retry_after=retry_after,
             )
-        return limit
+
+        tokens -= 1
+        self._limits[key] = (tokens, now)
+        return {
+            "remaining": int(tokens),
+            "reset": math.ceil(now + (limit - tokens) / rate),
+        }
+
+    async def async_increment(self, key, limit=None):
+        """Check rate limit for a key, same as `increment`
+
+        Used by BinderHub, so that subclasses can check limits in a shared store.
+        """
+        return self.increment(key, limit=limit)
+
+
+class RedisRateLimiter(RateLimiter):
+    """Rate limits stored in Redis, shared between BinderHub replicas
+
+    Each key has a token bucket in Redis, with the same semantics as RateLimiter:
+    up to `limit` requests at once, refilled at `limit` requests per `period_seconds`.
+    Buckets are updated with optimistic transactions (WATCH/MULTI).
+
+    To avoid a round trip to Redis for every request,
+    each replica claims a batch of tokens at a time, and spends them locally.
+    Concurrent requests for the same key share a single claim.
+    Tokens claimed but not spent by a replica within period_seconds are lost,
+    so batches are only used for limits much larger than the batch size.
+    Once a bucket is empty, requests are rejected locally
+    until it has refilled enough for the next request.
+
+    If Redis can't be reached, limits are checked locally (see RateLimiter).
+    Requires the redis package.
+    """
+
+    redis_url = Unicode(
+        "redis://localhost:6379/0",
+        config=True,
+        help="URL of the Redis server storing rate limits",
+    )
+
+    key_prefix = Unicode(
+        "binderhub:ratelimit:",
+        config=True,
+        help="Prefix of the Redis keys storing rate limits",
+    )
+
+    batch_size = Integer(
+        10,
+        config=True,
+        help="""
+        The maximum number of requests to claim from Redis at a time.
+
+        No more than a tenth of the limit is claimed at a time,
+        so limits under 20 requests are counted exactly.
+        """,
+    )
+
+    redis = Any(help="redis.asyncio.Redis client")
+
+    @default("redis")
+    def _default_redis(self):
+        return redis_from_url(self.redis_url)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # key: [claimed tokens, tokens left in Redis, retry_at, updated],
+        # ordered by update time
+        self._claims = OrderedDict()
+        # key: Future of the claim in progress
+        self._pending_claims = {}
+
+    def _evict_claims(self, now):
+        for _ in range(self._max_evictions):
+            if not self._claims:
+                return
+            key, claim = next(iter(self._claims.items()))
+            if claim[3] + self.period_seconds > now:
+                return
+            del self._claims[key]
+
+    async def _claim(self, key, limit):
+        """Claim up to batch_size tokens of the bucket of `key` in Redis
+
+        The tokens are added to the local claim of `key`.
+        """
+        from redis.exceptions import WatchError
+
+        batch = max(1, min(self.batch_size, limit // 10))
+        rate = limit / self.period_seconds
+        redis_key = f"{self.key_prefix}{key}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(redis_key)
+                    now = self.time()
+                    tokens, updated = await pipe.hmget(redis_key, "tokens", "updated")
+                    if tokens is None:
+                        # missing buckets are full
+                        tokens = limit
+                    else:
+                        refill = max(0, now - float(updated)) * rate
+                        tokens = min(limit, float(tokens) + refill)
+                    claimed = min(batch, int(tokens))
+                    tokens -= claimed
+                    pipe.multi()
+                    pipe.hset(redis_key, mapping={"tokens": tokens, "updated": now})
+                    # the bucket is full again by then
+                    pipe.expire(redis_key, self.period_seconds + 1)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    # updated by another replica, try again
+                    continue
+
+        claim = self._claims.get(key)
+        if claim is None:
+            claim = self._claims[key] = [0, 0, 0, now]
+        claim[0] += claimed
+        claim[1] = tokens
+        claim[3] = now
+        if not claimed:
+            # the time when the bucket has a token for the next request
+            claim[2] = now + (1 - tokens) / rate
+        self._claims.move_to_end(key)
+
+    def _claim_done(self, key, future):
+        if self._pending_claims.get(key) is future:
+            del self._pending_claims[key]
+
+    async def async_increment(self, key, limit=None):
+        if limit is None:
+            limit = self.limit
+        rate = limit / self.period_seconds
+        while True:
+            now = self.time()
+            self._evict_claims(now)
+            claim = self._claims.get(key)
+            if claim is not None:
+                if claim[0] >= 1:
+                    claim[0] -= 1
+                    # tokens claimed by other replicas are unknown,
+                    # so this may be too many
+                    remaining = int(claim[0] + claim[1])
+                    return {
+                        "remaining": remaining,
+                        "reset": math.ceil(now + (limit - remaining) / rate),
+                    }
+                if claim[2] > now:
+                    retry_after = math.ceil(claim[2] - now)
+                    raise RateLimitExceeded(
+                        f"Rate limit exceeded for {key!r}, next request allowed in {retry_after}s.",
+                        retry_after=retry_after,
+                    )
+
+            # claim more tokens, once for all the concurrent requests of the key
+            future = self._pending_claims.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._claim(key, limit))
+                self._pending_claims[key] = future
+                future.add_done_callback(partial(self._claim_done, key))
+            try:
+                # don't cancel the claim shared with other requests
+                await asyncio.shield(future)
+            except Exception as e:
+                self.log.error(
+                    "Error checking rate limit in Redis, checking locally: %s", e
+                )
+                return self.increment(key, limit=limit)
@@ -0,0 +1,158 @@
+"""
+Caches of resolved refs, shared by all repo providers
+"""
+
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from traitlets import Any, Integer, Unicode, default
+from traitlets.config import LoggingConfigurable
+
+from .utils import redis_from_url
+
+
+class RefCache(LoggingConfigurable):
+    """In-memory LRU cache of resolved refs
+
+    Values are JSON-serializable dicts, stored with a time to live.
+    Subclasses store values elsewhere, to keep them across restarts
+    or share them between BinderHub replicas.
+    """
+
+    max_size = Integer(
+        4096,
+        config=True,
+        help="Maximum number of entries to keep in memory",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # key: (value, expiry)
+        self._entries = OrderedDict()
+
+    def _now(self):
+        return time.monotonic()
+
+    async def get(self, key):
+        """Get the value stored for `key`, None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry < self._now():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        """Store `value` for `key`, for `ttl` seconds"""
+        self._entries[key] = (value, self._now() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key):
+        """Forget the value stored for `key`"""
+        self._entries.pop(key, None)
+
+
+class SQLiteRefCache(RefCache):
+    """Cache of resolved refs in a sqlite database, kept across restarts
+
+    Lookups are made on the event loop, they only touch a small local file.
+    """
+
+    path = Unicode(
+        "binderhub-refs.sqlite",
+        config=True,
+        help="Path of the sqlite database",
+    )
+
+    prune_interval = Integer(
+        300,
+        config=True,
+        help="Interval (in seconds) for how often expired refs are deleted",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS refs"
+            " (key TEXT PRIMARY KEY, value TEXT NOT NULL, expiry REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS refs_expiry ON refs (expiry)")
+        self._pruned = 0
+
+    def _now(self):
+        # stored across restarts, so use wall time
+        return time.time()
+
+    async def get(self, key):
+        row = self.db.execute(
+            "SELECT value FROM refs WHERE key = ? AND expiry >= ?", (key, self._now())
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    async def set(self, key, value, ttl):
+        now = self._now()
+        self.db.execute(
+            "INSERT OR REPLACE INTO refs (key, value, expiry) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl),
+        )
+        if now - self._pruned >= self.prune_interval:
+            # keep the database from growing forever
+            self._pruned = now
+            self.db.execute("DELETE FROM refs WHERE expiry < ?", (now,))
+
+    async def delete(self, key):
+        self.db.execute("DELETE FROM refs WHERE key = ?", (key,))
+
+
+class RedisRefCache(RefCache):
+    """Cache of resolved refs in Redis, shared between BinderHub replicas
+
+    Requires the redis package.
+    """
+
+    redis_url = Unicode(
+        "redis://localhost:6379/0",
+        config=True,
+        help="URL of the Redis server",
+    )
+
+    key_prefix = Unicode(
+        "binderhub:refs:",
+        config=True,
+        help="Prefix of the Redis keys",
+    )
+
+    redis = Any(help="redis.asyncio.Redis client")
+
+    @default("redis")
+    def _default_redis(self):
+        return redis_from_url(self.redis_url)
+
+    async def get(self, key):
+        value = await self.redis.get(self.key_prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, key, value, ttl):
+        # redis expiry has a resolution of milliseconds
+        await self.redis.set(
+            self.key_prefix + key, json.dumps(value), px=max(int(ttl * 1000), 1)
+        )
+
+    async def delete(self, key):
+        await self.redis.delete(self.key_prefix + key)
@@ -2,20 +2,33 @@
 Interaction with the Docker Registry
 """
 
+import asyncio
 import base64
 import json
 import os
 import re
+import time
+from datetime import datetime
 from urllib.parse import urlparse
 
 from tornado import httpclient
 from tornado.httputil import url_concat
-from traitlets import Bool, Dict, Unicode, default
+from traitlets import Any, Bool, Dict, Integer, Unicode, default
 from traitlets.config import LoggingConfigurable
 
+from .utils import Cache
+
 DEFAULT_DOCKER_REGISTRY_URL = "https://registry-1.docker.io"
 DEFAULT_DOCKER_AUTH_URL = "https://index.docker.io/v1/"
 
+# accepted manifest types, images may be single or multi-platform
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
 
 class DockerRegistry(LoggingConfigurable):
     url = Unicode(
@@ -206,6 +219,132 @@ class DockerRegistry(LoggingConfigurable):
         # instead of returning 404
         return self.url.endswith(".docker.io")
 
+    image_cache_ttl = Integer(
+        24 * 60 * 60,
+        config=True,
+        help="""
+        Time (in seconds) to remember that an image exists in the registry.
+
+        Image tags are resolved refs, so an image doesn't change once pushed.
+        Set to 0 to check the registry on every launch.
+        """,
+    )
+
+    image_cache_negative_ttl = Integer(
+        10,
+        config=True,
+        help="""
+        Time (in seconds) to remember that an image doesn't exist in the registry.
+
+        Images built by this BinderHub are forgotten as soon as they are built,
+        this only delays noticing images pushed by other replicas.
+        """,
+    )
+
+    image_cache_size = Integer(
+        4096,
+        config=True,
+        help="Maximum number of images to remember",
+    )
+
+    http_client = Any(help="""
+        Client for requests to the registry, e.g. a binderhub.http_client.PooledHTTPClient.
+
+        Set by BinderHub, defaults to the shared AsyncHTTPClient.
+        """)
+
+    @default("http_client")
+    def _default_http_client(self):
+        return httpclient.AsyncHTTPClient()
+
+    check_images_concurrency = Integer(
+        16,
+        config=True,
+        help="Maximum number of concurrent registry requests made by check_images",
+    )
+
+    token_refresh_margin = Integer(
+        30,
+        config=True,
+        help="""
+        Time (in seconds) before a registry token expires to request a new one.
+
+        Tokens are cached until they expire,
+        and refreshed in the background when they are about to.
+        """,
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (token_url, service, scope): (token, refresh_at, expires_at)
+        self._tokens = Cache(1024)
+        # (token_url, service, scope): Future of a token request in progress
+        self._token_requests = {}
+        self._images_found = Cache(self.image_cache_size, max_age=self.image_cache_ttl)
+        self._images_missing = Cache(
+            self.image_cache_size, max_age=self.image_cache_negative_ttl
+        )
+
+    async def image_exists(self, image, tag):
+        """
+        Whether an image exists in the registry, cached.
+
+        image: The image name without the registry and tag
+        tag: The image tag
+        """
+        key = f"{image}:{tag}"
+        if self._images_found.get(key):
+            self.log.debug("Image cache hit for %s", key)
+            return True
+        if self._images_missing.get(key):
+            self.log.debug("Image cache hit for missing %s", key)
+            return False
+
+        exists = await self._image_exists(image, tag)
+        if exists and self.image_cache_ttl:
+            self._images_found.set(key, True)
+        elif not exists and self.image_cache_negative_ttl:
+            self._images_missing.set(key, True)
+        return exists
+
+    def invalidate_image(self, image, tag):
+        """Forget whether an image exists, e.g. after building it"""
+        key = f"{image}:{tag}"
+        for cache in (self._images_found, self._images_missing):
+            if key in cache:
+                cache.pop(key)
+
+    async def _check_image(self, image, tag):
+        """Whether an image exists, for check_images"""
+        return await self.image_exists(image, tag)
+
+    async def check_images(self, images):
+        """
+        Check whether many images exist in the registry, e.g. to warm caches.
+
+        images: iterable of (image, tag), with the image name without the registry
+
+        Returns a dict {(image, tag): exists},
+        where exists is None if the image couldn't be checked.
+        At most check_images_concurrency requests are made at the same time,
+        images of the same repository share a registry token.
+        """
+        semaphore = asyncio.Semaphore(self.check_images_concurrency)
+        results = {}
+
+        async def check(image, tag):
+            async with semaphore:
+                try:
+                    results[(image, tag)] = await self._check_image(image, tag)
+                except Exception as e:
+                    self.log.error("Failed to check image %s:%s: %s", image, tag, e)
+                    results[(image, tag)] = None
+
+        await asyncio.gather(
+            *(check(image, tag) for image, tag in dict.fromkeys(images))
+        )
+        return results
+
     def _parse_www_authenticate_header(self, header):
         # Header takes the form
         # WWW-Authenticate: Bearer realm="https://uk-london-1.ocir.io/12345678/docker/token",service="uk-london-1.ocir.io",scope=""
@@ -224,7 +363,89 @@ class DockerRegistry(LoggingConfigurable):
                 f"Expected WWW-Authenticate to include realm service scope: {header}"
             ) from None
 
+    def _now(self):
+        return time.monotonic()
+
     async def _get_token(self, client, token_url, service, scope):
+        """Get a token for `scope`, cached until it expires
+
+        Tokens about to expire are refreshed in the background,
+        a single request at a time for each scope.
+        """
+        key = (token_url, service, scope)
+        cached = self._tokens.get(key)
+        if cached:
+            token, refresh_at, expires_at = cached
+            now = self._now()
+            if now < refresh_at:
+                return token
+            if now < expires_at:
+                self._refresh_token(client, key)
+                return token
+        return await asyncio.shield(self._refresh_token(client, key))
+
+    def _refresh_token(self, client, key):
+        """Request a new token for `key`, unless already requested
+
+        Returns the Future of the new token.
+        """
+        future = self._token_requests.get(key)
+        if future is not None:
+            return future
+
+        async def refresh():
+            token, expires_in = await self._request_token(client, *key)
+            now = self._now()
+            # refresh tokens before they expire,
+            # but not before half their lifetime for short-lived tokens
+            margin = min(self.token_refresh_margin, expires_in / 2)
+            self._tokens.set(key, (token, now + expires_in - margin, now + expires_in))
+            return token
+
+        def _done(f):
+            if self._token_requests.get(key) is f:
+                del self._token_requests[key]
+            if not f.cancelled() and f.exception():
+                # nobody may be waiting for a background refresh
+                self.log.error("Failed to get registry token for %s", key[2])
+
+        future = self._token_requests[key] = asyncio.ensure_future(refresh())
+        future.add_done_callback(_done)
+        return future
+
+    def _forget_token(self, token_url, service, scope):
+        """Forget the cached token for scope, e.g. when it is rejected"""
+        key = (token_url, service, scope)
+        if key in self._tokens:
+            self._tokens.pop(key)
+
+    def _token_expires_in(self, response_body):
+        """The number of seconds until the token in a token response expires"""
+        # the token is valid for 60 seconds if not specified
+        # https://distribution.github.io/distribution/spec/auth/token/#token-response-fields
+        expires_in = int(response_body.get("expires_in") or 60)
+        issued_at = response_body.get("issued_at")
+        if issued_at:
+            # RFC3339, e.g. 2009-11-10T23:00:00.123456789Z
+            # fromisoformat doesn't support nanoseconds or Z on Python < 3.11
+            issued_at = re.sub(r"(\.\d{6})\d+", r"\1", issued_at)
+            issued_at = re.sub(r"Z$", "+00:00", issued_at)
+            try:
+                issued_at = datetime.fromisoformat(issued_at)
+            except ValueError:
+                self.log.debug("Ignoring unparseable issued_at %r", issued_at)
+            else:
+                if issued_at.tzinfo is not None:
+                    age = time.time() - issued_at.timestamp()
+                    # don't trust clocks too much
+                    expires_in -= min(max(age, 0), expires_in / 2)
+        return expires_in
+
+    async def _request_token(self, client, token_url, service, scope):
+        """Request a token from the token server
+
+        Returns (token, expires_in)
+        """
         auth_req = httpclient.HTTPRequest(
             url_concat(
                 token_url,
@@ -248,54 +469,68 @@ class DockerRegistry(LoggingConfigurable):
             token = response_body["access_token"]
         else:
             raise ValueError(f"No token in response from registry: {response_body}")
-        return token
+        return token, self._token_expires_in(response_body)
 
-    async def _get_image_manifest_from_www_authenticate(
-        self, client, www_auth_header, url
+    async def _fetch_manifest_from_www_authenticate(
+        self, client, www_auth_header, url, method, headers, retry=True
     ):
         realm, service, scope = self._parse_www_authenticate_header(www_auth_header)
+        cached = (realm, service, scope) in self._tokens
         token = await self._get_token(client, realm, service, scope)
         req = httpclient.HTTPRequest(
             url,
-            headers={"Authorization": f"Bearer {token}"},
+            method=method,
+            headers=headers | {"Authorization": f"Bearer {token}"},
         )
         self.log.debug(f"Getting image manifest from {url}")
         try:
             resp = await client.fetch(req)
         except httpclient.HTTPError as e:
+            if e.code == 401 and cached and retry:
+                # the cached token may have been revoked, retry with a new one
+                self._forget_token(realm, service, scope)
+                return await self._fetch_manifest_from_www_authenticate(
+                    client, www_auth_header, url, method, headers, retry=False
+                )
             if e.code == 404:
                 return None
             else:
                 raise
-        return json.loads(resp.body.decode("utf-8"))
+        return resp
 
-    async def get_image_manifest(self, image, tag):
+    async def _fetch_manifest(self, image, tag, method="GET", accept=None, retry=True):
         """
-        Get the manifest for an image.
+        Request the manifest of an image.
 
-        image: The image name without the registry and tag
-        tag: The image tag
+        Returns the response, or None if the image doesn't exist.
+        A cached token rejected with a 401 is forgotten,
+        and the request is retried once with a new token if `retry`.
         """
-        client = httpclient.AsyncHTTPClient()
+        client = self.http_client
         url = f"{self.url}/v2/{image}/manifests/{tag}"
         token = None
-        headers = {"Accept": "application/vnd.oci.image.manifest.v1+json"}
+        cached = False
+        headers = {"Accept": accept or "application/vnd.oci.image.manifest.v1+json"}
         # first, get a token to perform the manifest request
         if self.token_url:
+            scope = f"repository:{image}:pull"
+            cached = (self.token_url, "container_registry", scope) in self._tokens
             token = await self._get_token(
                 client,
                 self.token_url,
-                scope=f"repository:{image}:pull",
+                scope=scope,
                 service="container_registry",
             )
             req = httpclient.HTTPRequest(
                 url,
+                method=method,
                 headers=headers | {"Authorization": f"Bearer {token}"},
             )
         else:
             # Use basic HTTP auth (htpasswd)
             req = httpclient.HTTPRequest(
                 url,
+                method=method,
                 headers=headers,
                 auth_username=self.username,
                 auth_password=self.password,
@@ -305,6 +540,16 @@ class DockerRegistry(LoggingConfigurable):
         try:
             resp = await client.fetch(req)
         except httpclient.HTTPError as e:
+            if e.code == 401 and cached and retry:
+                # the cached token may have been revoked, retry with a new one
+                self._forget_token(
+                    self.token_url,
+                    scope=f"repository:{image}:pull",
+                    service="container_registry",
+                )
+                return await self._fetch_manifest(
+                    image, tag, method=method, accept=accept, retry=False
+                )
             if e.code == 404:
                 # 404 means it doesn't exist
                 return None
@@ -325,13 +570,37 @@ class DockerRegistry(LoggingConfigurable):
                 # information from the WWW-Authenticate header
                 # https://stackoverflow.com/questions/56193110/how-can-i-use-docker-registry-http-api-v2-to-obtain-a-list-of-all-repositories-i/68654659#68654659
                 www_auth_header = e.response.headers["www-authenticate"]
-                return await self._get_image_manifest_from_www_authenticate(
-                    client, www_auth_header, url
+                return await self._fetch_manifest_from_www_authenticate(
+                    client, www_auth_header, url, method, headers
                 )
             else:
                 raise
+        return resp
+
+    async def get_image_manifest(self, image, tag):
+        """
+        Get the manifest for an image.
+
+        image: The image name without the registry and tag
+        tag: The image tag
+        """
+        resp = await self._fetch_manifest(image, tag)
+        if resp is None:
+            return None
         return json.loads(resp.body.decode("utf-8"))
 
+    async def _image_exists(self, image, tag):
+        """
+        Check whether an image exists with a HEAD request,
+        without downloading its manifest.
+
+        HEAD requests don't count against the Docker Hub pull rate limit.
+        """
+        resp = await self._fetch_manifest(
+            image, tag, method="HEAD", accept=", ".join(MANIFEST_MEDIA_TYPES)
+        )
+        return resp is not None
+
     async def get_credentials(self, image, tag):
         """
         If a dynamic token is required for pushing an image to the registry
@@ -355,7 +624,7 @@ class GoogleArtifactRegistry(DockerRegistry):
     def _default_token_url(self):
         return "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
 
-    async def _get_token(self, client, token_url, service, scope):
+    async def _request_token(self, client, token_url, service, scope):
         auth_req = httpclient.HTTPRequest(
             token_url, headers={"Metadata-Flavor": "Google"}
         )
@@ -367,7 +636,7 @@ class GoogleArtifactRegistry(DockerRegistry):
             token = response_body["access_token"]
         else:
             raise ValueError(f"No token in response from registry: {response_body}")
-        return token
+        return token, self._token_expires_in(response_body)
 
 
 class FakeRegistry(DockerRegistry):
@@ -378,6 +647,9 @@ class FakeRegistry(DockerRegistry):
     async def get_image_manifest(self, image, tag):
         return None
 
+    async def _image_exists(self, image, tag):
+        return False
+
 
 class ExternalRegistryHelper(DockerRegistry):
     """
@@ -401,7 +673,7 @@ class ExternalRegistryHelper(DockerRegistry):
     )
 
     async def _request(self, endpoint, **kwargs):
-        client = httpclient.AsyncHTTPClient()
+        client = self.http_client
         repo_url = f"{self.service_url}{endpoint}"
         headers = {"Authorization": f"Bearer {self.auth_token}"}
         repo = await client.fetch(repo_url, headers=headers, **kwargs)
@@ -453,6 +725,14 @@ class ExternalRegistryHelper(DockerRegistry):
             await self._request(repo_url, method="POST", body="")
             return None
 
+    async def _image_exists(self, image, tag):
+        # the registry helper creates missing repositories, ready for the build
+        return bool(await self.get_image_manifest(image, tag))
+
+    async def _check_image(self, image, tag):
+        # only checked, don't create missing repositories
+        return bool(await self._get_image(image, tag))
+
     async def get_credentials(self, image, tag):
         """
         Get the registry credentials for the given image and tag if supported
@@ -9,6 +9,7 @@ control services and providers.
 """
 
 import asyncio
+import functools
 import json
 import os
 import re
@@ -21,7 +22,7 @@ import escapism
 from prometheus_client import Gauge
 from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
 from tornado.httputil import url_concat
-from traitlets import Bool, Dict, List, Set, Unicode, default
+from traitlets import Any, Bool, Dict, Integer, List, Set, Unicode, default
 from traitlets.config import LoggingConfigurable
 
 from .utils import Cache
@@ -52,6 +53,166 @@ def strip_suffix(text, suffix):
     return text
 
 
+class SpecMatcher:
+    """Match specs against a list of regex patterns, compiled once
+
+    Patterns match at the start of the spec (like re.match), ignoring case,
+    because most git providers do not count DS-100/textbook
+    as different from ds-100/textbook.
+    Results are memoized for recently matched specs.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+        self._combined = None
+        # numbered backreferences and conditional group references
+        # would refer to the wrong group when combined,
+        # and inline flags would apply to all the patterns
+        if patterns and not any(
+            re.search(r"\\\d|\(\?[aiLmsux]+\)|\(\?\(", p) for p in patterns
+        ):
+            try:
+                self._combined = re.compile(
+                    "|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE
+                )
+            except re.error:
+                # e.g. the same group name in two patterns
+                pass
+        self._matches = Cache(4096)
+        self._matching = Cache(4096)
+
+    def matches(self, spec):
+        """Whether any of the patterns matches spec"""
+        result = self._matches.get(spec)
+        if result is None:
+            if self._combined is not None:
+                result = self._combined.match(spec) is not None
+            else:
+                result = any(pattern.match(spec) for pattern in self.patterns)
+            self._matches.set(spec, result)
+        return result
+
+    def matching(self, spec):
+        """The indices of the patterns matching spec"""
+        result = self._matching.get(spec)
+        if result is None:
+            if self._combined is not None and not self.matches(spec):
+                result = ()
+            else:
+                result = tuple(
+                    i for i, pattern in enumerate(self.patterns) if pattern.match(spec)
+                )
+            self._matching.set(spec, result)
+        return result
+
+
+class ProviderSpecMatchers:
+    """SpecMatchers of the banned_specs, allowed_specs, high_quota_specs
+    and spec_config of a provider
+
+    Built once per config, and shared by all the requests using it.
+    """
+
+    def __init__(self, banned_specs, allowed_specs, high_quota_specs, spec_config):
+        for item in spec_config:
+            if not isinstance(item, dict):
+                raise ValueError(
+                    "Spec-pattern configuration expected "
+                    f"a dict with a pattern and a config, not {item!r}"
+                )
+            pattern = item.get("pattern", None)
+            config = item.get("config", None)
+            if not isinstance(pattern, str):
+                raise ValueError(
+                    "Spec-pattern configuration expected "
+                    "a regex pattern string, not "
+                    f"type {type(pattern)}"
+                )
+            if not isinstance(config, dict):
+                raise ValueError(
+                    "Spec-pattern configuration expected "
+                    "a specification configuration dict, not "
+                    f"type {type(config)}"
+                )
+        self.banned = SpecMatcher(banned_specs)
+        # allowed_specs unspecified or empty: everything not banned is allowed
+        self.allowed = SpecMatcher(allowed_specs) if allowed_specs else None
+        self.high_quota = SpecMatcher(high_quota_specs)
+        self.spec_config = [item["config"] for item in spec_config]
+        self.spec_config_patterns = SpecMatcher(
+            [item["pattern"] for item in spec_config]
+        )
+
+
+# ref cache key: Future of the ref being resolved, shared by concurrent requests
+_resolving_refs = {}
+
+
+def cached_ref(get_resolved_ref):
+    """Cache the result of `RepoProvider.get_resolved_ref` in the provider's ref_cache
+
+    The attributes listed in `_resolved_attrs`, which are set while resolving
+    the ref and used later on (e.g. in `get_build_slug`), are cached along with it.
+
+    Concurrent resolutions of the same ref wait for a single call
+    to the provider, e.g. when a popular badge is clicked by many users at once.
+    """
+
+    async def resolve(self, key):
+        """Resolve the ref, returning a ref cache entry
+
+        {"ref": resolved_ref, "attrs": {name: value}}
+        """
+        use_cache = self.ref_cache is not None and self.ref_cache_ttl
+        if use_cache:
+            cached = await self._ref_cache_get(key)
+            if cached is not None:
+                self.log.debug("Ref cache hit for %s: %s", key, cached["ref"])
+                return cached
+
+        ref = await get_resolved_ref(self)
+        entry = {
+            "ref": ref,
+            "attrs": {
+                name: getattr(self, name)
+                for name in self._resolved_attrs
+                if hasattr(self, name)
+            },
+        }
+        if use_cache:
+            if ref is None:
+                # cache refs that don't exist for a shorter time, they may be created
+                ttl = self.ref_cache_negative_ttl
+            else:
+                ttl = self.ref_cache_ttl
+            if ttl:
+                await self._ref_cache_set(key, entry, ttl)
+        return entry
+
+    @functools.wraps(get_resolved_ref)
+    async def wrapper(self):
+        key = self.ref_cache_key()
+        future = _resolving_refs.get(key)
+        if future is None:
+            future = _resolving_refs[key] = asyncio.ensure_future(resolve(self, key))
+
+            def _forget(f):
+                if _resolving_refs.get(key) is f:
+                    del _resolving_refs[key]
+
+            future.add_done_callback(_forget)
+        else:
+            self.log.debug("Waiting for the resolution of %s in progress", key)
+
+        # shielded, so a request going away doesn't cancel the others
+        entry = await asyncio.shield(future)
+        for name, value in entry["attrs"].items():
+            setattr(self, name, value)
+        return entry["ref"]
+
+    return wrapper
+
+
 class RepoProvider(LoggingConfigurable):
     """Base class for a repo provider"""
 
@@ -114,10 +275,90 @@ class RepoProvider(LoggingConfigurable):
         config=True,
     )
 
+    spec_matchers = Any(help="""
+        ProviderSpecMatchers of banned_specs, allowed_specs, high_quota_specs
+        and spec_config.
+
+        Set by BinderHub with `build_spec_matchers`, once per config,
+        built from the provider's own config by default.
+        """)
+
+    @default("spec_matchers")
+    def _default_spec_matchers(self):
+        return ProviderSpecMatchers(
+            self.banned_specs,
+            self.allowed_specs,
+            self.high_quota_specs,
+            self.spec_config,
+        )
+
+    @classmethod
+    def build_spec_matchers(cls, config):
+        """Build the ProviderSpecMatchers of the provider's patterns in `config`"""
+        values = {}
+        # sections of the parent classes first, like traitlets
+        for section in cls.section_names():
+            if section in config:
+                values.update(config[section])
+        return ProviderSpecMatchers(
+            values.get("banned_specs", []),
+            values.get("allowed_specs", []),
+            values.get("high_quota_specs", []),
+            values.get("spec_config", []),
+        )
+
     unresolved_ref = Unicode()
 
     display_config = {}
 
+    http_client = Any(help="""
+        Client for requests to the repository provider, e.g. a binderhub.http_client.PooledHTTPClient.
+
+        Set by BinderHub, defaults to the shared AsyncHTTPClient.
+        """)
+
+    @default("http_client")
+    def _default_http_client(self):
+        return AsyncHTTPClient()
+
+    ref_cache = Any(
+        None,
+        allow_none=True,
+        help="""
+        binderhub.refcache.RefCache storing resolved refs, shared by all providers.
+
+        Set by BinderHub, resolved refs are not cached if None.
+        """,
+    )
+
+    ref_cache_ttl = Integer(
+        0,
+        config=True,
+        help="""
+        Time (in seconds) to cache resolved refs.
+
+        Within this time, a branch or tag resolves to the same commit
+        without asking the provider, so new commits aren't launched
+        until the cached ref expires.
+        0 (the default) disables caching.
+        """,
+    )
+
+    ref_cache_negative_ttl = Integer(
+        5,
+        config=True,
+        help="""
+        Time (in seconds) to cache refs that could not be resolved,
+        e.g. missing repositories or branches, when refs are cached.
+
+        Keep it short, so that newly created repositories or branches
+        can be launched right away.
+        """,
+    )
+
+    # attributes set by get_resolved_ref, cached along with the resolved ref
+    _resolved_attrs = ()
+
     git_credentials = Unicode(
         "",
         help="""
@@ -131,17 +372,11 @@ class RepoProvider(LoggingConfigurable):
         Return true if the given spec has been banned or explicitly
         not allowed.
         """
-        for banned in self.banned_specs:
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(banned, self.spec, re.IGNORECASE):
-                return True
-        if self.allowed_specs and len(self.allowed_specs):
-            for allowed in self.allowed_specs:
-                if re.match(allowed, self.spec, re.IGNORECASE):
-                    return False
-            # allowed_specs is not empty but spec is not in it: banned.
+        if self.spec_matchers.banned.matches(self.spec):
             return True
+        if self.spec_matchers.allowed is not None:
+            # allowed_specs is not empty: banned if spec is not in it
+            return not self.spec_matchers.allowed.matches(self.spec)
         # allowed_specs unspecified or empty and spec does not match
         # banned_specs: not banned.
         return False
@@ -150,12 +385,7 @@ class RepoProvider(LoggingConfigurable):
         """
         Return true if the given spec has a higher quota
         """
-        for higher_quota in self.high_quota_specs:
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(higher_quota, self.spec, re.IGNORECASE):
-                return True
-        return False
+        return self.spec_matchers.high_quota.matches(self.spec)
 
     def repo_config(self, settings):
         """
@@ -170,30 +400,32 @@ class RepoProvider(LoggingConfigurable):
             repo_config["quota"] = settings.get("per_repo_quota")
 
         # Spec regex-based configuration
-        for item in self.spec_config:
-            pattern = item.get("pattern", None)
-            config = item.get("config", None)
-            if not isinstance(pattern, str):
-                raise ValueError(
-                    "Spec-pattern configuration expected "
-                    "a regex pattern string, not "
-                    f"type {type(pattern)}"
-                )
-            if not isinstance(config, dict):
-                raise ValueError(
-                    "Spec-pattern configuration expected "
-                    "a specification configuration dict, not "
-                    f"type {type(config)}"
-                )
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(pattern, self.spec, re.IGNORECASE):
-                repo_config.update(config)
+        matchers = self.spec_matchers
+        for i in matchers.spec_config_patterns.matching(self.spec):
+            repo_config.update(matchers.spec_config[i])
         return repo_config
 
     async def get_resolved_ref(self):
         raise NotImplementedError("Must be overridden in child class")
 
+    def ref_cache_key(self):
+        """Key of the resolved ref in the ref cache"""
+        return f"{self.__class__.__name__}:{self.get_repo_url()}:{self.spec}"
+
+    async def _ref_cache_get(self, key):
+        try:
+            return await self.ref_cache.get(key)
+        except Exception:
+            # a broken cache shouldn't stop refs from being resolved
+            self.log.exception("Error getting %s from the ref cache", key)
+            return None
+
+    async def _ref_cache_set(self, key, value, ttl):
+        try:
+            await self.ref_cache.set(key, value, ttl)
+        except Exception:
+            self.log.exception("Error storing %s in the ref cache", key)
+
     async def get_resolved_spec(self):
         """Return the spec with resolved ref."""
         raise NotImplementedError("Must be overridden in child class")
@@ -258,6 +490,8 @@ class ZenodoProvider(RepoProvider):
 
     name = Unicode("Zenodo")
 
+    _resolved_attrs = ("record_id",)
+
     display_config = {
         "displayName": "Zenodo DOI",
         "id": "zenodo",
@@ -270,8 +504,9 @@ class ZenodoProvider(RepoProvider):
         "ref": {"enabled": False},
     }
 
+    @cached_ref
     async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
+        client = self.http_client
         req = HTTPRequest(f"https://doi.org/{self.spec}", user_agent="BinderHub")
         r = await client.fetch(req)
         self.record_id = r.effective_url.rsplit("/", maxsplit=1)[1]
@@ -308,6 +543,8 @@ class FigshareProvider(RepoProvider):
 
     name = Unicode("Figshare")
 
+    _resolved_attrs = ("record_id",)
+
     display_config = {
         "displayName": "FigShare DOI",
         "id": "figshare",
@@ -320,8 +557,9 @@ class FigshareProvider(RepoProvider):
         "ref": {"enabled": False},
     }
 
+    @cached_ref
     async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
+        client = self.http_client
         req = HTTPRequest(f"https://doi.org/{self.spec}", user_agent="BinderHub")
         # fetch doi: will 404 if it doesn't exist
         r = await client.fetch(req)
@@ -382,6 +620,8 @@ class FigshareProvider(RepoProvider):
 class DataverseProvider(RepoProvider):
     name = Unicode("Dataverse")
 
+    _resolved_attrs = ("identifier", "record_id", "resolved_spec", "resolved_ref_url")
+
     display_config = {
         "displayName": "Dataverse DOI",
         "id": "dataverse",
@@ -394,8 +634,9 @@ class DataverseProvider(RepoProvider):
         "ref": {"enabled": False},
     }
 
+    @cached_ref
     async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
+        client = self.http_client
         req = HTTPRequest(f"https://doi.org/{self.spec}", user_agent="BinderHub")
         r = await client.fetch(req)
 
@@ -452,6 +693,8 @@ class HydroshareProvider(RepoProvider):
 
     name = Unicode("Hydroshare")
 
+    _resolved_attrs = ("resource_id", "record_id")
+
     display_config = {
         "displayName": "Hydroshare resource",
         "id": "hydroshare",
@@ -473,8 +716,9 @@ class HydroshareProvider(RepoProvider):
         resource_id = match.groups()[0]
         return resource_id
 
+    @cached_ref
     async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
+        client = self.http_client
         self.resource_id = self._parse_resource_id(self.spec)
         req = HTTPRequest(
             f"https://www.hydroshare.org/hsapi/resource/{self.resource_id}/scimeta/elements",
@@ -521,6 +765,8 @@ class CKANProvider(RepoProvider):
 
     name = Unicode("CKAN")
 
+    _resolved_attrs = ("dataset_id", "record_id")
+
     display_config = {
         "displayName": "CKAN dataset",
         "id": "ckan",
@@ -537,6 +783,7 @@ class CKANProvider(RepoProvider):
         super().__init__(*args, **kwargs)
         self.repo = urllib.parse.unquote(self.spec)
 
+    @cached_ref
     async def get_resolved_ref(self):
         parsed_repo = urlparse(self.repo)
 
@@ -570,7 +817,7 @@ class CKANProvider(RepoProvider):
         else:
             fetch_url = f"{api}package_show?" + urlencode({"id": self.dataset_id})
 
-        client = AsyncHTTPClient()
+        client = self.http_client
         try:
             r = await client.fetch(fetch_url, user_agent="BinderHub")
         except HTTPError:
@@ -621,6 +868,8 @@ class GitRepoProvider(RepoProvider):
 
     name = Unicode("Git")
 
+    _resolved_attrs = ("resolved_ref",)
+
     display_config = {
         "displayName": "Git repository",
         "id": "git",
@@ -668,6 +917,7 @@ class GitRepoProvider(RepoProvider):
                 "`unresolved_ref` must be specified in the url for the basic git provider"
             )
 
+    @cached_ref
     async def get_resolved_ref(self):
         if hasattr(self, "resolved_ref"):
             return self.resolved_ref
@@ -728,6 +978,8 @@ class GitLabRepoProvider(RepoProvider):
 
     name = Unicode("GitLab")
 
+    _resolved_attrs = ("resolved_ref",)
+
     display_config = {
         "displayName": "GitLab",
         "id": "gl",
@@ -803,12 +1055,13 @@ class GitLabRepoProvider(RepoProvider):
         if not self.unresolved_ref:
             raise ValueError("An unresolved ref is required")
 
+    @cached_ref
     async def get_resolved_ref(self):
         if hasattr(self, "resolved_ref"):
             return self.resolved_ref
 
         namespace = urllib.parse.quote(self.namespace, safe="")
-        client = AsyncHTTPClient()
+        client = self.http_client
         api_url = "https://{hostname}/api/v4/projects/{namespace}/repository/commits/{ref}".format(
             hostname=self.hostname,
             namespace=namespace,
@@ -855,6 +1108,8 @@ class GitHubRepoProvider(RepoProvider):
 
     name = Unicode("GitHub")
 
+    _resolved_attrs = ("resolved_ref",)
+
     display_config = {
         "displayName": "GitHub",
         "id": "gh",
@@ -938,6 +1193,17 @@ class GitHubRepoProvider(RepoProvider):
     def _access_token_default(self):
         return os.getenv("GITHUB_ACCESS_TOKEN", "")
 
+    etag_cache_ttl = Integer(
+        24 * 60 * 60,
+        config=True,
+        help="""
+        Time (in seconds) to keep the ETags of GitHub API responses in the ref cache.
+
+        Requests with a known ETag don't count against the GitHub rate limit
+        if the ref hasn't changed.
+        """,
+    )
+
     @default("git_credentials")
     def _default_git_credentials(self):
         if self.access_token:
@@ -967,8 +1233,21 @@ class GitHubRepoProvider(RepoProvider):
             f"https://{self.hostname}/{self.user}/{self.repo}/tree/{self.resolved_ref}"
         )
 
+    async def _get_cached_etag(self, api_url):
+        """Get the cached ETag and sha of an API request"""
+        if self.ref_cache is None:
+            return self.cache.get(api_url)
+        return await self._ref_cache_get(f"etag:{api_url}")
+
+    async def _set_cached_etag(self, api_url, entry):
+        if self.ref_cache is None:
+            self.cache.set(api_url, entry)
+        else:
+            # shared with the other replicas, so they can make conditional requests
+            await self._ref_cache_set(f"etag:{api_url}", entry, self.etag_cache_ttl)
+
     async def github_api_request(self, api_url, etag=None):
-        client = AsyncHTTPClient()
+        client = self.http_client
 
         request_kwargs = {}
         if self.client_id and self.client_secret:
@@ -1050,6 +1329,7 @@ class GitHubRepoProvider(RepoProvider):
 
         return resp
 
+    @cached_ref
     async def get_resolved_ref(self):
         if hasattr(self, "resolved_ref"):
             return self.resolved_ref
@@ -1061,7 +1341,7 @@ class GitHubRepoProvider(RepoProvider):
             ref=self.unresolved_ref,
         )
         self.log.debug("Fetching %s", api_url)
-        cached = self.cache.get(api_url)
+        cached = await self._get_cached_etag(api_url)
         if cached:
             etag = cached["etag"]
             self.log.debug("Cache hit for %s: %s", api_url, etag)
@@ -1081,7 +1361,7 @@ class GitHubRepoProvider(RepoProvider):
             self.log.info("Using cached ref for %s: %s", api_url, cached["sha"])
             self.resolved_ref = cached["sha"]
             # refresh cache entry
-            self.cache.move_to_end(api_url)
+            await self._set_cached_etag(api_url, cached)
             return self.resolved_ref
         elif cached:
             self.log.debug("Cache outdated for %s", api_url)
@@ -1094,7 +1374,7 @@ class GitHubRepoProvider(RepoProvider):
             return None
         # store resolved ref and cache for later
         self.resolved_ref = ref_info["sha"]
-        self.cache.set(
+        await self._set_cached_etag(
             api_url,
             {
                 "etag": resp.headers.get("ETag"),
@@ -1167,6 +1447,7 @@ class GistRepoProvider(GitHubRepoProvider):
             self.resolved_ref = await self.get_resolved_ref()
         return f"https://{self.hostname}/{self.user}/{self.gist_id}/{self.resolved_ref}"
 
+    @cached_ref
     async def get_resolved_ref(self):
         if hasattr(self, "resolved_ref"):
             return self.resolved_ref
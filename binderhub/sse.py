@@ -0,0 +1,140 @@
+"""
+Incremental decoding of server-sent event streams
+"""
+
+import asyncio
+from collections import namedtuple
+
+ServerSentEvent = namedtuple("ServerSentEvent", ["data", "event", "id"])
+
+
+class SSEDecoder:
+    """Incremental decoder of a server-sent event stream (text/event-stream)
+
+    Call `decode(chunk)` with each chunk of a response as it arrives,
+    to get the events completed by the chunk.
+
+    Follows https://html.spec.whatwg.org/multipage/server-sent-events.html:
+    lines end with CRLF, LF or CR, the data lines of an event are joined with LF,
+    comments are ignored and `retry` sets the reconnection time.
+    Each byte is only scanned once, however the stream is split in chunks.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # bytes at the start of the buffer known not to contain a line ending
+        self._scanned = 0
+        self._started = False
+        self._data = []
+        self._event = ""
+        self.last_event_id = ""
+        # reconnection time (milliseconds) set by the stream, if any
+        self.retry = None
+
+    def decode(self, chunk):
+        """Decode a chunk of the stream
+
+        Returns the list of ServerSentEvents completed by the chunk.
+        """
+        buffer = self._buffer
+        buffer += chunk
+        if not self._started:
+            if len(buffer) < 3 and b"\xef\xbb\xbf".startswith(buffer):
+                # wait for the rest of a possible byte order mark
+                return []
+            if buffer.startswith(b"\xef\xbb\xbf"):
+                del buffer[:3]
+            self._started = True
+
+        events = []
+        start = 0
+        end = len(buffer)
+        # next positions of CR and LF, -1 if there are none
+        cr = lf = self._scanned
+        cr = buffer.find(b"\r", cr)
+        lf = buffer.find(b"\n", lf)
+        while cr != -1 or lf != -1:
+            if lf == -1 or (cr != -1 and cr < lf):
+                if cr + 1 == end:
+                    # CR at the end of the chunk, maybe followed by LF
+                    break
+                line_end = cr
+                next_start = cr + 2 if lf == cr + 1 else cr + 1
+            else:
+                line_end = lf
+                next_start = lf + 1
+            event = self._handle_line(buffer[start:line_end])
+            if event is not None:
+                events.append(event)
+            start = next_start
+            if cr != -1 and cr < start:
+                cr = buffer.find(b"\r", start)
+            if lf != -1 and lf < start:
+                lf = buffer.find(b"\n", start)
+
+        # keep the rest of the last line, and what's already been scanned of it
+        del buffer[:start]
+        self._scanned = len(buffer) - (1 if buffer.endswith(b"\r") else 0)
+        return events
+
+    def _handle_line(self, line):
+        """Handle a line, returning the event it completes if any"""
+        if not line:
+            return self._dispatch()
+        if line.startswith(b":"):
+            # comment, e.g. a keepalive
+            return None
+        line = line.decode("utf8", "replace")
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+
+    def _dispatch(self):
+        data, self._data = self._data, []
+        event, self._event = self._event, ""
+        if not data:
+            return None
+        return ServerSentEvent(
+            data="\n".join(data), event=event or "message", id=self.last_event_id
+        )
+
+
+class EventStreamQueue(asyncio.Queue):
+    """Queue of the events of server-sent event streams, in the order they arrive
+
+    Use `streaming_callback()` as the streaming_callback of a request,
+    and iterate over `events()` to handle them, until `close()` is called.
+    """
+
+    def streaming_callback(self):
+        """Get a callback queuing the events of the chunks of a response"""
+        decoder = SSEDecoder()
+
+        def callback(chunk):
+            for event in decoder.decode(chunk):
+                self.put_nowait(event)
+
+        return callback
+
+    def close(self):
+        """Signal the end of the events"""
+        self.put_nowait(None)
+
+    async def events(self):
+        """Iterate over the events, until the queue is closed"""
+        while True:
+            event = await self.get()
+            if event is None:
+                return
+            yield event
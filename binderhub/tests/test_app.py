@@ -1,10 +1,13 @@
 """Exercise the binderhub entrypoint"""
 
+import ipaddress
+import json
 import sys
 from subprocess import check_output
 
 import pytest
 from traitlets import TraitError
+from traitlets.config import Config
 
 from binderhub.app import BinderHub
 from binderhub.repoproviders import GitHubRepoProvider, GitLabRepoProvider, RepoProvider
@@ -38,3 +41,61 @@ def test_repo_providers():
     for repo_providers in wrong_repo_providers:
         with pytest.raises(TraitError):
             b.repo_providers = repo_providers
+
+
+def test_build_queue_limit():
+    b = BinderHub(concurrent_build_limit=4)
+    assert b._make_build_queue().limit == 4
+    b = BinderHub(config=Config({"BuildQueue": {"limit": 8}}), concurrent_build_limit=4)
+    assert b._make_build_queue().limit == 8
+
+
+def test_reload_dynamic_config(app, tmp_path):
+    config_file = tmp_path / "dynamic_config.json"
+    app.dynamic_config_file = str(config_file)
+    settings = app.tornado_app.settings
+
+    def provider(spec):
+        return GitHubRepoProvider(
+            spec=spec,
+            config=settings["traitlets_config"],
+            spec_matchers=settings["spec_matchers"]["gh"],
+        )
+
+    assert not provider("abuser/repo/HEAD").is_banned()
+
+    config_file.write_text(
+        json.dumps(
+            {
+                "BinderHub": {"ban_networks": {"10.0.0.0/8": "abuse"}},
+                "GitHubRepoProvider": {
+                    "banned_specs": ["^abuser/.*"],
+                    "spec_config": [{"pattern": "^vip/", "config": {"quota": 100}}],
+                },
+            }
+        )
+    )
+    assert app.reload_dynamic_config()
+    assert provider("abuser/repo/HEAD").is_banned()
+    assert provider("vip/repo/HEAD").repo_config(settings)["quota"] == 100
+    assert settings["ban_networks"].match(ipaddress.ip_address("10.1.2.3"))
+    # unchanged
+    assert not app.reload_dynamic_config()
+
+    # invalid config is ignored, the previous config is kept
+    config_file.write_text(
+        json.dumps({"GitHubRepoProvider": {"banned_specs": ["^(unclosed"]}})
+    )
+    assert not app.reload_dynamic_config()
+    assert provider("abuser/repo/HEAD").is_banned()
+
+    # only ban lists and spec_config can be reloaded
+    config_file.write_text(
+        json.dumps(
+            {"BinderHub": {"port": 1}, "GitHubRepoProvider": {"banned_specs": []}}
+        )
+    )
+    assert app.reload_dynamic_config()
+    assert not provider("abuser/repo/HEAD").is_banned()
+    assert "port" not in settings["traitlets_config"].BinderHub
+    assert not settings["ban_networks"]
@@ -0,0 +1,85 @@
+"""Test the back-pressure on the Hub API"""
+
+import asyncio
+
+import pytest
+
+from binderhub.backpressure import AdaptiveConcurrencyLimit, CircuitBreaker, Overloaded
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, open_seconds=10)
+    now = 1000
+    breaker._now = lambda: now
+    breaker.check()
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    # failures have to be consecutive
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open"
+    with pytest.raises(Overloaded) as excinfo:
+        breaker.check()
+    assert excinfo.value.retry_after == 10
+
+    # a single request probes the Hub once the circuit is half-open
+    now += 10
+    breaker.check()
+    assert breaker.state == "half_open"
+    with pytest.raises(Overloaded):
+        breaker.check()
+    # a failed probe opens the circuit for longer
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.retry_after() == 20
+    now += 20
+    breaker.check()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    breaker.check()
+
+
+async def test_concurrency_limit_aimd():
+    limit = AdaptiveConcurrencyLimit(
+        initial_limit=4, min_limit=1, backoff_interval=1, slow_request_seconds=5
+    )
+    now = 1000
+    limit._now = lambda: now
+    started = await limit.acquire()
+    limit.release(started, True)
+    assert limit.limit == 4.25
+    started = await limit.acquire()
+    limit.release(started, False)
+    assert limit.limit == 2.125
+    # failures of concurrent requests only decrease the limit once
+    started = await limit.acquire()
+    limit.release(started, False)
+    assert limit.limit == 2.125
+    # slow requests decrease the limit
+    now += 1
+    started = await limit.acquire()
+    now += 6
+    limit.release(started, True)
+    assert limit.limit == 1.0625
+    # unknown outcomes leave it unchanged
+    started = await limit.acquire()
+    limit.release(started, None)
+    assert limit.limit == 1.0625
+    assert limit.active == 0
+
+
+async def test_concurrency_limit_wait():
+    limit = AdaptiveConcurrencyLimit(initial_limit=1, max_wait=0.1)
+    started = await limit.acquire()
+    waiting = asyncio.ensure_future(limit.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    limit.release(started, None)
+    await waiting
+    assert limit.active == 1
+    # requests that don't get a slot in time are rejected
+    with pytest.raises(Overloaded):
+        await limit.acquire()
+    assert limit.active == 1
+    assert not limit._waiters
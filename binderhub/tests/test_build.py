@@ -1,5 +1,6 @@
 """Test building repos"""
 
+import asyncio
 import json
 import sys
 from time import monotonic
@@ -10,13 +11,23 @@ from uuid import uuid4
 import docker
 import pytest
 from kubernetes import client
+from tornado.httpclient import HTTPClientError
 from tornado.httputil import url_concat
 from tornado.queues import Queue
-
-from binderhub.build import BuildExecutor, KubernetesBuildExecutor, ProgressEvent
+from tornado.simple_httpclient import HTTPTimeoutError
+from tornado.web import Application, RequestHandler
+
+from binderhub.build import (
+    AsyncKubernetesBuildExecutor,
+    BuildExecutor,
+    KubernetesBuildExecutor,
+    ProgressEvent,
+    _LineBuffer,
+)
 from binderhub.build_local import LocalRepo2dockerBuild, ProcessTerminated, _execute_cmd
+from binderhub.informer import PodInformer
 
-from .utils import async_requests
+from .utils import async_requests, random_port
 
 
 # We have optimized this slow test, for more information, see the README of
@@ -618,3 +629,232 @@ def test_extra_r2d_options():
         "--user-id=1000",
         "--repo-dir=/srv/repo",
     ]
+
+
+def test_build_pod_informer_events():
+    informer = PodInformer(api=mock.MagicMock(), label_selector="component=test")
+    build = KubernetesBuildExecutor(
+        q=mock.MagicMock(),
+        api=_list_image_builder_pods_mock(),
+        pod_informer=informer,
+        name="test_build",
+        namespace="build_namespace",
+        repo_url="repo",
+        ref="ref",
+        build_image="image",
+        image_name="name",
+        push_secret="",
+        memory_limit=0,
+        git_credentials="",
+        docker_host="http://mydockerregistry.local",
+        node_selector={},
+    )
+    progress = []
+
+    def record_progress(kind, payload):
+        progress.append(payload)
+
+    def pod(phase):
+        return client.V1Pod(
+            metadata=client.V1ObjectMeta(name="test_build"),
+            status=client.V1PodStatus(phase=phase),
+        )
+
+    # submit returns as soon as the pod is created, without watching
+    build.submit()
+    assert build.api.create_namespaced_pod.call_count == 1
+    assert informer._subscribers["test_build"] == [build._on_pod_event]
+
+    with (
+        mock.patch.object(build, "progress", record_progress),
+        mock.patch.object(build.main_loop, "run_in_executor") as run_in_executor,
+    ):
+        informer._dispatch("ADDED", pod("Pending"))
+        informer._dispatch("MODIFIED", pod("Running"))
+        informer._dispatch("MODIFIED", pod("Succeeded"))
+        informer._dispatch("MODIFIED", pod("Succeeded"))
+        informer._dispatch("DELETED", pod("Succeeded"))
+
+    assert progress == [
+        ProgressEvent.BuildStatus.PENDING,
+        ProgressEvent.BuildStatus.RUNNING,
+        ProgressEvent.BuildStatus.BUILT,
+    ]
+    # the pod is deleted only once
+    run_in_executor.assert_called_once_with(None, build.cleanup)
+    assert "test_build" not in informer._subscribers
+
+
+class FakeKubernetesPodsHandler(RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    async def get(self):
+        assert self.request.headers["Authorization"] == "Bearer kube-token"
+        if not self.get_argument("watch", None):
+            self.write({"kind": "PodList", "items": []})
+            return
+        assert self.get_argument("labelSelector") == "name=test-build"
+        pod = client.ApiClient().sanitize_for_serialization(self.store["pod"])
+        for event_type, phase in [
+            ("ADDED", "Pending"),
+            ("MODIFIED", "Running"),
+            ("MODIFIED", "Succeeded"),
+        ]:
+            pod["status"] = {"phase": phase}
+            self.write(json.dumps({"type": event_type, "object": pod}) + "\n")
+            await self.flush()
+        while "deleted" not in self.store:
+            await asyncio.sleep(0.01)
+        self.write(json.dumps({"type": "DELETED", "object": pod}) + "\n")
+
+    def post(self):
+        self.store["pod"] = json.loads(self.request.body)
+        self.set_status(201)
+        self.write(self.request.body)
+
+
+class FakeKubernetesPodHandler(RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    def delete(self, name):
+        assert self.get_argument("gracePeriodSeconds") == "0"
+        self.store["deleted"] = name
+        self.write({})
+
+
+class FakeKubernetesLogHandler(RequestHandler):
+    async def get(self, name):
+        assert self.get_argument("follow") == "true"
+        self.write(json.dumps({"phase": "building", "message": "step 1\n"}) + "\n")
+        await self.flush()
+        # the last line isn't terminated
+        self.write("not json")
+
+
+async def test_async_kubernetes_build():
+    store = {}
+    app = Application(
+        [
+            (
+                r"/api/v1/namespaces/ns/pods",
+                FakeKubernetesPodsHandler,
+                {"store": store},
+            ),
+            (
+                r"/api/v1/namespaces/ns/pods/([^/]+)",
+                FakeKubernetesPodHandler,
+                {"store": store},
+            ),
+            (r"/api/v1/namespaces/ns/pods/([^/]+)/log", FakeKubernetesLogHandler),
+        ]
+    )
+    port = random_port()
+    server = app.listen(port, "127.0.0.1")
+
+    config = client.Configuration(host=f"http://127.0.0.1:{port}")
+    config.api_key = {"authorization": "kube-token"}
+    config.api_key_prefix = {"authorization": "Bearer"}
+    q = Queue()
+    build = AsyncKubernetesBuildExecutor(
+        q=q,
+        api=client.CoreV1Api(client.ApiClient(config)),
+        name="test-build",
+        namespace="ns",
+        repo_url="repo",
+        ref="ref",
+        build_image="image",
+        image_name="name",
+        push_secret="",
+        git_credentials="",
+        docker_host="http://mydockerregistry.local",
+    )
+    # builds share a client, separate from the other requests
+    assert build.http_client.max_clients == build.max_clients
+    assert (
+        build.http_client
+        is AsyncKubernetesBuildExecutor(q=q, api=build.api).http_client
+    )
+    try:
+        await asyncio.wait_for(build.submit(), 10)
+        assert store["pod"]["metadata"]["labels"]["name"] == "test-build"
+        assert store["deleted"] == "test-build"
+        await asyncio.wait_for(build.stream_logs(), 10)
+    finally:
+        server.stop()
+
+    events = []
+    while q.qsize():
+        progress = q.get_nowait()
+        if progress.kind == ProgressEvent.Kind.LOG_MESSAGE:
+            events.append(json.loads(progress.payload))
+        else:
+            events.append(progress.payload)
+    assert events == [
+        ProgressEvent.BuildStatus.PENDING,
+        ProgressEvent.BuildStatus.RUNNING,
+        ProgressEvent.BuildStatus.BUILT,
+        {"phase": "building", "message": "step 1\n"},
+        {"phase": "unknown", "message": "not json"},
+    ]
+
+
+class FailingWatchHTTPClient:
+    """http_client failing requests to watch pods with `errors`, in turn"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.watches = 0
+
+    async def fetch(self, request, **kwargs):
+        if "watch=true" in request.url:
+            self.watches += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            raise HTTPClientError(599, "Failed to connect")
+        if request.method == "GET":
+            return mock.Mock(body=json.dumps({"items": []}))
+        return mock.Mock(body=b"{}")
+
+
+async def test_async_kubernetes_build_watch_errors():
+    config = client.Configuration(host="http://127.0.0.1:1")
+    http_client = FailingWatchHTTPClient(
+        [
+            HTTPTimeoutError("Timeout while connecting"),
+            HTTPClientError(599, "Failed to connect"),
+            HTTPTimeoutError("Timeout during request"),
+        ]
+    )
+    build = AsyncKubernetesBuildExecutor(
+        q=Queue(),
+        api=client.CoreV1Api(client.ApiClient(config)),
+        name="test-build",
+        namespace="ns",
+        http_client=http_client,
+        watch_max_retries=3,
+        watch_max_retry_delay=3,
+    )
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    with mock.patch.object(asyncio, "sleep", sleep):
+        with pytest.raises(HTTPClientError):
+            await asyncio.wait_for(build.submit(), 10)
+    # timeouts are retried at once,
+    # other errors after an increasing delay, up to watch_max_retries in a row
+    assert delays == [1, 1, 2, 3]
+    assert http_client.watches == 3 + 4
+
+
+def test_line_buffer():
+    lines = []
+    buffer = _LineBuffer(lines.append)
+    for chunk in [b"a", b"b", b"c\nd", b"\n\n", b"e", b"f\ng\n", b"h"]:
+        buffer(chunk)
+    assert lines == [b"abc", b"d", b"ef", b"g"]
+    buffer.flush()
+    assert lines == [b"abc", b"d", b"ef", b"g", b"h"]
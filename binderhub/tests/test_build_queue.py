@@ -0,0 +1,145 @@
+"""Test the build admission queue"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from binderhub.build_queue import BuildQueue
+from binderhub.build_registry import BuildRegistry
+
+from .test_build_registry import SteppedBuild
+
+
+async def test_build_queue_order():
+    queue = BuildQueue(limit=1)
+    started = []
+    positions = {}
+
+    async def build(name, priority=0):
+        await queue.acquire(
+            priority, lambda position: positions.setdefault(name, []).append(position)
+        )
+        started.append(name)
+
+    await build("first")
+    assert queue.running == 1
+    tasks = [
+        asyncio.ensure_future(build("a")),
+        asyncio.ensure_future(build("b")),
+        asyncio.ensure_future(build("urgent", priority=10)),
+    ]
+    await asyncio.sleep(0.01)
+    assert queue.queued == 3
+    assert positions == {"urgent": [1], "a": [2], "b": [3]}
+
+    for expected in ["urgent", "a", "b"]:
+        queue.release()
+        await asyncio.sleep(0.01)
+        assert started[-1] == expected
+    assert positions == {"urgent": [1], "a": [2, 1], "b": [3, 2, 1]}
+    await asyncio.gather(*tasks)
+    assert queue.running == 1
+
+
+async def test_build_queue_cancel():
+    queue = BuildQueue(limit=1)
+    await queue.acquire()
+    positions = []
+    leaving = asyncio.ensure_future(queue.acquire())
+    waiting = asyncio.ensure_future(queue.acquire(on_position=positions.append))
+    await asyncio.sleep(0.01)
+    assert positions == [2]
+
+    leaving.cancel()
+    await asyncio.sleep(0.01)
+    assert positions == [2, 1]
+    assert queue.queued == 1
+
+    queue.release()
+    await asyncio.wait_for(waiting, 1)
+    assert queue.running == 1
+    assert queue.queued == 0
+
+
+async def test_build_queue_no_limit():
+    queue = BuildQueue(limit=0)
+    for _ in range(100):
+        await asyncio.wait_for(queue.acquire(), 1)
+    assert queue.running == 100
+
+
+async def test_registry_build_queue():
+    pool = ThreadPoolExecutor(2)
+    registry = BuildRegistry(build_queue=BuildQueue(limit=1))
+    builds = {}
+
+    def create_build(name):
+        async def create(q):
+            builds[name] = SteppedBuild(q=q, name=name)
+            return builds[name]
+
+        return create
+
+    submitted = SteppedBuild.submit_count
+    _, first_q, _ = await registry.attach("first", create_build("first"), pool)
+    _, second_q, _ = await registry.attach("second", create_build("second"), pool)
+    await asyncio.sleep(0.1)
+    # only one build can run
+    assert SteppedBuild.submit_count == submitted + 1
+    progress = second_q.get_nowait()
+    assert json.loads(progress.payload) == {
+        "phase": "waiting",
+        "message": "Waiting for a free build slot, position 1 in the queue...\n",
+        "position": 1,
+    }
+    assert second_q.empty()
+
+    builds["first"].release.set()
+    builds["second"].release.set()
+    while await asyncio.wait_for(second_q.get(), 5) is not None:
+        pass
+    assert registry.build_queue.running == 0
+    pool.shutdown(wait=False)
+
+
+async def test_registry_build_queue_unwatched_build():
+    pool = ThreadPoolExecutor(2)
+    registry = BuildRegistry(build_queue=BuildQueue(limit=1))
+    builds = {}
+
+    def create_build(name):
+        async def create(q):
+            builds[name] = SteppedBuild(q=q, name=name)
+            return builds[name]
+
+        return create
+
+    submitted = SteppedBuild.submit_count
+    first, first_q, _ = await registry.attach("first", create_build("first"), pool)
+    await asyncio.sleep(0.1)
+    # the build keeps running without clients, and keeps its slot
+    first.unsubscribe(first_q)
+    assert not builds["first"].stop_event.is_set()
+    _, second_q, _ = await registry.attach("second", create_build("second"), pool)
+    await asyncio.sleep(0.1)
+    assert SteppedBuild.submit_count == submitted + 1
+    assert registry.build_queue.running == 1
+
+    # new requests attach to the running build again
+    shared_build, first_q, created = await registry.attach(
+        "first", create_build("first"), pool
+    )
+    assert shared_build is first
+    assert not created
+
+    # the next build starts once the first one is done
+    builds["first"].release.set()
+    while await asyncio.wait_for(first_q.get(), 5) is not None:
+        pass
+    await asyncio.sleep(0.1)
+    assert SteppedBuild.submit_count == submitted + 2
+    builds["second"].release.set()
+    while await asyncio.wait_for(second_q.get(), 5) is not None:
+        pass
+    assert registry.build_queue.running == 0
+    pool.shutdown(wait=False)
@@ -0,0 +1,207 @@
+"""Test sharing builds between requests"""
+
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from binderhub.build import BuildExecutor, ProgressEvent
+from binderhub.build_registry import BuildRegistry
+
+
+class SteppedBuild(BuildExecutor):
+    """Build emitting a few log lines, waiting for the test to let it finish"""
+
+    submit_count = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = threading.Event()
+
+    def submit(self):
+        SteppedBuild.submit_count += 1
+        self.progress(
+            ProgressEvent.Kind.BUILD_STATUS_CHANGE, ProgressEvent.BuildStatus.RUNNING
+        )
+
+    def stream_logs(self):
+        for i in range(3):
+            self.progress(
+                ProgressEvent.Kind.LOG_MESSAGE,
+                json.dumps({"phase": "building", "message": f"step {i}\n"}),
+            )
+        self.release.wait(10)
+        if self.stop_event.is_set():
+            return
+        self.progress(
+            ProgressEvent.Kind.BUILD_STATUS_CHANGE, ProgressEvent.BuildStatus.BUILT
+        )
+
+
+async def _collect(q):
+    events = []
+    while True:
+        progress = await asyncio.wait_for(q.get(), 5)
+        if progress is None:
+            return events
+        events.append(progress.payload)
+
+
+@pytest.fixture
+def pool():
+    pool = ThreadPoolExecutor(4)
+    yield pool
+    pool.shutdown(wait=False)
+
+
+async def test_concurrent_requests_share_build(pool):
+    SteppedBuild.submit_count = 0
+    registry = BuildRegistry()
+    builds = []
+
+    async def create_build(q):
+        # yield, so the other request arrives while the build is being created
+        await asyncio.sleep(0.1)
+        build = SteppedBuild(q=q, name="build-a")
+        builds.append(build)
+        return build
+
+    results = await asyncio.gather(
+        registry.attach("build-a", create_build, pool),
+        registry.attach("build-a", create_build, pool),
+    )
+    assert len(builds) == 1
+    assert [created for _, _, created in results] == [True, False]
+    shared_build = results[0][0]
+    assert results[1][0] is shared_build
+
+    # wait for the log lines
+    while len(shared_build.replay) < 4:
+        await asyncio.sleep(0.05)
+
+    # a late request receives the log from the start
+    late = await registry.attach("build-a", create_build, pool)
+    assert late[0] is shared_build
+    assert not late[2]
+
+    builds[0].release.set()
+    all_events = await asyncio.gather(*(_collect(q) for _, q, _ in results + [late]))
+    expected = [ProgressEvent.BuildStatus.RUNNING] + [
+        json.dumps({"phase": "building", "message": f"step {i}\n"}) for i in range(3)
+    ]
+    expected.append(ProgressEvent.BuildStatus.BUILT)
+    for events in all_events:
+        assert events == expected
+    assert SteppedBuild.submit_count == 1
+    assert registry.builds == {}
+
+
+async def test_replay_buffer_size(pool):
+    registry = BuildRegistry(replay_buffer_size=2)
+    builds = []
+
+    async def create_build(q):
+        build = SteppedBuild(q=q, name="build-b")
+        builds.append(build)
+        return build
+
+    shared_build, first_q, _ = await registry.attach("build-b", create_build, pool)
+    while len(shared_build.replay) < 2 or shared_build.replay[-1].payload != (
+        json.dumps({"phase": "building", "message": "step 2\n"})
+    ):
+        await asyncio.sleep(0.05)
+    _, late_q, _ = await registry.attach("build-b", create_build, pool)
+    builds[0].release.set()
+    events = await _collect(late_q)
+    assert len(events) == 3
+    assert events[-1] == ProgressEvent.BuildStatus.BUILT
+
+
+async def test_last_client_leaving_stops_build(pool):
+    registry = BuildRegistry()
+    builds = []
+
+    async def create_build(q):
+        build = SteppedBuild(q=q, name="build-c")
+        builds.append(build)
+        return build
+
+    shared_build, q, _ = await registry.attach("build-c", create_build, pool)
+    _, q2, _ = await registry.attach("build-c", create_build, pool)
+    shared_build.unsubscribe(q)
+    assert not builds[0].stop_event.is_set()
+    shared_build.unsubscribe(q2)
+    assert builds[0].stop_event.is_set()
+    # the next request starts watching the build again
+    assert "build-c" not in registry.builds
+    new_build, new_q, created = await registry.attach("build-c", create_build, pool)
+    assert created
+    assert new_build is not shared_build
+    builds[0].release.set()
+    builds[1].release.set()
+    events = await _collect(new_q)
+    assert events[-1] == ProgressEvent.BuildStatus.BUILT
+
+
+async def test_failed_build_task(pool):
+    registry = BuildRegistry()
+
+    class BrokenBuild(SteppedBuild):
+        def submit(self):
+            raise RuntimeError("oops")
+
+    async def create_build(q):
+        return BrokenBuild(q=q, name="build-d")
+
+    _, q, _ = await registry.attach("build-d", create_build, pool)
+    events = await _collect(q)
+    assert len(events) == 1
+    assert json.loads(events[0])["phase"] == "failed"
+    assert registry.builds == {}
+
+
+async def test_create_build_error():
+    registry = BuildRegistry()
+
+    async def create_build(q):
+        await asyncio.sleep(0.1)
+        raise ValueError("no credentials")
+
+    results = await asyncio.gather(
+        registry.attach("build-e", create_build, None),
+        registry.attach("build-e", create_build, None),
+        return_exceptions=True,
+    )
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert registry.builds == {}
+
+
+async def test_async_build_executor():
+    registry = BuildRegistry()
+
+    class AsyncBuild(BuildExecutor):
+        async def submit(self):
+            self.progress(
+                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                ProgressEvent.BuildStatus.RUNNING,
+            )
+
+        async def stream_logs(self):
+            await asyncio.sleep(0.1)
+            self.progress(
+                ProgressEvent.Kind.BUILD_STATUS_CHANGE,
+                ProgressEvent.BuildStatus.BUILT,
+            )
+
+    async def create_build(q):
+        return AsyncBuild(q=q, name="build-f")
+
+    # no thread pool needed
+    _, q, _ = await registry.attach("build-f", create_build, None)
+    events = await _collect(q)
+    assert events == [
+        ProgressEvent.BuildStatus.RUNNING,
+        ProgressEvent.BuildStatus.BUILT,
+    ]
@@ -0,0 +1,56 @@
+"""Test the pools of outbound HTTP clients"""
+
+import asyncio
+from random import randint
+
+import pytest
+from tornado.web import Application, RequestHandler
+from traitlets import TraitError
+
+from binderhub.http_client import HTTP_CLIENT_SATURATED, HTTPClientPools
+
+
+class SlowHandler(RequestHandler):
+    async def get(self):
+        await asyncio.sleep(0.1)
+        self.write("ok")
+
+
+def test_pool_settings():
+    pools = HTTPClientPools(
+        max_clients=10, pools={"registry": {"max_clients": 2, "request_timeout": 5}}
+    )
+    registry = pools.get("registry")
+    assert pools.get("registry") is registry
+    assert registry.max_clients == 2
+    assert registry.settings["request_timeout"] == 5
+    assert registry.settings["connect_timeout"] == pools.connect_timeout
+    assert pools.get("launcher").max_clients == 10
+    # long-running spawn requests have a larger pool
+    assert pools.get("launcher_spawns").max_clients == 512
+    pools = HTTPClientPools(pools={"launcher_spawns": {"max_clients": 100}})
+    assert pools.get("launcher_spawns").max_clients == 100
+
+
+def test_pool_settings_invalid():
+    with pytest.raises(TraitError):
+        HTTPClientPools(pools={"registry": {"max_connections": 2}})
+
+
+async def test_pool_saturation():
+    app = Application([(r"/slow", SlowHandler)])
+    port = randint(10000, 65535)
+    server = app.listen(port, "127.0.0.1")
+
+    pools = HTTPClientPools(max_clients=2)
+    client = pools.get("test-saturation")
+    saturated = HTTP_CLIENT_SATURATED.labels(pool="test-saturation")
+    before = saturated._value.get()
+    responses = await asyncio.gather(
+        *(client.fetch(f"http://127.0.0.1:{port}/slow") for _ in range(4))
+    )
+    assert [r.body for r in responses] == [b"ok"] * 4
+    assert saturated._value.get() - before == 2
+    assert client.active == 0
+    pools.close()
+    server.stop()
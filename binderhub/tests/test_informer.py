@@ -0,0 +1,83 @@
+"""Test the shared pod informer"""
+
+from unittest import mock
+
+from kubernetes import client
+
+from binderhub.informer import PodInformer
+
+
+def _pod(name, phase="Pending"):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name),
+        status=client.V1PodStatus(phase=phase),
+    )
+
+
+def test_informer_dispatch_by_name():
+    informer = PodInformer(api=mock.MagicMock(), label_selector="component=test")
+    events_a = []
+    events_b = []
+    informer.subscribe("a", lambda t, pod: events_a.append((t, pod.status.phase)))
+    informer.subscribe("b", lambda t, pod: events_b.append((t, pod.status.phase)))
+
+    informer._dispatch("ADDED", _pod("a"))
+    informer._dispatch("MODIFIED", _pod("a", "Running"))
+    informer._dispatch("DELETED", _pod("a", "Succeeded"))
+
+    assert events_a == [
+        ("ADDED", "Pending"),
+        ("MODIFIED", "Running"),
+        ("DELETED", "Succeeded"),
+    ]
+    assert events_b == []
+    assert informer.pods == {}
+
+
+def test_informer_late_subscriber():
+    informer = PodInformer(api=mock.MagicMock(), label_selector="component=test")
+    informer._dispatch("ADDED", _pod("a", "Running"))
+
+    # several subscribers to the same pod share the same watch
+    first = []
+    second = []
+    informer.subscribe("a", lambda t, pod: first.append(t))
+    informer.subscribe("a", lambda t, pod: second.append(t))
+    assert first == ["ADDED"]
+    assert second == ["ADDED"]
+
+    callback = mock.MagicMock()
+    informer.subscribe("a", callback)
+    informer.unsubscribe("a", callback)
+    informer._dispatch("MODIFIED", _pod("a", "Running"))
+    callback.assert_called_once()
+    assert first == ["ADDED", "MODIFIED"]
+
+
+def test_informer_relist():
+    informer = PodInformer(api=mock.MagicMock(), label_selector="component=test")
+    events = []
+    informer.add_listener(lambda t, pod: events.append((t, pod.metadata.name)))
+    informer._dispatch("ADDED", _pod("a"))
+    informer._dispatch("ADDED", _pod("b"))
+    assert not informer.ready.is_set()
+
+    # pod a disappeared while the watch was down, pod c was created
+    informer._replace({"b": _pod("b", "Running"), "c": _pod("c")})
+    assert informer.ready.is_set()
+    assert events[2:] == [("DELETED", "a"), ("MODIFIED", "b"), ("ADDED", "c")]
+    assert sorted(informer.pods) == ["b", "c"]
+
+
+def test_informer_list_records_resource_version():
+    api = mock.MagicMock()
+    api.list_namespaced_pod.return_value = client.V1PodList(
+        metadata=client.V1ListMeta(resource_version="123"),
+        items=[_pod("a")],
+    )
+    informer = PodInformer(api=api, namespace="ns", label_selector="component=test")
+    informer._list()
+    assert informer._resource_version == "123"
+    assert list(informer.pods) == ["a"]
+    assert api.list_namespaced_pod.call_args[0] == ("ns",)
+    assert api.list_namespaced_pod.call_args[1]["label_selector"] == "component=test"
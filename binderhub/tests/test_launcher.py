@@ -1,9 +1,15 @@
 """Test launcher"""
 
+import asyncio
+import json
+from unittest import mock
+
 import pytest
 from tornado import web
+from tornado.httpclient import HTTPError
+from tornado.simple_httpclient import HTTPTimeoutError
 
-from binderhub.launcher import Launcher
+from binderhub.launcher import HubUnavailable, Launcher
 
 
 async def my_pre_launch_hook(launcher, *args):
@@ -20,3 +26,291 @@ async def test_pre_launch_hook():
     assert excinfo.value.status_code == 400
     message = excinfo.value.log_message
     assert parameters == message.split(":", 1)[-1].lstrip().split(",")
+
+
+class MockHubLauncher(Launcher):
+    """Launcher with the requests to the Hub API mocked"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+        self.spawn_started = False
+
+    async def api_request(self, url, *args, **kwargs):
+        method = kwargs.get("method", "GET")
+        self.requests.append((method, url))
+        if method == "POST" and url == "users":
+            response = mock.MagicMock(code=201)
+            usernames = json.loads(kwargs["body"])["usernames"]
+            response.body = json.dumps([{"name": name} for name in usernames])
+            return response
+        if method == "POST" and "/servers/" in url:
+            self.spawn_started = True
+            # the Hub replies once the server is ready
+            await asyncio.sleep(0.2)
+            self.requests.append(("REPLY", url))
+        elif url.endswith("/progress"):
+            if not self.spawn_started:
+                raise HTTPError(400)
+            kwargs["streaming_callback"](
+                b'data: {"progress": 100, "ready": true, "message": "ready"}\n\n'
+            )
+
+
+async def test_launch_follows_progress_before_spawn_reply():
+    launcher = MockHubLauncher(hub_url="http://hub/", progress_delay=0)
+    info = await launcher.launch("image", "user-abc")
+    assert info["url"] == "http://hub/user/user-abc/"
+    methods = [method for method, url in launcher.requests]
+    assert methods[0] == "POST"
+    # the progress is requested before the Hub replies to the spawn request
+    assert methods.index("GET") < methods.index("REPLY")
+
+
+async def test_launch_before_spawn():
+    launcher = MockHubLauncher(hub_url="http://hub/")
+
+    async def quota_check():
+        await asyncio.sleep(0.1)
+        raise web.HTTPError(429, "quota exceeded")
+
+    with pytest.raises(web.HTTPError):
+        await launcher.launch("image", "user-abc", before_spawn=quota_check())
+    await asyncio.sleep(0)
+    # the user is created while the quota is checked, and deleted
+    assert launcher.requests == [
+        ("POST", "users/user-abc"),
+        ("DELETE", "users/user-abc"),
+    ]
+
+
+class MockBulkUsersLauncher(Launcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+        self.users = {"taken"}
+
+    async def api_request(self, url, *args, **kwargs):
+        self.requests.append(url)
+        response = mock.MagicMock(code=201)
+        if url == "users":
+            usernames = json.loads(kwargs["body"])["usernames"]
+            if "INVALID" in usernames:
+                raise HTTPError(400)
+            # existing users are skipped
+            created = [name for name in usernames if name not in self.users]
+            self.users.update(created)
+            response.body = json.dumps([{"name": name} for name in created])
+            return response
+        username = url.split("/", 1)[1]
+        if username in self.users or username == "INVALID":
+            raise HTTPError(409 if username in self.users else 400)
+        self.users.add(username)
+        return response
+
+
+async def test_create_users_batch():
+    launcher = MockBulkUsersLauncher()
+    await asyncio.gather(
+        *(launcher._create_temporary_user(f"user-{i}") for i in range(5))
+    )
+    assert launcher.requests == ["users"]
+    assert launcher.users == {"taken"} | {f"user-{i}" for i in range(5)}
+
+    # the users that couldn't be created at once are created one by one
+    launcher.requests = []
+    results = await asyncio.gather(
+        *(
+            launcher._create_temporary_user(name)
+            for name in ["user-a", "INVALID", "user-b"]
+        ),
+        return_exceptions=True,
+    )
+    assert results[0] is None and results[2] is None
+    assert results[1].code == 400
+    assert launcher.requests == [
+        "users",
+        "users/user-a",
+        "users/INVALID",
+        "users/user-b",
+    ]
+
+
+async def test_create_users_batch_error():
+    launcher = MockBulkUsersLauncher()
+
+    async def api_request(url, *args, **kwargs):
+        raise ConnectionRefusedError("hub is down")
+
+    launcher.api_request = api_request
+    # launches don't wait forever for users the Hub couldn't be asked to create
+    results = await asyncio.wait_for(
+        asyncio.gather(
+            *(launcher._create_temporary_user(f"user-{i}") for i in range(3)),
+            return_exceptions=True,
+        ),
+        5,
+    )
+    assert all(isinstance(result, ConnectionRefusedError) for result in results)
+
+    # bad replies from the Hub
+    async def api_request(url, *args, **kwargs):
+        return mock.MagicMock(code=201, body=b"not json")
+
+    launcher.api_request = api_request
+    results = await asyncio.wait_for(
+        asyncio.gather(
+            *(launcher._create_temporary_user(f"user-{i}") for i in range(3)),
+            return_exceptions=True,
+        ),
+        5,
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+async def test_create_users_batch_size():
+    launcher = MockBulkUsersLauncher(create_user_batch_size=2)
+    results = await asyncio.gather(
+        *(launcher._create_temporary_user(f"user-{i}") for i in range(3)),
+        launcher._create_temporary_user("taken"),
+        return_exceptions=True,
+    )
+    assert results[:3] == [None] * 3
+    # users that exist already aren't created
+    assert results[3].code == 409
+    assert launcher.requests.count("users") == 2
+
+
+async def test_user_pool():
+    launcher = MockHubLauncher(hub_url="http://hub/", user_pool_size=2)
+    await launcher.fill_user_pool()
+    pooled = [username for username, _ in launcher._user_pool]
+    assert len(pooled) == 2
+    assert launcher.requests == [("POST", "users")]
+
+    launcher.requests = []
+    info = await launcher.launch("image", "org-repo-abc", repo_url="org/repo")
+    # the newest user is used, and the pool is refilled in the background
+    assert info["url"] == f"http://hub/user/{pooled[1]}/"
+    assert info["binder_launch_name"] == "org-repo-abc"
+    assert ("POST", "users/org-repo-abc") not in launcher.requests
+    await asyncio.sleep(0.1)
+    assert len(launcher._user_pool) == 2
+    assert pooled[1] not in [username for username, _ in launcher._user_pool]
+
+    # unused users are replaced
+    launcher.user_pool_max_age = 0
+    launcher.requests = []
+    await launcher.fill_user_pool()
+    assert sorted(method for method, url in launcher.requests) == [
+        "DELETE",
+        "DELETE",
+        "POST",
+    ]
+
+
+async def test_api_request_fails_fast():
+    http_client = mock.MagicMock()
+    http_client.fetch = mock.AsyncMock(side_effect=HTTPError(502))
+    launcher = Launcher(
+        hub_url="http://hub/", http_client=http_client, retries=3, retry_delay=0
+    )
+    launcher.circuit_breaker.failure_threshold = 2
+    # the circuit opens during the retries of the first request
+    with pytest.raises(HubUnavailable) as excinfo:
+        await launcher.api_request("users/a", method="DELETE")
+    assert http_client.fetch.call_count == 2
+    assert excinfo.value.status_code == 503
+    assert "try again in 10s" in excinfo.value.log_message % excinfo.value.args
+    # other requests aren't sent until the Hub is probed again
+    with pytest.raises(HubUnavailable):
+        await launcher.api_request("users/b", method="DELETE")
+    assert http_client.fetch.call_count == 2
+    assert launcher.concurrency_limit.active == 0
+
+
+async def test_api_request_spawn_failures():
+    http_client = mock.MagicMock()
+    http_client.fetch = mock.AsyncMock(side_effect=HTTPError(500))
+    launcher = Launcher(
+        hub_url="http://hub/", http_client=http_client, retries=1, retry_delay=0
+    )
+    launcher.circuit_breaker.failure_threshold = 2
+    # failed spawns (e.g. of a broken image) don't open the circuit
+    for i in range(5):
+        with pytest.raises(HTTPError):
+            await launcher.api_request(
+                f"users/{i}/servers/", method="POST", long_running=True
+            )
+    assert launcher.circuit_breaker.state == "closed"
+    assert launcher.concurrency_limit.limit == launcher.concurrency_limit.initial_limit
+
+    # nor do streams timing out (e.g. pulling a large image)
+    http_client.fetch.side_effect = HTTPTimeoutError("Timeout")
+    for i in range(5):
+        with pytest.raises(HTTPError):
+            await launcher.api_request(
+                f"users/{i}/server/progress",
+                streaming_callback=lambda chunk: None,
+                long_running=True,
+            )
+    assert launcher.circuit_breaker.state == "closed"
+
+    # but the Hub being unreachable does
+    http_client.fetch.side_effect = HTTPError(502)
+    for i in range(2):
+        with pytest.raises(HTTPError):
+            await launcher.api_request(
+                f"users/{i}/servers/", method="POST", long_running=True
+            )
+    assert launcher.circuit_breaker.state == "open"
+
+
+async def test_api_request_spawn_concurrency_limit():
+    started = asyncio.Event()
+    reply = asyncio.Event()
+
+    async def fetch(req):
+        started.set()
+        await reply.wait()
+        return mock.Mock(code=200)
+
+    http_client = mock.MagicMock()
+    http_client.fetch = fetch
+    launcher = Launcher(hub_url="http://hub/", http_client=http_client)
+    # spawn requests count in the concurrency limit, progress streams don't
+    spawn = asyncio.ensure_future(
+        launcher.api_request("users/a/servers/", method="POST", long_running=True)
+    )
+    await started.wait()
+    assert launcher.concurrency_limit.active == 1
+    started.clear()
+    progress = asyncio.ensure_future(
+        launcher.api_request(
+            "users/a/server/progress",
+            streaming_callback=lambda chunk: None,
+            long_running=True,
+        )
+    )
+    await started.wait()
+    assert launcher.concurrency_limit.active == 1
+    reply.set()
+    await asyncio.gather(spawn, progress)
+    assert launcher.concurrency_limit.active == 0
+
+
+async def test_api_request_spawn_http_client():
+    http_client = mock.MagicMock()
+    http_client.fetch = mock.AsyncMock()
+    spawn_http_client = mock.MagicMock()
+    spawn_http_client.fetch = mock.AsyncMock()
+    launcher = Launcher(
+        hub_url="http://hub/",
+        http_client=http_client,
+        spawn_http_client=spawn_http_client,
+    )
+    # long-running requests don't hold up the connections of other requests
+    await launcher.api_request("users/a/servers/", method="POST", long_running=True)
+    await launcher.api_request("users/a", method="GET")
+    assert spawn_http_client.fetch.call_count == 1
+    assert http_client.fetch.call_count == 1
@@ -0,0 +1,189 @@
+"""Test prewarming popular images"""
+
+import datetime
+from unittest import mock
+
+from kubernetes import client
+
+from binderhub.prewarm import ImagePrewarmer, KubernetesImagePrewarmer
+
+
+def launch(prewarmer, image, times=1):
+    for _ in range(times):
+        prewarmer.record_launch(f"registry.example.org/{image}:abc", image, "abc")
+
+
+def test_popular_images():
+    prewarmer = ImagePrewarmer(min_score=3, half_life=60)
+    now = 1000
+    prewarmer._now = lambda: now
+    launch(prewarmer, "old", 10)
+    launch(prewarmer, "once")
+    now += 60
+    launch(prewarmer, "recent", 6)
+    # the score of old images decays, images launched once aren't popular
+    assert prewarmer.popular_images() == [
+        "registry.example.org/recent:abc",
+        "registry.example.org/old:abc",
+    ]
+    now += 60
+    assert prewarmer.popular_images() == ["registry.example.org/recent:abc"]
+
+
+def test_max_tracked_images():
+    prewarmer = ImagePrewarmer(max_tracked_images=8)
+    launch(prewarmer, "popular", 2)
+    for i in range(8):
+        launch(prewarmer, f"image-{i}")
+    assert len(prewarmer._scores) == 6
+    assert "registry.example.org/popular:abc" in prewarmer._scores
+
+
+async def test_select_images():
+    prewarmer = ImagePrewarmer(min_score=1, max_images=3, max_new_images=2)
+    for i in range(5):
+        launch(prewarmer, f"image-{i}", 10 - i)
+    # new images are added a few at a time
+    await prewarmer.update()
+    assert prewarmer.prewarmed == [
+        "registry.example.org/image-0:abc",
+        "registry.example.org/image-1:abc",
+    ]
+    await prewarmer.update()
+    assert prewarmer.prewarmed == [
+        "registry.example.org/image-0:abc",
+        "registry.example.org/image-1:abc",
+        "registry.example.org/image-2:abc",
+    ]
+
+
+async def test_select_images_registry():
+    registry = mock.MagicMock()
+
+    async def check_images(images):
+        return {image: image[0] != "missing" for image in images}
+
+    async def get_image_manifest(name, tag):
+        return {
+            "config": {"size": 1},
+            "layers": [{"size": 100 if name == "large" else 1}],
+        }
+
+    registry.check_images = check_images
+    registry.get_image_manifest = get_image_manifest
+    prewarmer = ImagePrewarmer(
+        min_score=1, max_new_images=10, max_size=100, registry=registry
+    )
+    launch(prewarmer, "missing", 4)
+    launch(prewarmer, "large", 3)
+    launch(prewarmer, "small", 2)
+    await prewarmer.update()
+    # missing images aren't pulled, images over the size budget are skipped
+    assert prewarmer.prewarmed == ["registry.example.org/small:abc"]
+
+
+def mock_kube_prewarmer(**kwargs):
+    kube = mock.MagicMock()
+    kube.replace_namespaced_daemon_set.side_effect = client.rest.ApiException(
+        status=404
+    )
+    coordination = mock.MagicMock()
+    leases = {}
+
+    def read_namespaced_lease(name, namespace, **kwargs):
+        if name not in leases:
+            raise client.rest.ApiException(status=404)
+        return leases[name]
+
+    def create_namespaced_lease(namespace, lease, **kwargs):
+        lease.metadata.resource_version = "1"
+        leases[lease.metadata.name] = lease
+
+    coordination.read_namespaced_lease.side_effect = read_namespaced_lease
+    coordination.create_namespaced_lease.side_effect = create_namespaced_lease
+    return KubernetesImagePrewarmer(
+        kube=kube, coordination=coordination, namespace="ns", **kwargs
+    )
+
+
+async def test_kubernetes_prewarmer():
+    prewarmer = mock_kube_prewarmer(min_score=1, node_selector={"pool": "user"})
+    kube = prewarmer.kube
+    kube.read_namespaced_daemon_set.side_effect = client.rest.ApiException(status=404)
+    launch(prewarmer, "image", 2)
+    await prewarmer.update()
+    # the lease is taken before updating the DaemonSet
+    prewarmer.coordination.create_namespaced_lease.assert_called_once()
+    kube.create_namespaced_daemon_set.assert_called_once()
+    daemonset = kube.create_namespaced_daemon_set.call_args[0][1]
+    spec = daemonset.spec.template.spec
+    assert [c.image for c in spec.init_containers] == ["registry.example.org/image:abc"]
+    assert spec.node_selector == {"pool": "user"}
+
+    # nothing to prewarm anymore
+    prewarmer.min_score = 10
+    await prewarmer.update()
+    kube.delete_namespaced_daemon_set.assert_called_once()
+
+
+async def test_kubernetes_prewarmer_stable():
+    prewarmer = mock_kube_prewarmer(min_score=1, max_new_images=3)
+    prewarmer.kube.read_namespaced_daemon_set.side_effect = client.rest.ApiException(
+        status=404
+    )
+    launch(prewarmer, "b", 3)
+    launch(prewarmer, "a", 2)
+    await prewarmer.update()
+    daemonset = prewarmer.kube.create_namespaced_daemon_set.call_args[0][1]
+    # images in a stable order, whatever their rank
+    assert [c.image for c in daemonset.spec.template.spec.init_containers] == [
+        "registry.example.org/a:abc",
+        "registry.example.org/b:abc",
+    ]
+    # a change of rank doesn't update the DaemonSet
+    launch(prewarmer, "a", 5)
+    await prewarmer.update()
+    assert prewarmer.kube.create_namespaced_daemon_set.call_count == 1
+
+
+async def test_kubernetes_prewarmer_lease():
+    prewarmer = mock_kube_prewarmer(min_score=1)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lease = client.V1Lease(
+        metadata=client.V1ObjectMeta(name="lease", resource_version="1"),
+        spec=client.V1LeaseSpec(
+            holder_identity="other-replica",
+            lease_duration_seconds=900,
+            renew_time=now,
+        ),
+    )
+    prewarmer.coordination.read_namespaced_lease.side_effect = None
+    prewarmer.coordination.read_namespaced_lease.return_value = lease
+    launch(prewarmer, "image", 2)
+    # another replica updates the DaemonSet
+    await prewarmer.update()
+    prewarmer.kube.create_namespaced_daemon_set.assert_not_called()
+
+    # until it stops renewing the lease
+    lease.spec.renew_time = now - datetime.timedelta(seconds=1000)
+    prewarmer.kube.read_namespaced_daemon_set.return_value = client.V1DaemonSet(
+        spec=client.V1DaemonSetSpec(
+            selector=client.V1LabelSelector(),
+            template=client.V1PodTemplateSpec(
+                spec=client.V1PodSpec(
+                    containers=[],
+                    init_containers=[
+                        client.V1Container(
+                            name="image-0", image="registry.example.org/image:abc"
+                        )
+                    ],
+                )
+            ),
+        )
+    )
+    await prewarmer.update()
+    prewarmer.coordination.replace_namespaced_lease.assert_called_once()
+    assert lease.spec.holder_identity == prewarmer.identity
+    # the images prewarmed by the other replica are kept
+    assert prewarmer.prewarmed == ["registry.example.org/image:abc"]
+    prewarmer.kube.create_namespaced_daemon_set.assert_not_called()
@@ -1,12 +1,21 @@
 """Test launch quotas"""
 
+import asyncio
 import concurrent.futures
 import json
 from unittest import mock
 
 import pytest
+from kubernetes import client
 
-from binderhub.quota import KubernetesLaunchQuota, LaunchQuotaExceeded
+from binderhub.informer import PodInformer
+from binderhub.quota import (
+    KubernetesLaunchQuota,
+    LaunchQuotaExceeded,
+    QuotaReservations,
+    RedisQuotaReservations,
+    ServerQuotaCheck,
+)
 
 
 @pytest.fixture
@@ -43,7 +52,9 @@ def mock_pod_list_resp():
 
 
 async def test_kubernetes_quota_none(mock_pod_list_resp):
-    quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), use_pod_informer=False
+    )
     quota.executor.submit.return_value = mock_pod_list_resp
 
     r = await quota.check_repo_quota(
@@ -53,7 +64,9 @@ async def test_kubernetes_quota_none(mock_pod_list_resp):
 
 
 async def test_kubernetes_quota_allowed(mock_pod_list_resp):
-    quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), use_pod_informer=False
+    )
     quota.executor.submit.return_value = mock_pod_list_resp
 
     r = await quota.check_repo_quota(
@@ -66,7 +79,10 @@ async def test_kubernetes_quota_allowed(mock_pod_list_resp):
 
 async def test_kubernetes_quota_total_exceeded(mock_pod_list_resp):
     quota = KubernetesLaunchQuota(
-        api=mock.MagicMock(), executor=mock.MagicMock(), total_quota=3
+        api=mock.MagicMock(),
+        executor=mock.MagicMock(),
+        total_quota=3,
+        use_pod_informer=False,
     )
     quota.executor.submit.return_value = mock_pod_list_resp
 
@@ -81,7 +97,9 @@ async def test_kubernetes_quota_total_exceeded(mock_pod_list_resp):
 
 
 async def test_kubernetes_quota_repo_exceeded(mock_pod_list_resp):
-    quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), use_pod_informer=False
+    )
     quota.executor.submit.return_value = mock_pod_list_resp
 
     with pytest.raises(LaunchQuotaExceeded) as excinfo:
@@ -92,3 +110,163 @@ async def test_kubernetes_quota_repo_exceeded(mock_pod_list_resp):
     assert excinfo.value.quota == 2
     assert excinfo.value.used == 2
     assert excinfo.value.status == "repo_quota"
+
+
+def _pod(name, image):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name),
+        spec=client.V1PodSpec(containers=[client.V1Container(name="c", image=image)]),
+    )
+
+
+async def test_kubernetes_quota_informer(mock_pod_list_resp):
+    informer = PodInformer(api=mock.MagicMock())
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), pod_informer=informer
+    )
+    quota.executor.submit.return_value = mock_pod_list_resp
+
+    with mock.patch.object(informer, "start") as start:
+        # pods are listed until the informer is ready
+        r = await quota.check_repo_quota(
+            "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+        )
+    start.assert_called_once()
+    assert quota.executor.submit.call_count == 1
+    assert (r.total, r.matching) == (3, 2)
+
+    informer._replace(
+        {
+            "a": _pod("a", "example.org/test/kubernetes_quota:1.2.3"),
+            "b": _pod("b", "example.org/test/other:abc"),
+        }
+    )
+    r = await quota.check_repo_quota(
+        "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+    )
+    assert (r.total, r.matching) == (2, 1)
+
+    # counts are kept up to date from pod events
+    informer._dispatch("ADDED", _pod("c", "example.org/test/kubernetes_quota:4.5"))
+    informer._dispatch("MODIFIED", _pod("b", "example.org/test/kubernetes_quota:1"))
+    with pytest.raises(LaunchQuotaExceeded):
+        await quota.check_repo_quota(
+            "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+        )
+    informer._dispatch("DELETED", _pod("a", "example.org/test/kubernetes_quota:1.2.3"))
+    r = await quota.check_repo_quota(
+        "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+    )
+    assert (r.total, r.matching) == (2, 2)
+    # no more listing
+    assert quota.executor.submit.call_count == 1
+
+
+@pytest.fixture(params=["memory", "redis"])
+def reservations(request):
+    if request.param == "memory":
+        return QuotaReservations()
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisQuotaReservations(redis=fakeredis.FakeAsyncRedis())
+
+
+async def test_quota_reservations(reservations):
+    r1, total, matching = await reservations.reserve("image-a", 60)
+    assert (total, matching) == (1, 1)
+    r2, total, matching = await reservations.reserve("image-b", 60)
+    assert (total, matching) == (2, 1)
+    r3, total, matching = await reservations.reserve("image-a", 60)
+    assert (total, matching) == (3, 2)
+    assert await reservations.count("image-a") == (3, 2)
+
+    await reservations.release(r1)
+    # releasing twice is fine
+    await reservations.release(r1)
+    assert await reservations.count("image-a") == (2, 1)
+    await reservations.release(r2)
+    await reservations.release(r3)
+    assert await reservations.count("image-a") == (0, 0)
+
+
+async def test_quota_reservations_timeout(reservations):
+    await reservations.reserve("image-a", 0.1)
+    await reservations.reserve("image-a", 60)
+    assert await reservations.count("image-a") == (2, 2)
+    await asyncio.sleep(0.2)
+    assert await reservations.count("image-a") == (1, 1)
+
+
+async def test_kubernetes_quota_reservations(mock_pod_list_resp):
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), use_pod_informer=False
+    )
+    quota.executor.submit.return_value = mock_pod_list_resp
+    image = "example.org/test/kubernetes_quota"
+
+    # 2 running pods, quota of 4: only 2 concurrent launches can be reserved
+    checks = await asyncio.gather(
+        *(
+            quota.check_repo_quota(image, {"quota": 4}, "repo.url", reserve=True)
+            for _ in range(3)
+        ),
+        return_exceptions=True,
+    )
+    assert [type(check) for check in checks].count(LaunchQuotaExceeded) == 1
+    reservations = [
+        check.reservation for check in checks if isinstance(check, ServerQuotaCheck)
+    ]
+    assert len(reservations) == 2
+    assert await quota.reservations.count(image) == (2, 2)
+
+    # checks without reservation count pending launches too
+    with pytest.raises(LaunchQuotaExceeded):
+        await quota.check_repo_quota(image, {"quota": 4}, "repo.url")
+
+    await quota.release(reservations[0])
+    r = await quota.check_repo_quota(image, {"quota": 4}, "repo.url")
+    assert (r.total, r.matching, r.reservation) == (4, 3, None)
+
+
+def _server_pod(username, image):
+    pod = _pod(f"jupyter-{username}", image)
+    pod.metadata.annotations = {"hub.jupyter.org/username": username}
+    return pod
+
+
+async def test_kubernetes_quota_reservations_released_with_pods():
+    informer = PodInformer(api=mock.MagicMock())
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), pod_informer=informer
+    )
+    quota.total_quota = 4
+    image = "example.org/test/kubernetes_quota"
+    with mock.patch.object(informer, "start"):
+        informer._replace({})
+
+        # the pods of launches in progress are only counted once
+        for i in range(4):
+            check = await quota.check_repo_quota(
+                f"{image}:{i}", {}, "repo.url", reserve=True
+            )
+            assert check.total == i
+            quota.assign(check.reservation, f"user-{i}")
+            informer._dispatch("ADDED", _server_pod(f"user-{i}", f"{image}:{i}"))
+            # released by the pod event
+            await asyncio.sleep(0)
+            assert await quota.reservations.count(image) == (0, 0)
+        with pytest.raises(LaunchQuotaExceeded):
+            await quota.check_repo_quota(image, {}, "repo.url", reserve=True)
+
+        # pods that already exist release the reservation right away
+        informer._dispatch("DELETED", _server_pod("user-0", f"{image}:0"))
+        check = await quota.check_repo_quota(image, {}, "repo.url", reserve=True)
+        informer._dispatch("ADDED", _server_pod("user-4", f"{image}:4"))
+        quota.assign(check.reservation, "user-4")
+        await asyncio.sleep(0)
+        assert await quota.reservations.count(image) == (0, 0)
+        # released by the launch, before the pod exists
+        informer._dispatch("DELETED", _server_pod("user-1", f"{image}:1"))
+        check = await quota.check_repo_quota(image, {}, "repo.url", reserve=True)
+        quota.assign(check.reservation, "user-5")
+        await quota.release(check.reservation)
+        assert not quota._assigned
@@ -1,79 +1,172 @@
+import asyncio
+import math
 from unittest import mock
 
 import pytest
 
-from binderhub.ratelimit import RateLimiter, RateLimitExceeded
+from binderhub.ratelimit import RateLimiter, RateLimitExceeded, RedisRateLimiter
 
 
 def test_rate_limit():
     r = RateLimiter(limit=10, period_seconds=60)
-    assert r._limits == {}
+    assert len(r._limits) == 0
     now = r.time()
-    reset = int(now) + 60
     with mock.patch.object(r, "time", lambda: now):
         limit = r.increment("1.2.3.4")
-    assert limit == {
-        "remaining": 9,
-        "reset": reset,
-    }
-    assert r._limits == {
-        "1.2.3.4": limit,
-    }
-    for i in range(1, 10):
-        limit = r.increment("1.2.3.4")
         assert limit == {
-            "remaining": 9 - i,
-            "reset": reset,
+            "remaining": 9,
+            "reset": math.ceil(now + 6),
         }
+        assert list(r._limits) == ["1.2.3.4"]
+        for i in range(1, 10):
+            limit = r.increment("1.2.3.4")
+            assert limit["remaining"] == 9 - i
 
-    for i in range(5):
-        with pytest.raises(RateLimitExceeded):
-            r.increment("1.2.3.4")
-
-    assert r._limits["1.2.3.4"]["remaining"] == -5
+        for i in range(5):
+            with pytest.raises(RateLimitExceeded) as excinfo:
+                r.increment("1.2.3.4")
+            # one request every 6 seconds
+            assert excinfo.value.retry_after == 6
 
 
-def test_rate_limit_expires():
+def test_rate_limit_refill():
     r = RateLimiter(limit=10, period_seconds=60)
-    assert r._limits == {}
     now = r.time()
+    with mock.patch.object(r, "time", lambda: now):
+        for i in range(10):
+            r.increment("1.2.3.4")
+        with pytest.raises(RateLimitExceeded):
+            r.increment("1.2.3.4")
 
-    for i in range(5):
+    # one request is allowed every 6 seconds
+    with mock.patch.object(r, "time", lambda: now + 7):
         limit = r.increment("1.2.3.4")
+        assert limit["remaining"] == 0
+        with pytest.raises(RateLimitExceeded):
+            r.increment("1.2.3.4")
 
-    # now expire period, should get fresh limit
-    with mock.patch.object(r, "time", lambda: now + 65):
+    # full again after period_seconds
+    with mock.patch.object(r, "time", lambda: now + 7 + 65):
         limit = r.increment("1.2.3.4")
-    assert limit == {
-        "remaining": 9,
-        "reset": int(now) + 65 + 60,
-    }
+    assert limit["remaining"] == 9
+
+
+def test_rate_limit_separate_limits():
+    r = RateLimiter(limit=10, period_seconds=60)
+    for i in range(10):
+        r.increment("1.2.3.4")
+    with pytest.raises(RateLimitExceeded):
+        r.increment("1.2.3.4")
+    limit = r.increment("user:someone", limit=100)
+    assert limit["remaining"] == 99
 
 
 def test_rate_limit_clean():
     r = RateLimiter(limit=10, period_seconds=60)
-    assert r._limits == {}
     now = r.time()
 
-    r.increment("1.2.3.4")
+    with mock.patch.object(r, "time", lambda: now):
+        r.increment("1.2.3.4")
 
     with mock.patch.object(r, "time", lambda: now + 30):
-        limit2 = r.increment("4.3.2.1")
+        r.increment("4.3.2.1")
 
-    # force clean, shouldn't expire
-    r._last_cleaned = now - r.clean_seconds
+    # 1.2.3.4 is still in use
     with mock.patch.object(r, "time", lambda: now + 35):
         limit2 = r.increment("4.3.2.1")
-
     assert "1.2.3.4" in r._limits
 
-    # force clean again, should expire
-    r._last_cleaned = now - r.clean_seconds
+    # 1.2.3.4 is full again, forgotten
     with mock.patch.object(r, "time", lambda: now + 65):
         limit2 = r.increment("4.3.2.1")
-
-    assert r._last_cleaned == now + 65
     assert "1.2.3.4" not in r._limits
     assert "4.3.2.1" in r._limits
-    # 4.3.2.1 hasn't expired, still consuming rate limit
-    assert limit2["remaining"] == 7
+    # 4.3.2.1 has been refilled since the last request
+    assert limit2["remaining"] == 9
+
+
+def test_rate_limit_clean_incremental():
+    r = RateLimiter(limit=10, period_seconds=60)
+    now = r.time()
+    with mock.patch.object(r, "time", lambda: now):
+        for i in range(100):
+            r.increment(f"10.0.0.{i}")
+
+    # expired limits are removed a few at a time
+    with mock.patch.object(r, "time", lambda: now + 65):
+        r.increment("1.2.3.4")
+        assert len(r._limits) == 100 - r._max_evictions + 1
+        for i in range(6):
+            r.increment("1.2.3.4")
+    assert list(r._limits) == ["1.2.3.4"]
+
+
+@pytest.fixture
+def fake_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeAsyncRedis()
+
+
+async def test_redis_rate_limit_shared(fake_redis):
+    # two replicas sharing the same limits
+    replicas = [
+        RedisRateLimiter(limit=10, period_seconds=60, redis=fake_redis)
+        for _ in range(2)
+    ]
+    now = 6000
+    for r in replicas:
+        r.time = lambda: now
+    for i in range(10):
+        limit = await replicas[i % 2].async_increment("1.2.3.4")
+        # the bucket refills at one request every 6 seconds
+        assert limit["remaining"] == 9 - i
+        assert limit["reset"] == now + 6 * (i + 1)
+    for r in replicas:
+        with pytest.raises(RateLimitExceeded) as excinfo:
+            await r.async_increment("1.2.3.4")
+        assert excinfo.value.retry_after == 6
+    # other keys have their own limit
+    await replicas[0].async_increment("4.3.2.1")
+
+    # refilled, one request at a time
+    now += 6
+    await replicas[1].async_increment("1.2.3.4")
+    with pytest.raises(RateLimitExceeded):
+        await replicas[0].async_increment("1.2.3.4")
+
+
+async def test_redis_rate_limit_batches(fake_redis):
+    r = RedisRateLimiter(limit=100, period_seconds=60, redis=fake_redis)
+    r.time = lambda: 6000
+    with mock.patch.object(r, "_claim", wraps=r._claim) as claim:
+        for i in range(100):
+            await r.async_increment("1.2.3.4")
+        for i in range(5):
+            with pytest.raises(RateLimitExceeded):
+                await r.async_increment("1.2.3.4")
+    # 10 requests claimed at a time, rejected requests don't go back to Redis
+    assert claim.call_count == 11
+
+
+async def test_redis_rate_limit_concurrent(fake_redis):
+    r = RedisRateLimiter(limit=100, period_seconds=60, redis=fake_redis)
+    r.time = lambda: 6000
+    results = await asyncio.gather(
+        *(r.async_increment("1.2.3.4") for _ in range(110)),
+        return_exceptions=True,
+    )
+    # concurrent requests share claims, none of the claimed tokens are lost
+    allowed = [result for result in results if isinstance(result, dict)]
+    assert len(allowed) == 100
+    assert float(await fake_redis.hget("binderhub:ratelimit:1.2.3.4", "tokens")) == 0
+
+
+async def test_redis_rate_limit_unavailable():
+    redis = mock.MagicMock()
+    redis.pipeline.side_effect = ConnectionError("redis is down")
+    r = RedisRateLimiter(limit=2, period_seconds=60, redis=redis)
+    # falls back to local limits
+    for i in range(2):
+        await r.async_increment("1.2.3.4")
+    with pytest.raises(RateLimitExceeded):
+        await r.async_increment("1.2.3.4")
@@ -0,0 +1,201 @@
+"""Test caching resolved refs"""
+
+import asyncio
+from unittest import mock
+
+import pytest
+
+from binderhub.refcache import RedisRefCache, RefCache, SQLiteRefCache
+from binderhub.repoproviders import GitHubRepoProvider, ZenodoProvider, cached_ref
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def ref_cache(request, tmpdir):
+    if request.param == "memory":
+        return RefCache()
+    if request.param == "sqlite":
+        return SQLiteRefCache(path=str(tmpdir.join("refs.sqlite")))
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisRefCache(redis=fakeredis.FakeAsyncRedis())
+
+
+async def test_ref_cache(ref_cache):
+    assert await ref_cache.get("a") is None
+    await ref_cache.set("a", {"ref": "abc"}, 60)
+    assert await ref_cache.get("a") == {"ref": "abc"}
+    await ref_cache.set("a", {"ref": "def"}, 60)
+    assert await ref_cache.get("a") == {"ref": "def"}
+    await ref_cache.delete("a")
+    assert await ref_cache.get("a") is None
+
+
+async def test_ref_cache_expiry():
+    ref_cache = RefCache()
+    with mock.patch.object(ref_cache, "_now", return_value=100):
+        await ref_cache.set("a", {"ref": "abc"}, 10)
+    with mock.patch.object(ref_cache, "_now", return_value=105):
+        assert await ref_cache.get("a") == {"ref": "abc"}
+    with mock.patch.object(ref_cache, "_now", return_value=111):
+        assert await ref_cache.get("a") is None
+
+
+async def test_ref_cache_max_size():
+    ref_cache = RefCache(max_size=2)
+    for key in "abc":
+        await ref_cache.set(key, {"ref": key}, 60)
+    assert await ref_cache.get("a") is None
+    assert await ref_cache.get("c") == {"ref": "c"}
+
+
+class CountingZenodoProvider(ZenodoProvider):
+    resolved = 0
+
+    @cached_ref
+    async def get_resolved_ref(self):
+        CountingZenodoProvider.resolved += 1
+        if self.spec.endswith("missing"):
+            return None
+        self.record_id = "3242074"
+        return f"zenodo/{self.record_id}"
+
+
+async def test_cached_ref(ref_cache):
+    CountingZenodoProvider.resolved = 0
+
+    provider = CountingZenodoProvider(
+        spec="10.5281/zenodo.3242074", ref_cache=ref_cache, ref_cache_ttl=60
+    )
+    assert await provider.get_resolved_ref() == "zenodo/3242074"
+
+    # another provider, e.g. in another request or replica
+    provider = CountingZenodoProvider(
+        spec="10.5281/zenodo.3242074", ref_cache=ref_cache, ref_cache_ttl=60
+    )
+    assert await provider.get_resolved_ref() == "zenodo/3242074"
+    assert provider.record_id == "3242074"
+    assert provider.get_build_slug() == "zenodo-3242074"
+    assert CountingZenodoProvider.resolved == 1
+
+    # refs that couldn't be resolved are cached too
+    for _ in range(2):
+        provider = CountingZenodoProvider(
+            spec="10.5281/missing", ref_cache=ref_cache, ref_cache_ttl=60
+        )
+        assert await provider.get_resolved_ref() is None
+    assert CountingZenodoProvider.resolved == 2
+
+
+async def test_sqlite_ref_cache_prune(tmpdir):
+    ref_cache = SQLiteRefCache(path=str(tmpdir.join("refs.sqlite")), prune_interval=60)
+    now = 1000
+    ref_cache._now = lambda: now
+    await ref_cache.set("a", {"ref": "abc"}, 10)
+    now += 20
+    # expired refs are only deleted every prune_interval
+    await ref_cache.set("b", {"ref": "def"}, 10)
+    assert ref_cache.db.execute("SELECT COUNT(*) FROM refs").fetchone()[0] == 2
+    assert await ref_cache.get("a") is None
+    now += 60
+    await ref_cache.set("c", {"ref": "ghi"}, 10)
+    assert ref_cache.db.execute("SELECT key FROM refs").fetchall() == [("c",)]
+
+
+async def test_cached_ref_disabled():
+    CountingZenodoProvider.resolved = 0
+    ref_cache = RefCache()
+    for _ in range(2):
+        provider = CountingZenodoProvider(
+            spec="10.5281/zenodo.3242074", ref_cache=ref_cache, ref_cache_ttl=0
+        )
+        assert await provider.get_resolved_ref() == "zenodo/3242074"
+    assert CountingZenodoProvider.resolved == 2
+
+
+async def test_cached_ref_broken_cache():
+    ref_cache = mock.MagicMock(spec=RefCache)
+    ref_cache.get.side_effect = ConnectionError("redis is down")
+    ref_cache.set.side_effect = ConnectionError("redis is down")
+    provider = CountingZenodoProvider(
+        spec="10.5281/zenodo.3242074", ref_cache=ref_cache, ref_cache_ttl=60
+    )
+    assert await provider.get_resolved_ref() == "zenodo/3242074"
+
+
+async def test_github_shared_etag():
+    ref_cache = RefCache()
+    requests = []
+
+    async def github_api_request(api_url, etag=None):
+        requests.append(etag)
+        resp = mock.MagicMock()
+        if etag == '"abc"':
+            resp.code = 304
+        else:
+            resp.code = 200
+            resp.headers = {"ETag": '"abc"'}
+            resp.body = b'{"sha": "123abc"}'
+        return resp
+
+    for _ in range(2):
+        # refs aren't cached, but their ETags are
+        provider = GitHubRepoProvider(
+            spec="jupyterhub/binderhub/main", ref_cache=ref_cache, ref_cache_ttl=0
+        )
+        provider.github_api_request = github_api_request
+        assert await provider.get_resolved_ref() == "123abc"
+    assert requests == [None, '"abc"']
+
+
+class SlowZenodoProvider(ZenodoProvider):
+    resolved = 0
+
+    @cached_ref
+    async def get_resolved_ref(self):
+        SlowZenodoProvider.resolved += 1
+        await asyncio.sleep(0.1)
+        if self.spec.endswith("error"):
+            raise ValueError("Zenodo is down")
+        self.record_id = "3242074"
+        return f"zenodo/{self.record_id}"
+
+
+@pytest.mark.parametrize("ref_cache", [None, RefCache()])
+async def test_concurrent_resolutions(ref_cache):
+    SlowZenodoProvider.resolved = 0
+    providers = [
+        SlowZenodoProvider(
+            spec="10.5281/zenodo.3242074", ref_cache=ref_cache, ref_cache_ttl=60
+        )
+        for _ in range(10)
+    ]
+    refs = await asyncio.gather(*(p.get_resolved_ref() for p in providers))
+    assert refs == ["zenodo/3242074"] * 10
+    assert [p.record_id for p in providers] == ["3242074"] * 10
+    assert SlowZenodoProvider.resolved == 1
+
+
+async def test_concurrent_resolutions_error():
+    SlowZenodoProvider.resolved = 0
+    providers = [SlowZenodoProvider(spec="10.5281/error") for _ in range(3)]
+    results = await asyncio.gather(
+        *(p.get_resolved_ref() for p in providers), return_exceptions=True
+    )
+    assert [type(r) for r in results] == [ValueError] * 3
+    assert SlowZenodoProvider.resolved == 1
+
+    # errors aren't kept, the next request tries again
+    with pytest.raises(ValueError):
+        await SlowZenodoProvider(spec="10.5281/error").get_resolved_ref()
+    assert SlowZenodoProvider.resolved == 2
+
+
+async def test_concurrent_resolution_cancelled():
+    SlowZenodoProvider.resolved = 0
+    first = asyncio.ensure_future(
+        SlowZenodoProvider(spec="10.5281/zenodo.3242074").get_resolved_ref()
+    )
+    await asyncio.sleep(0)
+    second = SlowZenodoProvider(spec="10.5281/zenodo.3242074").get_resolved_ref()
+    first.cancel()
+    assert await second == "zenodo/3242074"
+    assert SlowZenodoProvider.resolved == 1
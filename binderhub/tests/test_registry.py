@@ -1,9 +1,11 @@
 """Tests for the registry"""
 
+import asyncio
 import base64
 import json
 import secrets
 from random import randint
+from unittest import mock
 
 import pytest
 from tornado import httpclient
@@ -140,13 +142,24 @@ class MockManifestHandler(RequestHandler):
     def initialize(self, test_handle):
         self.test_handle = test_handle
 
-    def get(self, image, tag):
+    def _check_auth(self):
         auth_header = self.request.headers.get("Authorization", "")
         if not auth_header.startswith("Bearer "):
             raise HTTPError(401, "No bearer auth")
         token = auth_header[7:]
         if token != self.test_handle["token"]:
-            raise HTTPError(403, "{} != {}".format(token, self.test_handle["token"]))
+            # e.g. a revoked token
+            raise HTTPError(401, "{} != {}".format(token, self.test_handle["token"]))
+
+    def head(self, image, tag):
+        self._check_auth()
+        self.test_handle["head_accept"] = self.request.headers["Accept"]
+        if image == "missing":
+            raise HTTPError(404)
+        self.set_header("Content-Type", "application/vnd.oci.image.index.v1+json")
+
+    def get(self, image, tag):
+        self._check_auth()
         self.set_header("Content-Type", "application/json")
         # get_image_manifest never looks at the contents here
         self.write(json.dumps({"image": image, "tag": tag}))
@@ -243,6 +256,16 @@ async def test_get_image_manifest(tmpdir, token_url_known):
     manifest = await registry.get_image_manifest("myimage", "abc123")
     assert manifest == {"image": "myimage", "tag": "abc123"}
 
+    assert await registry.image_exists("myimage", "abc123")
+    assert "application/vnd.oci.image.index.v1+json" in test_handle["head_accept"]
+    assert not await registry.image_exists("missing", "abc123")
+
+    # a cached token that is rejected is replaced
+    test_handle["token"] = "revoked"
+    manifest = await registry.get_image_manifest("myimage", "abc123")
+    assert manifest == {"image": "myimage", "tag": "abc123"}
+    assert test_handle["token"] != "revoked"
+
 
 class FakeExternalRegistryHandler(RequestHandler):
     def initialize(self, store):
@@ -388,3 +411,148 @@ async def test_external_registry_helper_token(fake_external_registry):
     assert len(request_store) == 1
     assert request_store[0].method == "POST"
     assert request_store[0].uri == "/token/owner/my-repo:tag"
+
+
+async def test_external_registry_helper_check_images(fake_external_registry):
+    service, request_store = fake_external_registry
+
+    registry = ExternalRegistryHelper(
+        service_url=service,
+        auth_token="registry-token",
+    )
+
+    r = await registry.check_images(
+        [("owner/my-repo", "tag"), ("owner/new-repo", "tag")]
+    )
+    assert r == {("owner/my-repo", "tag"): True, ("owner/new-repo", "tag"): False}
+    # repositories aren't created
+    assert sorted((r.method, r.uri) for r in request_store) == [
+        ("GET", "/image/owner/my-repo:tag"),
+        ("GET", "/image/owner/new-repo:tag"),
+    ]
+
+
+class CountingRegistry(DockerRegistry):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.images = {"exists:abc123"}
+        self.requests = 0
+
+    async def _image_exists(self, image, tag):
+        self.requests += 1
+        return f"{image}:{tag}" in self.images
+
+
+async def test_image_exists_cache():
+    registry = CountingRegistry(url="https://registry.example.org")
+    for _ in range(3):
+        assert await registry.image_exists("exists", "abc123")
+        assert not await registry.image_exists("missing", "abc123")
+    assert registry.requests == 2
+
+    # the missing image is built, forget it is missing
+    registry.images.add("missing:abc123")
+    registry.invalidate_image("missing", "abc123")
+    assert await registry.image_exists("missing", "abc123")
+    assert registry.requests == 3
+
+
+async def test_image_exists_negative_ttl():
+    registry = CountingRegistry(
+        url="https://registry.example.org", image_cache_negative_ttl=0
+    )
+    for _ in range(2):
+        assert not await registry.image_exists("missing", "abc123")
+    assert registry.requests == 2
+
+
+class CountingTokenRegistry(DockerRegistry):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.token_requests = 0
+
+    async def _request_token(self, client, token_url, service, scope):
+        self.token_requests += 1
+        await asyncio.sleep(0.01)
+        return f"token-{self.token_requests}", 60
+
+
+async def test_token_cache():
+    registry = CountingTokenRegistry(url="https://registry.example.org")
+    client = httpclient.AsyncHTTPClient()
+
+    def get_token(scope="repository:a:pull"):
+        return registry._get_token(client, "https://token", "service", scope)
+
+    with mock.patch.object(registry, "_now", return_value=1000):
+        # concurrent requests share a single token request
+        tokens = await asyncio.gather(*(get_token() for _ in range(5)))
+        assert tokens == ["token-1"] * 5
+        # each scope has its own token
+        assert await get_token("repository:b:pull") == "token-2"
+
+    with mock.patch.object(registry, "_now", return_value=1020):
+        assert await get_token() == "token-1"
+        assert registry.token_requests == 2
+
+    # about to expire, refreshed in the background
+    with mock.patch.object(registry, "_now", return_value=1040):
+        assert await get_token() == "token-1"
+        await asyncio.sleep(0.05)
+        assert registry.token_requests == 3
+        assert await get_token() == "token-3"
+
+    # expired
+    with mock.patch.object(registry, "_now", return_value=1200):
+        assert await get_token() == "token-4"
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        ({"token": "abc"}, 60),
+        ({"token": "abc", "expires_in": 300}, 300),
+        ({"token": "abc", "expires_in": 300, "issued_at": "bad"}, 300),
+        (
+            {
+                "token": "abc",
+                "expires_in": 300,
+                "issued_at": "2009-11-10T23:00:00.123456789Z",
+            },
+            150,
+        ),
+    ],
+)
+def test_token_expires_in(response, expected):
+    registry = DockerRegistry(url="https://registry.example.org")
+    assert registry._token_expires_in(response) == expected
+
+
+async def test_check_images():
+    class BrokenRegistry(CountingRegistry):
+        running = 0
+        max_running = 0
+
+        async def _image_exists(self, image, tag):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            if image == "broken":
+                raise httpclient.HTTPClientError(500)
+            return await super()._image_exists(image, tag)
+
+    registry = BrokenRegistry(
+        url="https://registry.example.org", check_images_concurrency=4
+    )
+    images = [("exists", "abc123"), ("broken", "abc123")]
+    images += [("missing", str(i)) for i in range(20)]
+    # duplicates are checked once
+    images.append(("exists", "abc123"))
+    results = await registry.check_images(images)
+    assert len(results) == 22
+    assert results[("exists", "abc123")] is True
+    assert results[("broken", "abc123")] is None
+    assert results[("missing", "0")] is False
+    assert registry.max_running == 4
+    assert registry.requests == 21
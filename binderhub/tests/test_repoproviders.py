@@ -4,6 +4,7 @@ from urllib.parse import quote
 
 import pytest
 from tornado.ioloop import IOLoop
+from traitlets.config import Config
 
 from binderhub.repoproviders import (
     CKANProvider,
@@ -14,6 +15,7 @@ from binderhub.repoproviders import (
     GitLabRepoProvider,
     GitRepoProvider,
     HydroshareProvider,
+    SpecMatcher,
     ZenodoProvider,
     strip_suffix,
     tokenize_spec,
@@ -408,6 +410,50 @@ def test_ban_is_case_insensitive(ban_spec):
     assert provider.is_banned()
 
 
+@pytest.mark.parametrize(
+    "patterns, combined",
+    [
+        (["^yuvipanda.*", ".*ZERO-to-.*", "a/b"], True),
+        # can't be combined
+        (["^yuvipanda.*", r"(.)\1.*", ".*ZERO-to-.*", "a/b"], False),
+        (["(?P<org>yuvipanda).*", "(?P<org>.*)ZERO-to-.*", "a/b"], False),
+        (["^yuvipanda.*", "(a)?(?(1)b|c)x", ".*ZERO-to-.*", "a/b"], False),
+    ],
+)
+def test_spec_matcher(patterns, combined):
+    matcher = SpecMatcher(patterns)
+    assert (matcher._combined is not None) == combined
+    spec = "jupyterhub/zero-to-jupyterhub-k8s/v0.4"
+    for _ in range(2):
+        assert matcher.matches(spec)
+        assert [patterns[i] for i in matcher.matching(spec)] == [patterns[-2]]
+        assert matcher.matches("a/b/HEAD")
+        assert not matcher.matches("b/a/HEAD")
+        assert matcher.matching("b/a/HEAD") == ()
+
+
+def test_build_spec_matchers():
+    config = Config(
+        {
+            "RepoProvider": {"banned_specs": ["^a/"]},
+            "GitHubRepoProvider": {"high_quota_specs": ["^b/"]},
+            "GitLabRepoProvider": {"banned_specs": ["^c/"]},
+        }
+    )
+    matchers = GitHubRepoProvider.build_spec_matchers(config)
+
+    def provider(spec):
+        return GitHubRepoProvider(spec=spec, config=config, spec_matchers=matchers)
+
+    assert provider("a/b/HEAD").is_banned()
+    assert not provider("c/a/HEAD").is_banned()
+    assert provider("b/c/HEAD").has_higher_quota()
+    # the same matchers as the provider's own config
+    own_matchers = GitHubRepoProvider(spec="a/b/HEAD", config=config).spec_matchers
+    assert own_matchers.banned.patterns == matchers.banned.patterns
+    assert own_matchers.high_quota.patterns == matchers.high_quota.patterns
+
+
 @pytest.mark.github_api
 def test_github_missing_ref():
     provider = GitHubRepoProvider(
@@ -0,0 +1,64 @@
+"""Test decoding server-sent event streams"""
+
+import pytest
+
+from binderhub.sse import EventStreamQueue, ServerSentEvent, SSEDecoder
+
+STREAM = (
+    b"\xef\xbb\xbf: keepalive\r\n"
+    b"retry: 1000\r\n"
+    b'data: {"progress": 10}\r\n'
+    b"\r\n"
+    b"event: update\n"
+    b"id: 1\n"
+    b"data: first line\n"
+    b"data:second line\n"
+    b"\n"
+    b"data: cr\r\r"
+    b"id: 2\n"
+    b"\n"
+)
+
+EVENTS = [
+    ServerSentEvent(data='{"progress": 10}', event="message", id=""),
+    ServerSentEvent(data="first line\nsecond line", event="update", id="1"),
+    # the last event id is kept for the next events
+    ServerSentEvent(data="cr", event="message", id="1"),
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, len(STREAM)])
+def test_sse_decoder(chunk_size):
+    decoder = SSEDecoder()
+    events = []
+    for i in range(0, len(STREAM), chunk_size):
+        events.extend(decoder.decode(STREAM[i : i + chunk_size]))
+    assert events == EVENTS
+    assert decoder.retry == 1000
+    assert decoder.last_event_id == "2"
+
+
+def test_sse_decoder_long_line():
+    decoder = SSEDecoder()
+    for _ in range(1000):
+        assert decoder.decode(b"x" * 100) == []
+    # the partial line isn't scanned again for each chunk
+    assert decoder._scanned == 100000
+    assert decoder.decode(b"\n") == []
+    assert decoder.decode(b"data: done\n\n") == [
+        ServerSentEvent(data="done", event="message", id="")
+    ]
+
+
+async def test_event_stream_queue():
+    queue = EventStreamQueue()
+    callback = queue.streaming_callback()
+    callback(STREAM[:40])
+    callback(STREAM[40:])
+    # a new response has its own decoder
+    queue.streaming_callback()(b"data: next\n\n")
+    queue.close()
+    events = [event async for event in queue.events()]
+    assert [event.data for event in events] == [event.data for event in EVENTS] + [
+        "next"
+    ]
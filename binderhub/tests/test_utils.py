@@ -127,3 +127,51 @@ def test_ip_in_networks(ip, cidrs, found):
         assert str(match) in cidrs
     else:
         assert match is False
+
+    index = utils.NetworkIndex({ipaddress.ip_network(c): "" for c in cidrs})
+    match = utils.ip_in_networks(ip, index)
+    if found:
+        assert str(match) in cidrs
+    else:
+        assert match is False
+
+
+@pytest.mark.parametrize(
+    "ip, expected",
+    [
+        ("10.1.2.3", "10.1.2.0/24"),
+        ("10.1.3.3", "10.1.0.0/16"),
+        ("10.2.3.3", "10.0.0.0/8"),
+        ("11.0.0.1", None),
+        ("192.168.1.1", "192.168.1.1/32"),
+        ("192.168.1.2", None),
+        ("8.8.8.8", None),
+        ("2001:db8::1", "2001:db8::/32"),
+        ("2001:db9::1", None),
+        ("::1", None),
+    ],
+)
+def test_network_index(ip, expected):
+    index = utils.NetworkIndex(
+        {
+            ipaddress.ip_network(cidr): cidr
+            for cidr in [
+                "10.0.0.0/8",
+                "10.1.2.0/24",
+                "10.1.0.0/16",
+                "192.168.1.1/32",
+                "2001:db8::/32",
+            ]
+        }
+    )
+    match = index.match(ip)
+    if expected is None:
+        assert match is None
+    else:
+        assert index[match] == expected
+
+
+def test_network_index_everything():
+    index = utils.NetworkIndex({ipaddress.ip_network("0.0.0.0/0"): "all"})
+    assert index.match("1.2.3.4") == ipaddress.ip_network("0.0.0.0/0")
+    assert index.match("::1") is None
@@ -0,0 +1,137 @@
+"""Test keeping idle servers for popular images"""
+
+import asyncio
+
+from binderhub.launcher import Launcher
+from binderhub.quota import LaunchQuota, LaunchQuotaExceeded, ServerQuotaCheck
+from binderhub.warmpool import WarmPool
+
+
+class MockLauncher(Launcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.launched = []
+        self.launch_args = []
+        self.deleted = []
+
+    async def launch(
+        self, image, username, server_name="", repo_url="", extra_args=None, **kwargs
+    ):
+        self.launched.append(username)
+        self.launch_args.append(extra_args)
+        if kwargs.get("spawn_callback"):
+            kwargs["spawn_callback"](username, server_name)
+        await asyncio.sleep(0)
+        return {"url": f"http://hub/user/{username}/", "token": "abc", "image": image}
+
+    async def api_request(self, url, *args, **kwargs):
+        self.deleted.append(url)
+
+
+async def test_warm_pool():
+    launcher = MockLauncher()
+    pool = WarmPool(launcher=launcher, min_launches=2, half_life=60)
+    now = 1000
+    pool._now = lambda: now
+    image = "registry/popular:abc"
+    repo_url = "https://github.com/org/popular"
+
+    pool.record_launch(image, repo_url)
+    assert pool.take(image) is None
+    await pool.update()
+    # not launched enough yet
+    assert launcher.launched == []
+
+    pool.record_launch(image, repo_url)
+    pool.record_launch("registry/other:abc", "https://github.com/org/other")
+    await pool.update()
+    assert len(launcher.launched) == 1
+    # the pool is full
+    await pool.update()
+    assert len(launcher.launched) == 1
+
+    server = pool.take(image)
+    assert server["url"] == f"http://hub/user/{launcher.launched[0]}/"
+    assert pool.take(image) is None
+    # refilled in the background
+    await asyncio.sleep(0.1)
+    assert len(launcher.launched) == 2
+
+    # idle servers are replaced before they are culled
+    now += pool.max_idle
+    for _ in range(2):
+        pool.record_launch(image, repo_url)
+    await pool.update()
+    assert launcher.deleted == [f"users/{launcher.launched[1]}"]
+    assert len(launcher.launched) == 3
+
+    # images that aren't launched anymore don't have idle servers
+    now += 600
+    await pool.update()
+    assert launcher.deleted[1] == f"users/{launcher.launched[2]}"
+    assert pool.target_sizes() == {}
+    assert pool.take(image) is None
+
+
+class MockLaunchQuota(LaunchQuota):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.servers = 0
+        self.assigned = []
+
+    async def check_repo_quota(self, image_name, repo_config, repo_url, reserve=False):
+        if self.servers >= repo_config.get("quota", 0):
+            raise LaunchQuotaExceeded(
+                "full", quota=repo_config["quota"], used=self.servers, status="repo"
+            )
+        self.servers += 1
+        return ServerQuotaCheck(self.servers, self.servers, 1, reservation=self.servers)
+
+    def assign(self, reservation, username, server_name=""):
+        self.assigned.append((reservation, username))
+
+    async def release(self, reservation):
+        pass
+
+
+async def test_warm_pool_quota():
+    launcher = MockLauncher()
+    launch_quota = MockLaunchQuota()
+    pool = WarmPool(
+        launcher=launcher,
+        launch_quota=launch_quota,
+        min_launches=0.5,
+        max_servers_per_image=3,
+    )
+    pool._start_seconds = 1e6
+    image = "registry/popular:abc"
+    extra_args = {"binder_launch_host": "https://mybinder.org/"}
+    pool.record_launch(
+        image, "https://github.com/org/popular", {"quota": 2}, extra_args
+    )
+    await pool.update()
+    # idle servers are launched within the quota of the repository,
+    # with the launch arguments of the image
+    assert len(launcher.launched) == 2
+    assert launcher.launch_args == [extra_args, extra_args]
+    assert launch_quota.assigned == [
+        (1, launcher.launched[0]),
+        (2, launcher.launched[1]),
+    ]
+
+
+def test_warm_pool_sizes():
+    pool = WarmPool(
+        min_launches=1, half_life=600, max_servers_per_image=3, max_servers=4
+    )
+    pool._start_seconds = 30
+    for _ in range(100):
+        pool.record_launch("registry/busy:abc", "")
+    for _ in range(10):
+        pool.record_launch("registry/hot:abc", "")
+    pool.record_launch("registry/lukewarm:abc", "")
+    # ~0.12 launches per second for 30s, ~0.01 launches per second
+    assert pool.target_sizes() == {
+        "registry/busy:abc": 3,
+        "registry/hot:abc": 1,
+    }
@@ -145,6 +145,20 @@ class Cache(OrderedDict):
         return result
 
 
+def redis_from_url(url):
+    """Connect to Redis at `url`, with the optional redis package
+
+    Returns a `redis.asyncio.Redis` client.
+    """
+    try:
+        import redis.asyncio
+    except ImportError as e:
+        raise ImportError(
+            f"The redis package is required to use Redis at {url}: pip install redis"
+        ) from e
+    return redis.asyncio.from_url(url)
+
+
 def url_path_join(*pieces):
     """Join components of url into a relative url.
 
@@ -168,17 +182,64 @@ def url_path_join(*pieces):
     return result
 
 
+class NetworkIndex(dict):
+    """Dict with IPv4Network or IPv6Network keys, indexed by network prefix
+
+    `match(ip_addr)` finds the most specific network containing ip_addr
+    in a binary trie of the network prefixes, in O(prefix length)
+    instead of checking every network.
+
+    The index is built on creation, don't modify it afterwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # a trie for each ip version, nodes are [child for bit 0, child for bit 1, network]
+        self._tries = {4: [None, None, None], 6: [None, None, None]}
+        for network in self:
+            self._insert(network)
+
+    def _insert(self, network):
+        node = self._tries[network.version]
+        address = int(network.network_address)
+        for i in range(
+            network.max_prefixlen - 1, network.max_prefixlen - 1 - network.prefixlen, -1
+        ):
+            bit = (address >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = network
+
+    def match(self, ip_addr):
+        """Return the most specific network containing `ip_addr`, None if there is none"""
+        ip = ipaddress.ip_address(ip_addr)
+        node = self._tries[ip.version]
+        address = int(ip)
+        match = node[2]
+        for i in range(ip.max_prefixlen - 1, -1, -1):
+            node = node[(address >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+
 def ip_in_networks(
     ip_addr: str, networks: Iterable[ipaddress.IPv4Network | ipaddress.IPv6Network]
 ):
     """
     Checks if `ip_addr` is contained within any of the networks in `networks`
 
-    If ip_addr is in any of the provided networks, return the first network that matches.
+    If ip_addr is in any of the provided networks, return the first network that matches,
+    or the most specific one if `networks` is a NetworkIndex.
     If not, return False
 
     Both ipv6 and ipv4 are supported
     """
+    if isinstance(networks, NetworkIndex):
+        return networks.match(ip_addr) or False
     ip = ipaddress.ip_address(ip_addr)
     for network in networks:
         if ip in network:
@@ -0,0 +1,264 @@
+"""
+Servers started ahead of the launches of popular images
+"""
+
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from functools import partial
+from urllib.parse import quote
+
+from prometheus_client import Counter, Gauge
+from traitlets import Any, Float, Integer
+from traitlets.config import LoggingConfigurable
+
+from .quota import LaunchQuotaExceeded
+
+WARM_POOL_SERVERS = Gauge(
+    "binderhub_warm_pool_servers", "Idle servers started ahead of launches"
+)
+WARM_POOL_LAUNCHES = Counter(
+    "binderhub_warm_pool_launch_count",
+    "Launches of images with a warm pool, by whether an idle server was available",
+    ["status"],
+)
+
+
+class WarmPool(LoggingConfigurable):
+    """Keep idle servers running for the most launched images
+
+    When an image with an idle server is launched, the server (its url and token)
+    is handed to the requester instead of starting a new one,
+    and the pool is refilled in the background.
+
+    The number of idle servers of an image follows its launch rate:
+    enough servers to serve the launches made while a new server is starting.
+
+    Idle servers count towards the launch quota like any other server:
+    the quota is checked before starting one, and before handing one out.
+
+    Idle servers are started with the launch arguments that are the same
+    for every launch of an image (BINDER_REF_URL, BINDER_LAUNCH_HOST
+    and BINDER_PERSISTENT_REQUEST), from the last launch of the image.
+    The arguments of each request (BINDER_REQUEST and BINDER_CLIENT_IP)
+    aren't known when the server starts, and aren't set.
+
+    Only used without authentication, where servers belong to temporary users.
+    """
+
+    launcher = Any(help="The Launcher starting the servers")
+
+    launch_quota = Any(
+        None,
+        allow_none=True,
+        help="LaunchQuota to check before starting idle servers, not checked if None",
+    )
+
+    max_servers_per_image = Integer(
+        3,
+        config=True,
+        help="Maximum number of idle servers of each image",
+    )
+
+    max_servers = Integer(
+        20,
+        config=True,
+        help="Maximum number of idle servers of all images",
+    )
+
+    min_launches = Float(
+        3,
+        config=True,
+        help="""
+        Minimum number of recent launches of an image to keep idle servers for it
+        """,
+    )
+
+    half_life = Float(
+        600,
+        config=True,
+        help="""
+        Time (in seconds) for the count of recent launches of an image to decay by half
+        """,
+    )
+
+    max_idle = Integer(
+        600,
+        config=True,
+        help="""
+        Time (in seconds) after which idle servers are stopped and replaced.
+
+        Should be less than the idle timeout of the JupyterHub culler,
+        so that servers aren't culled before being handed to users.
+        """,
+    )
+
+    update_interval = Integer(
+        30,
+        config=True,
+        help="Interval (in seconds) for how often idle servers are started or stopped",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # image: [launches, updated, repo_url, repo_config, extra_args]
+        self._launches = {}
+        # image: idle servers {"username", "created", "data"}, oldest first
+        self._servers = defaultdict(deque)
+        # image: number of servers starting
+        self._starting = defaultdict(int)
+        # moving average of the time to start a server
+        self._start_seconds = 30.0
+
+    def _now(self):
+        return time.monotonic()
+
+    def _recent_launches(self, image, now):
+        launches, updated = self._launches[image][:2]
+        return launches * 0.5 ** ((now - updated) / self.half_life)
+
+    def record_launch(self, image, repo_url, repo_config=None, extra_args=None):
+        """Record a launch of `image`
+
+        repo_config: the configuration of the repository, to check its quota
+        extra_args: the launch arguments that are the same for every launch of `image`
+        """
+        now = self._now()
+        launches = self._recent_launches(image, now) if image in self._launches else 0
+        self._launches[image] = [
+            launches + 1,
+            now,
+            repo_url,
+            repo_config or {},
+            extra_args or {},
+        ]
+
+    def available(self, image):
+        """Whether `image` has idle servers, which may have expired"""
+        return bool(self._servers.get(image))
+
+    def target_sizes(self):
+        """The number of idle servers to keep for each image"""
+        now = self._now()
+        sizes = {}
+        total = 0
+        recent = {image: self._recent_launches(image, now) for image in self._launches}
+        for image in sorted(recent, key=recent.get, reverse=True):
+            launches = recent[image]
+            if launches < self.min_launches:
+                # forget images without recent launches
+                if launches < 0.1 and not self._servers.get(image):
+                    del self._launches[image]
+                continue
+            # launches per second, from the count decayed with half_life
+            rate = launches * math.log(2) / self.half_life
+            size = min(
+                self.max_servers_per_image,
+                self.max_servers - total,
+                max(1, math.ceil(rate * self._start_seconds)),
+            )
+            if size <= 0:
+                break
+            sizes[image] = size
+            total += size
+        return sizes
+
+    def take(self, image):
+        """Take an idle server of `image`
+
+        Returns the launch info of the server (see Launcher.launch),
+        or None if there is no idle server.
+        """
+        servers = self._servers.get(image)
+        now = self._now()
+        while servers:
+            # newest first, the oldest are the closest to being culled
+            server = servers.pop()
+            if now - server["created"] < self.max_idle:
+                WARM_POOL_LAUNCHES.labels(status="hit").inc()
+                self._update_metrics()
+                asyncio.ensure_future(self.update())
+                self.log.info(
+                    "Handing idle server of %s to a new user %s",
+                    image,
+                    server["username"],
+                )
+                return server["data"]
+            asyncio.ensure_future(self._stop(server))
+        if servers is not None:
+            WARM_POOL_LAUNCHES.labels(status="miss").inc()
+        return None
+
+    def _update_metrics(self):
+        WARM_POOL_SERVERS.set(sum(len(servers) for servers in self._servers.values()))
+
+    async def _start(self, image):
+        """Start an idle server, counted in _starting by the caller"""
+        _, _, repo_url, repo_config, extra_args = self._launches[image]
+        username = self.launcher.unique_name_from_repo(repo_url)
+        start = self._now()
+        quota_check = None
+        try:
+            if self.launch_quota is not None:
+                quota_check = await self.launch_quota.check_repo_quota(
+                    image, repo_config, repo_url, reserve=True
+                )
+            data = await self.launcher.launch(
+                image=image,
+                username=username,
+                repo_url=repo_url,
+                extra_args=dict(extra_args),
+                spawn_callback=partial(self._assign_reservation, quota_check),
+            )
+        except LaunchQuotaExceeded as e:
+            self.log.info("Not starting idle server of %s: %s", image, e.message)
+            return
+        except Exception as e:
+            self.log.error("Failed to start idle server of %s: %s", image, e)
+            return
+        finally:
+            self._starting[image] -= 1
+            if quota_check is not None and quota_check.reservation is not None:
+                await self.launch_quota.release(quota_check.reservation)
+        self._start_seconds = 0.8 * self._start_seconds + 0.2 * (self._now() - start)
+        self._servers[image].append(
+            {"username": username, "created": self._now(), "data": data}
+        )
+        self._update_metrics()
+
+    def _assign_reservation(self, quota_check, username, server_name):
+        if quota_check is not None and quota_check.reservation is not None:
+            self.launch_quota.assign(quota_check.reservation, username, server_name)
+
+    async def _stop(self, server):
+        try:
+            await self.launcher.api_request(
+                f"users/{quote(server['username'], safe='@~')}", method="DELETE"
+            )
+        except Exception as e:
+            self.log.error("Failed to stop idle server %s: %s", server["username"], e)
+
+    async def update(self):
+        """Stop old idle servers, and start servers for the images short of idle servers"""
+        now = self._now()
+        stop = []
+        for servers in self._servers.values():
+            while servers and now - servers[0]["created"] >= self.max_idle:
+                stop.append(servers.popleft())
+        sizes = self.target_sizes()
+        # stop the servers of images that aren't launched as much anymore
+        for image, servers in self._servers.items():
+            while len(servers) > sizes.get(image, 0):
+                stop.append(servers.popleft())
+        self._update_metrics()
+
+        start = []
+        for image, size in sizes.items():
+            missing = size - len(self._servers[image]) - self._starting[image]
+            if missing <= 0:
+                continue
+            # count them before they start, so that concurrent updates don't start more
+            self._starting[image] += missing
+            start.extend(self._start(image) for _ in range(missing))
+        await asyncio.gather(*start, *(self._stop(server) for server in stop))
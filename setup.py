@@ -70,5 +70,7 @@ setup(
         #   for building documentation which inspects the source code.
         #
         "pycurl": ["pycurl"],
+        # redis is an optional dependency to share state between replicas
+        "redis": ["redis>=4.2"],
     },
 )